@@ -1,8 +1,25 @@
 from discord.ext import commands
 import discord.utils
 
+from discordbot.utils.metrics import metrics
+from discordbot.utils.ratelimit import limiter
+
 def is_owner_check(message):
     return message.author.id == '215839425211531266' #M'vy#8790
 
 def is_owner():
     return commands.check(lambda ctx: is_owner_check(ctx.message))
+
+class RateLimited(commands.CheckFailure):
+    '''Raised for a command over its budget, which is dropped silently'''
+    pass
+
+def rate_limited_check(ctx):
+    name = ctx.command.qualified_name
+    if limiter.allow(name, ctx.message.author.id, ctx.message.channel.id):
+        return True
+    metrics.incr('berlioz_rate_limited_total', command=name)
+    raise RateLimited('Command ' + name + ' is rate limited.')
+
+def rate_limited():
+    return commands.check(rate_limited_check)
@@ -0,0 +1,58 @@
+import argparse
+import subprocess
+import sys
+
+# Modules imported when the bot starts
+startup_modules = ['main', 'tcnexts.collab']
+
+
+def profile(module):
+    '''
+    Imports module in a fresh interpreter with -X importtime
+
+    :return: (cumulative us, self us, name) for every imported module
+    :rtype: list
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import ' + module],
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            own, cumulative = int(fields[0]), int(fields[1])
+        except ValueError:
+            # Header line
+            continue
+        entries.append((cumulative, own, fields[2].strip()))
+
+    if result.returncode != 0:
+        raise Exception('importing ' + module + ' failed:\n' + result.stderr)
+    return entries
+
+
+def report(module, top=15):
+    '''Returns the import profile of module as text'''
+    entries = profile(module)
+    total = max(entries)[0] if entries else 0
+    lines = ['{}: {:.1f} ms, {} modules'.format(module, total / 1000,
+                                                 len(entries)),
+             '  {:>10s} {:>10s}  module'.format('cumul ms', 'self ms')]
+    for cumulative, own, name in sorted(entries, reverse=True)[:top]:
+        lines.append('  {:10.1f} {:10.1f}  {}'.format(cumulative / 1000,
+                                                      own / 1000, name))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Reports where the startup imports spend their time.')
+    parser.add_argument('modules', nargs='*', default=startup_modules)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        print(report(module, args.top))
+        print()
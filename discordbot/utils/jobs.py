@@ -0,0 +1,381 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from discordbot.utils.storethread import (StoreThread, cancelTasks)
+
+jobs_path = 'tmp/jobs.db'
+# Jobs running at once
+max_workers = 4
+# Seconds a job may run before being cancelled, None for no limit
+default_timeout = 600
+# Finished jobs kept for !jobs
+history_size = 20
+
+log = logging.getLogger(__name__)
+
+
+class JobStore():
+    '''
+    Queued jobs stored in SQLite, so that they survive restarts
+
+    A job is removed once it ends. Those running when the process stops stay
+    and run again on the next start.
+    '''
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            args TEXT NOT NULL,
+            guild TEXT,
+            priority INTEGER NOT NULL,
+            timeout REAL,
+            key TEXT,
+            created REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path=jobs_path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(JobStore.schema)
+
+    def add(self, row):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO jobs VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def remove(self, job_id):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def load(self):
+        '''Returns the rows of the stored jobs, oldest first'''
+        with self.lock:
+            return self.conn.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class Job():
+    '''A call of a registered job kind, with its scheduling and timing'''
+    __slots__ = ('id', 'kind', 'args', 'guild', 'priority', 'timeout', 'key',
+                 'created', 'started', 'finished', 'state', 'error', 'task',
+                 'ended')
+
+    def __init__(self, id, kind, args=(), guild=None, priority=0,
+                 timeout=default_timeout, key=None, created=None):
+        self.id = id
+        self.kind = kind
+        self.args = list(args)
+        self.guild = guild
+        self.priority = priority
+        self.timeout = timeout
+        self.key = key
+        self.created = time.time() if created is None else created
+        self.started = None
+        self.finished = None
+        # pending, running, then done, failed, timeout or cancelled
+        self.state = 'pending'
+        self.error = None
+        self.task = None
+        # Future set to the final state once the job ends
+        self.ended = None
+
+    def __repr__(self):
+        return 'Job({}, {}, {})'.format(self.id, self.kind, self.state)
+
+    def row(self):
+        '''Returns the job as a JobStore row, raising if its args are not JSON'''
+        return (self.id, self.kind, json.dumps(self.args), self.guild,
+                self.priority, self.timeout, self.key, self.created)
+
+    @classmethod
+    def fromRow(cls, row):
+        id, kind, args, guild, priority, timeout, key, created = row
+        return cls(id, kind, json.loads(args), guild, priority, timeout, key,
+                   created)
+
+    @property
+    def waited(self):
+        '''Seconds spent in the queue'''
+        end = self.started or self.finished or time.time()
+        return max(0.0, end - self.created)
+
+    @property
+    def ran(self):
+        '''Seconds spent running'''
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+class Scheduler():
+    '''
+    Runs jobs on a bounded number of workers
+
+    Job kinds are coroutine functions registered by name, and jobs are a kind
+    with JSON arguments, so that the queue can be stored in a JobStore and
+    taken up again after a restart. Higher priorities run first. Among equal
+    priorities, guilds take turns so that one guild queueing many jobs does
+    not hold the others up. Jobs given a key are found with find(), a new
+    job of a key replacing the one queued or running.
+
+    Kinds keeping state outside the queue, such as a checkpoint to resume
+    from, register a cancel function so that revoke() clears it too.
+    '''
+
+    def __init__(self, store=None, workers=max_workers, metrics=None,
+                 history=history_size):
+        self.store = store
+        self.workers = workers
+        self.metrics = metrics
+        self.kinds = {}
+        self.cancellers = {}
+        # Queued and running jobs, by id and by key
+        self.jobs = {}
+        self.keys = {}
+        # Heap of (-priority, id) of each guild, and the guilds with queued
+        # jobs, least recently served first
+        self.queues = {}
+        self.guilds = collections.OrderedDict()
+        self.history = collections.deque(maxlen=history)
+        self.ids = itertools.count(1)
+        self.thread = StoreThread('job queue')
+        self.loop = None
+        self.wakeup = None
+        self.tasks = []
+
+    def register(self, kind, function, cancel=None):
+        '''
+        Registers the coroutine function run by the jobs of kind, and the
+        one revoke() calls with the args of a job instead of cancel()
+        '''
+        self.kinds[kind] = function
+        if cancel is None:
+            self.cancellers.pop(kind, None)
+        else:
+            self.cancellers[kind] = cancel
+
+    def unregister(self, kind):
+        '''Forgets a kind, its stored jobs failing if run before it is back'''
+        self.kinds.pop(kind, None)
+        self.cancellers.pop(kind, None)
+
+    def start(self, loop=None):
+        '''Queues the stored jobs and starts the workers on loop'''
+        self.loop = loop or asyncio.get_event_loop()
+        self.wakeup = asyncio.Event()
+        if self.store is not None:
+            rows = self.store.load()
+            for row in rows:
+                self.enqueue(Job.fromRow(row))
+            if rows:
+                self.ids = itertools.count(rows[-1][0] + 1)
+                log.info('Resuming %d stored jobs', len(rows))
+        self.tasks = [self.loop.create_task(self.work())
+                      for i in range(self.workers)]
+
+    def stop(self):
+        '''
+        Stops the workers, the jobs they were running staying stored to run
+        again on the next start. May be called once the loop is closed.
+        '''
+        cancelTasks(self.loop, self.tasks + [job.task for job in
+                                             self.jobs.values()
+                                             if job.task is not None])
+        self.tasks = []
+        self.thread.stop()
+        if self.store is not None:
+            self.store.close()
+
+    def submit(self, kind, args=(), guild=None, priority=0,
+               timeout=default_timeout, key=None):
+        '''
+        Queues a job of kind, called with args, cancelling the live job of
+        key if there is one
+
+        :raises KeyError: for a kind that was not registered
+        :raises TypeError: for args that cannot be written as JSON
+        :return: the Job
+        '''
+        if kind not in self.kinds:
+            raise KeyError('Unknown job kind: ' + kind)
+        job = Job(next(self.ids), kind, args, guild, priority, timeout, key)
+        row = job.row()
+        if key is not None and key in self.keys:
+            self.cancel(self.keys[key].id)
+        self.enqueue(job)
+        if self.store is not None:
+            self.thread.submit(self.store.add, row)
+        return job
+
+    def enqueue(self, job):
+        job.ended = self.loop.create_future()
+        self.jobs[job.id] = job
+        if job.key is not None:
+            self.keys[job.key] = job
+        heapq.heappush(self.queues.setdefault(job.guild, []),
+                       (-job.priority, job.id))
+        self.guilds.setdefault(job.guild)
+        self.wakeup.set()
+
+    def take(self):
+        '''Returns the next job to run, None if none is queued'''
+        # Jobs without a guild queue under None, hence the separate flag
+        found = False
+        best = None
+        for guild in list(self.guilds):
+            queue = self.queues[guild]
+            # Cancelled jobs are only dropped from the heaps here
+            while queue and queue[0][1] not in self.jobs:
+                heapq.heappop(queue)
+            if not queue:
+                del self.guilds[guild]
+                del self.queues[guild]
+            elif not found or queue[0][0] < self.queues[best][0][0]:
+                found = True
+                best = guild
+        if not found:
+            return None
+
+        queue = self.queues[best]
+        job = self.jobs[heapq.heappop(queue)[1]]
+        if queue:
+            self.guilds.move_to_end(best)
+        else:
+            del self.guilds[best]
+            del self.queues[best]
+        return job
+
+    async def work(self):
+        while True:
+            job = self.take()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.run(job)
+
+    async def run(self, job):
+        job.state = 'running'
+        job.started = time.time()
+        try:
+            function = self.kinds.get(job.kind)
+            if function is None:
+                raise KeyError('Unknown job kind: ' + job.kind)
+            job.task = asyncio.ensure_future(function(*job.args))
+            await asyncio.wait_for(job.task, job.timeout)
+        except asyncio.CancelledError:
+            if job.state != 'cancelled':
+                # The worker is stopping, the job stays stored
+                raise
+        except asyncio.TimeoutError:
+            job.state = 'timeout'
+            log.warning('Job %s %s timed out after %ss', job.id, job.kind,
+                        job.timeout)
+        except Exception as e:
+            job.state = 'failed'
+            job.error = '{}: {}'.format(type(e).__name__, e)
+            log.warning('Job %s %s failed: %s', job.id, job.kind, job.error)
+        else:
+            job.state = 'done'
+        self.finish(job)
+
+    def finish(self, job):
+        job.finished = time.time()
+        job.task = None
+        del self.jobs[job.id]
+        if job.key is not None and self.keys.get(job.key) is job:
+            del self.keys[job.key]
+        self.history.append(job)
+        if self.store is not None:
+            self.thread.submit(self.store.remove, job.id)
+        if not job.ended.done():
+            job.ended.set_result(job.state)
+
+        if self.metrics is not None:
+            self.metrics.incr('berlioz_jobs_total', kind=job.kind,
+                              state=job.state)
+            self.metrics.observe('berlioz_job_wait_seconds', job.waited,
+                                 kind=job.kind)
+            if job.started is not None:
+                self.metrics.observe('berlioz_job_seconds', job.ran,
+                                     kind=job.kind)
+
+    def cancel(self, job_id):
+        '''Cancels a queued or running job, returns it or None if not found'''
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job.state == 'cancelled':
+            # Running until its task takes the cancellation
+            return job
+        if job.state == 'running':
+            job.state = 'cancelled'
+            job.task.cancel()
+        else:
+            job.state = 'cancelled'
+            self.finish(job)
+        return job
+
+    async def revoke(self, job_id):
+        '''
+        Cancels a job for good, as asked by a user, its kind dropping the
+        state it would be resumed from. Returns the job or None if not found.
+        '''
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        canceller = self.cancellers.get(job.kind)
+        if canceller is None:
+            return self.cancel(job_id)
+        await canceller(*job.args)
+        self.cancel(job_id)
+        return job
+
+    def find(self, key):
+        '''Returns the queued or running job of key, None if there is none'''
+        return self.keys.get(key)
+
+    def live(self, guild=None):
+        '''Returns the queued and running jobs, of a single guild if given'''
+        return [job for job in self.jobs.values()
+                if guild is None or job.guild == guild]
+
+    def every(self, interval, kind, args=(), priority=-1,
+              timeout=default_timeout, key=None):
+        '''
+        Submits a job of kind now and every interval seconds, skipping the
+        times the previous one is still queued or running
+        '''
+        key = key or kind
+
+        async def submitter():
+            while True:
+                if self.find(key) is None:
+                    self.submit(kind, args, priority=priority,
+                                timeout=timeout, key=key)
+                await asyncio.sleep(interval)
+
+        task = self.loop.create_task(submitter())
+        self.tasks.append(task)
+        return task
+
+    def collect(self, metrics):
+        '''Metrics collector of the queue sizes'''
+        running = sum(job.state == 'running' for job in self.jobs.values())
+        metrics.set('berlioz_jobs_running', running)
+        metrics.set('berlioz_jobs_queued', len(self.jobs) - running)
@@ -0,0 +1,40 @@
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    '''
+    Stands for a module that is only imported when one of its attributes is
+    first used. A missing module fails at that point rather than at startup.
+    '''
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    @property
+    def loaded(self):
+        return self.__dict__['_module'] is not None
+
+    def load(self):
+        '''Imports the module if needed and returns it'''
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __dir__(self):
+        return dir(self.load())
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded'
+        return '<lazy module {!r} ({})>'.format(self.__name__, state)
+
+
+def lazyImport(name):
+    '''Returns a proxy importing module name on first use'''
+    return LazyModule(name)
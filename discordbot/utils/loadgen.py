@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+import random
+import time
+
+# Seconds between two wake ups of the lag monitor, and lag counted as a stall
+lag_interval = 0.01
+stall_threshold = 0.05
+
+mode_names = ['M', 'nm', 'hm', 'mm']
+
+
+class FakeServer():
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id):
+        self.id = id
+        self.name = 'server-' + id
+
+
+class FakeChannel():
+    '''Just what command dispatch reads of a discord.Channel'''
+    __slots__ = ('id', 'name', 'server', 'is_private')
+
+    def __init__(self, id, server):
+        self.id = id
+        self.name = 'channel-' + id
+        self.server = server
+        self.is_private = False
+
+
+class FakeUser():
+    __slots__ = ('id', 'name', 'bot', 'display_name')
+
+    def __init__(self, id):
+        self.id = id
+        self.name = self.display_name = 'user-' + id
+        self.bot = False
+
+
+class FakeMessage():
+    '''Just what command dispatch reads of a discord.Message'''
+    __slots__ = ('id', 'content', 'channel', 'author', 'server', 'mentions',
+                 'timestamp')
+
+    def __init__(self, id, content, channel, author):
+        self.id = id
+        self.content = content
+        self.channel = channel
+        self.author = author
+        self.server = channel.server
+        self.mentions = []
+        self.timestamp = time.time()
+
+
+def parseMix(text):
+    '''
+    Parses a command mix such as "scale=8,collab next=3,collab set=1"
+
+    :return: {command: weight}
+    '''
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight) if weight else 1.0
+    return mix
+
+
+class Workload():
+    '''
+    Random commands from many users over many channels
+
+    Channels belong to servers of channels_per_server channels, and each
+    user writes in a single server.
+    '''
+
+    def __init__(self, mix, set_url, channels=100, users=1000,
+                 channels_per_server=10, seed=0):
+        self.mix = mix
+        self.set_url = set_url
+        self.rng = random.Random(seed)
+        servers = [FakeServer(str(i))
+                   for i in range(-(-channels // channels_per_server))]
+        self.channels = [FakeChannel(str(i), servers[i // channels_per_server])
+                         for i in range(channels)]
+        self.users = [FakeUser(str(i)) for i in range(users)]
+        self.ids = itertools.count(1)
+
+    def content(self, command):
+        if command == 'scale':
+            return '!scale {} {}'.format(self.rng.randint(-7, 7),
+                                         self.rng.choice(mode_names))
+        if command == 'collab set':
+            return '!collab set ' + self.set_url
+        return '!' + command
+
+    def messages(self, count):
+        '''Yields count messages following the mix'''
+        commands = list(self.mix)
+        weights = [self.mix[c] for c in commands]
+        for command in self.rng.choices(commands, weights, k=count):
+            channel = self.rng.choice(self.channels)
+            author = self.rng.choice(self.users)
+            yield FakeMessage(str(next(self.ids)), self.content(command),
+                              channel, author)
+
+
+def percentile(values, fraction):
+    '''Returns the value under which fraction of the sorted values fall'''
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+class LagMonitor():
+    '''Measures how late the event loop wakes up, as watchLoop does'''
+
+    def __init__(self, interval=lag_interval, threshold=stall_threshold):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_lag = 0.0
+        self.stalled = 0.0
+        self.stalls = 0
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.stalls += 1
+                self.stalled += lag
+
+
+async def replay(handler, messages, rate):
+    '''
+    Sends messages to handler at rate per second, without waiting for the
+    previous ones to be handled
+
+    :param handler: coroutine function taking a message, as on_message
+    :return: (latencies in seconds sorted, failures, elapsed seconds)
+    '''
+    loop = asyncio.get_event_loop()
+    latencies = []
+    failures = 0
+
+    async def timed(message):
+        nonlocal failures
+        start = loop.time()
+        try:
+            await handler(message)
+        except Exception:
+            failures += 1
+        latencies.append(loop.time() - start)
+
+    start = loop.time()
+    tasks = []
+    for i, message in enumerate(messages):
+        delay = start + i / rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(timed(message)))
+    await asyncio.gather(*tasks)
+    return sorted(latencies), failures, loop.time() - start
+
+
+def report(latencies, failures, elapsed, monitor, errors=0):
+    '''Returns the figures of a replay as a dict'''
+    return {
+        'commands': len(latencies),
+        'failures': failures,
+        'errors': errors,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else 0.0,
+        'max_lag': monitor.max_lag,
+        'stalls': monitor.stalls,
+        'stalled': monitor.stalled,
+    }
+
+
+def formatReport(figures):
+    return '\n'.join([
+        '{commands} commands in {seconds:.2f}s, {throughput:.0f}/s',
+        '{failures} failed, {errors} command errors',
+        'latency p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms, max {max_ms:.2f}ms',
+        'event loop: max lag {max_lag_ms:.2f}ms, {stalls} stalls, '
+        '{stalled_ms:.2f}ms stalled',
+    ]).format(p50_ms=figures['p50'] * 1e3, p99_ms=figures['p99'] * 1e3,
+              max_ms=figures['max'] * 1e3,
+              max_lag_ms=figures['max_lag'] * 1e3,
+              stalled_ms=figures['stalled'] * 1e3, **figures)
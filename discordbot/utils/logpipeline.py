@@ -0,0 +1,142 @@
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+# Rotate the log file once it reaches that many bytes, keeping backup_count
+# previous files
+max_bytes = 10 * 1024 * 1024
+backup_count = 5
+
+# Attributes every LogRecord has, the others come from extra=
+record_attributes = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats records as one JSON object per line'''
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'thread': record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        for name, value in vars(record).items():
+            if name not in record_attributes:
+                data[name] = value
+        return json.dumps(data, default=str)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queues records for the listener thread, keeping the traceback apart from
+    the message so it can be written as its own field
+    '''
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Keeps one record in n of the loggers given as {name: n}, and their
+    children. Warnings and above are always kept.
+    '''
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.counts = {}
+        self.dropped = 0
+
+    def rate(self, name):
+        while True:
+            if name in self.rates:
+                return self.rates[name]
+            if '.' not in name:
+                return 1
+            name = name.rsplit('.', 1)[0]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        if rate <= 1:
+            return True
+
+        count = self.counts.get(record.name, 0)
+        self.counts[record.name] = count + 1
+        if count % rate == 0:
+            return True
+        self.dropped += 1
+        return False
+
+
+def configureLevels(levels):
+    '''Sets the level of each logger of {name: level}, '' being the root'''
+    for name, level in levels.items():
+        logging.getLogger(name or None).setLevel(level)
+
+
+class LogPipeline():
+    '''
+    Logs of the process written by a background thread
+
+    Loggers only put records on a queue, so the event loop never waits on
+    the disk. The listener thread writes them as JSON lines to a file
+    rotated by size, or by time when when is given (see
+    TimedRotatingFileHandler).
+    '''
+
+    def __init__(self, path, levels=None, sampling=None, max_bytes=max_bytes,
+                 backup_count=backup_count, when=None):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if when is None:
+            self.handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count,
+                encoding='utf-8')
+        else:
+            self.handler = logging.handlers.TimedRotatingFileHandler(
+                path, when=when, backupCount=backup_count, encoding='utf-8')
+        self.handler.setFormatter(JsonFormatter())
+
+        self.levels = levels or {}
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = StructuredQueueHandler(self.queue)
+        self.sampler = SamplingFilter(sampling or {})
+        self.queue_handler.addFilter(self.sampler)
+        self.listener = logging.handlers.QueueListener(self.queue, self.handler)
+
+    def start(self, logger=None):
+        '''Routes the records of logger, the root one by default'''
+        configureLevels(self.levels)
+        self.logger = logger or logging.getLogger()
+        self.logger.addHandler(self.queue_handler)
+        self.listener.start()
+
+    def stop(self):
+        '''Writes the queued records and closes the file'''
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+        self.handler.close()
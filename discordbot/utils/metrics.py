@@ -0,0 +1,177 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets, in seconds
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+log = logging.getLogger(__name__)
+
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+
+def formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def writeText(path, text):
+    '''Writes text to path, replacing it atomically'''
+    with open(path + '.tmp', 'w') as outfile:
+        outfile.write(text)
+    os.replace(path + '.tmp', path)
+
+
+class Histogram():
+    '''Counts of observations falling under each bucket bound'''
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics():
+    '''
+    Counters, gauges and histograms rendered in the Prometheus text format
+
+    Metrics are identified by a name and keyword labels. Recording costs a
+    dict lookup and nothing at all when disabled.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def incr(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        series = self.counters.setdefault(name, {})
+        key = labelKey(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        self.gauges.setdefault(name, {})[labelKey(labels)] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        series = self.histograms.setdefault(name, {})
+        key = labelKey(labels)
+        try:
+            histogram = series[key]
+        except KeyError:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''Observes the time spent in the with block'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register(self, collector):
+        '''Adds a callable run before each rendering, to update gauges'''
+        self.collectors.append(collector)
+
+    def render(self):
+        '''Returns every metric in the Prometheus text format'''
+        for collector in self.collectors:
+            collector(self)
+
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append('# TYPE {} counter'.format(name))
+            for key, value in sorted(series.items()):
+                lines.append('{}{} {}'.format(name, formatLabels(key), value))
+        for name, series in sorted(self.gauges.items()):
+            lines.append('# TYPE {} gauge'.format(name))
+            for key, value in sorted(series.items()):
+                lines.append('{}{} {}'.format(name, formatLabels(key), value))
+        for name, series in sorted(self.histograms.items()):
+            lines.append('# TYPE {} histogram'.format(name))
+            for key, histogram in sorted(series.items()):
+                cumulative = 0
+                bounds = list(histogram.buckets) + ['+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, formatLabels(key, [('le', bound)]), cumulative))
+                lines.append('{}_sum{} {}'.format(name, formatLabels(key),
+                                                  histogram.total))
+                lines.append('{}_count{} {}'.format(name, formatLabels(key),
+                                                    histogram.count))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def writeTo(self, path):
+        '''Writes the rendered metrics to path, replacing it atomically'''
+        writeText(path, self.render())
+
+    async def export(self, path, interval=15):
+        '''
+        Writes the metrics to path every interval seconds. They are rendered
+        on the loop, which the collectors read the state of, and only the
+        file is written in the default executor.
+        '''
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                text = self.render()
+                await loop.run_in_executor(None, writeText, path, text)
+            except Exception as e:
+                log.exception('Could not write the metrics: %s', e)
+
+    async def serve(self, host='127.0.0.1', port=9108):
+        '''Serves the metrics over HTTP, on any path'''
+        async def answer(reader, writer):
+            try:
+                await reader.readline()
+                body = self.render().encode('utf-8')
+                writer.write(b'HTTP/1.0 200 OK\r\n'
+                             b'Content-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() +
+                             b'\r\n\r\n' + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(answer, host, port)
+
+    async def watchLoop(self, interval=0.5):
+        '''Measures how late the event loop wakes up from a sleep'''
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - start - interval)
+            self.set('berlioz_event_loop_last_lag_seconds', lag)
+            self.observe('berlioz_event_loop_lag_seconds', lag)
+
+
+metrics = Metrics()
@@ -0,0 +1,99 @@
+import time
+
+# (tokens per second, burst) allowed for each command, per user and per
+# channel. Commands missing from the table are not limited.
+command_budgets = {
+    'scale': {'user': (0.5, 5), 'channel': (2, 10)},
+    'collab set': {'user': (1 / 60, 2), 'channel': (1 / 30, 2)},
+    'collab next': {'user': (0.5, 3), 'channel': (1, 5)},
+    'progression': {'user': (0.5, 5), 'channel': (2, 10)},
+    'progression analyze': {'user': (0.5, 5), 'channel': (2, 10)},
+    'whichkey': {'user': (0.5, 5), 'channel': (2, 10)},
+    'whichkey notes': {'user': (0.5, 5), 'channel': (2, 10)},
+    'modulate': {'user': (0.5, 5), 'channel': (2, 10)},
+    'jobs': {'user': (0.5, 5), 'channel': (2, 10)},
+    'jobs cancel': {'user': (0.5, 5), 'channel': (2, 10)},
+}
+
+# Buckets kept before the idle ones are dropped
+max_buckets = 10000
+
+
+class TokenBucket():
+    '''Allows rate calls per second on average, and burst calls at once'''
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now, amount=1):
+        '''Takes amount tokens if available, returns whether it could'''
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def isFull(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter():
+    '''Token buckets for each command, user and channel'''
+
+    def __init__(self, budgets=command_budgets):
+        self.budgets = budgets
+        self.buckets = {}
+
+    def bucket(self, command, scope, ident, now):
+        key = (command, scope, ident)
+        try:
+            return self.buckets[key]
+        except KeyError:
+            pass
+
+        if len(self.buckets) >= max_buckets:
+            self.prune(now)
+        rate, capacity = self.budgets[command][scope]
+        bucket = self.buckets[key] = TokenBucket(rate, capacity, now)
+        return bucket
+
+    def allow(self, command, user_id, channel_id, now=None):
+        '''Returns whether the command may run, taking a token if so'''
+        budget = self.budgets.get(command)
+        if budget is None:
+            return True
+
+        now = time.monotonic() if now is None else now
+        buckets = []
+        if 'user' in budget:
+            buckets.append(self.bucket(command, 'user', user_id, now))
+        if 'channel' in budget:
+            buckets.append(self.bucket(command, 'channel', channel_id, now))
+
+        # Tokens are only taken when every bucket agrees
+        for bucket in buckets:
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                return False
+        for bucket in buckets:
+            bucket.consume(now)
+        return True
+
+    def prune(self, now):
+        '''Drops the buckets that refilled completely'''
+        for key in [key for key, bucket in self.buckets.items()
+                    if bucket.isFull(now)]:
+            del self.buckets[key]
+
+
+limiter = RateLimiter()
@@ -0,0 +1,125 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Environment variables telling a worker which shard it runs
+shard_id_variable = 'BERLIOZ_SHARD_ID'
+shard_count_variable = 'BERLIOZ_SHARD_COUNT'
+
+# Seconds to wait before restarting a crashed worker, doubled on each crash
+# in a row up to max_backoff
+min_backoff = 1
+max_backoff = 60
+# A worker running that long is considered healthy again
+stable_after = 300
+
+log = logging.getLogger(__name__)
+
+
+def shardFor(guild_id, shard_count):
+    '''Returns the shard Discord sends the events of a guild to'''
+    return (int(guild_id) >> 22) % shard_count
+
+
+def shardOptions(environ=os.environ):
+    '''Returns the shard_id and shard_count options set by the launcher'''
+    if shard_count_variable not in environ:
+        return {}
+    return {'shard_id': int(environ[shard_id_variable]),
+            'shard_count': int(environ[shard_count_variable])}
+
+
+class Worker():
+    '''One bot process running a single shard'''
+
+    def __init__(self, shard_id, shard_count, command):
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.command = command
+        self.process = None
+        self.started = 0
+        self.backoff = min_backoff
+        self.restart_at = 0
+        self.restarts = 0
+
+    def start(self):
+        environ = dict(os.environ)
+        environ[shard_id_variable] = str(self.shard_id)
+        environ[shard_count_variable] = str(self.shard_count)
+        self.process = subprocess.Popen(self.command, env=environ)
+        self.started = time.monotonic()
+        log.info('Started shard %s/%s, pid %s', self.shard_id,
+                 self.shard_count, self.process.pid)
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, timeout=10):
+        if not self.running():
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class ShardLauncher():
+    '''
+    Runs one worker process per shard and restarts the ones that exit
+
+    Collab state is kept in the SQLite store, which every worker opens. A
+    channel belongs to a single guild and so to a single shard, so only one
+    worker ever moves its cursor.
+    '''
+
+    def __init__(self, shard_count, command=None):
+        if command is None:
+            command = [sys.executable, 'main.py']
+        self.workers = [Worker(i, shard_count, command)
+                        for i in range(shard_count)]
+        self.stopping = False
+
+    def check(self, now=None):
+        '''Restarts the workers that exited, once their backoff expired'''
+        now = time.monotonic() if now is None else now
+        for worker in self.workers:
+            if worker.running():
+                if now - worker.started > stable_after:
+                    worker.backoff = min_backoff
+                continue
+
+            if worker.process is None:
+                worker.start()
+            elif worker.restart_at == 0:
+                log.warning('Shard %s exited with %s, restarting in %ss',
+                            worker.shard_id, worker.process.returncode,
+                            worker.backoff)
+                worker.restart_at = now + worker.backoff
+                worker.backoff = min(worker.backoff * 2, max_backoff)
+            elif now >= worker.restart_at:
+                worker.restart_at = 0
+                worker.restarts += 1
+                worker.start()
+
+    def stop(self, *args):
+        '''Terminates every worker'''
+        self.stopping = True
+        for worker in self.workers:
+            worker.stop()
+
+    def run(self, interval=1):
+        '''Supervises the workers until a termination signal'''
+        signal.signal(signal.SIGTERM, self.stop)
+        try:
+            while not self.stopping:
+                self.check()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
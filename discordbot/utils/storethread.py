@@ -0,0 +1,45 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class StoreThread():
+    '''
+    Runs the calls to a store one at a time on a thread of its own, in the
+    order they are made, so that the event loop never waits on the disk
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def call(self, function, *args):
+        '''Returns function(*args), run on the thread'''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    def submit(self, function, *args):
+        '''Runs function(*args) on the thread without waiting, logging errors'''
+        def logErrors(future):
+            if future.exception() is not None:
+                log.error('Could not write the %s: %s', self.name,
+                          future.exception())
+
+        self.executor.submit(function, *args).add_done_callback(logErrors)
+
+    def stop(self):
+        '''Returns once the pending calls are done'''
+        self.executor.shutdown(wait=True)
+
+
+def cancelTasks(loop, tasks):
+    '''
+    Cancels tasks of loop. Once the loop is closed, as after bot.run(),
+    they are left alone: cancelling raises and they would never run again.
+    '''
+    if loop is None or loop.is_closed():
+        return
+    for task in tasks:
+        task.cancel()
@@ -0,0 +1,553 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from jobs import (JobStore, Scheduler)
+from lazy import lazyImport
+from loadgen import (LagMonitor, Workload, formatReport, parseMix,
+                     percentile, replay, report)
+from logpipeline import (JsonFormatter, LogPipeline, SamplingFilter)
+from metrics import (Metrics, Histogram)
+from ratelimit import (RateLimiter, TokenBucket)
+from shards import (ShardLauncher, shardFor, shardOptions)
+from storethread import StoreThread
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.incr('commands_total', command='scale')
+        metrics.incr('commands_total', command='scale')
+        metrics.set('loaded', 3)
+        metrics.register(lambda m: m.set('collected', 1))
+        with metrics.timer('command_seconds', command='collab next'):
+            pass
+
+        text = metrics.render()
+        self.assertIn('# TYPE commands_total counter', text)
+        self.assertIn('commands_total{command="scale"} 2', text)
+        self.assertIn('loaded 3', text)
+        self.assertIn('collected 1', text)
+        self.assertIn('command_seconds_bucket{command="collab next",le="0.001"} 1',
+                      text)
+        self.assertIn('command_seconds_bucket{command="collab next",le="+Inf"} 1',
+                      text)
+        self.assertIn('command_seconds_count{command="collab next"} 1', text)
+
+    def test_disabled(self):
+        metrics = Metrics(enabled=False)
+        metrics.incr('commands_total')
+        metrics.observe('command_seconds', 1)
+        self.assertEqual(metrics.render(), '')
+
+    def test_writeTo(self):
+        metrics = Metrics()
+        metrics.incr('commands_total')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.prom')
+            metrics.writeTo(path)
+            with open(path) as infile:
+                self.assertEqual(infile.read(), metrics.render())
+
+
+class TestMetricsEndpoint(unittest.IsolatedAsyncioTestCase):
+    async def test_serve(self):
+        metrics = Metrics()
+        metrics.incr('commands_total')
+        server = await metrics.serve(port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+            answer = await reader.read()
+            writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+        self.assertTrue(answer.startswith(b'HTTP/1.0 200 OK'))
+        self.assertIn(b'commands_total 1', answer)
+
+    async def test_watchLoop(self):
+        metrics = Metrics()
+        task = asyncio.ensure_future(metrics.watchLoop(0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        self.assertIn('berlioz_event_loop_lag_seconds', metrics.histograms)
+
+    async def test_export(self):
+        metrics = Metrics()
+        metrics.incr('commands_total')
+        failures = []
+
+        def collector(metrics):
+            # Fails once, the export going on with the next interval
+            if not failures:
+                failures.append(1)
+                raise RuntimeError('collector failed')
+            metrics.set('collected', 1)
+
+        metrics.register(collector)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.prom')
+            task = asyncio.ensure_future(metrics.export(path, 0.01))
+            try:
+                with self.assertLogs('metrics', logging.ERROR):
+                    for i in range(100):
+                        await asyncio.sleep(0.01)
+                        if os.path.exists(path):
+                            break
+            finally:
+                task.cancel()
+            with open(path) as infile:
+                self.assertIn('collected 1', infile.read())
+
+
+class TestLogPipeline(unittest.TestCase):
+    def record(self, name='berlioz.test', level=logging.INFO, msg='hello',
+               args=(), exc_info=None):
+        return logging.LogRecord(name, level, __file__, 1, msg, args,
+                                 exc_info)
+
+    def test_jsonFormatter(self):
+        record = self.record(msg='%s songs', args=(3,))
+        record.channel_id = '42'
+        data = json.loads(JsonFormatter().format(record))
+        self.assertEqual(data['message'], '3 songs')
+        self.assertEqual(data['level'], 'INFO')
+        self.assertEqual(data['logger'], 'berlioz.test')
+        self.assertEqual(data['channel_id'], '42')
+        self.assertNotIn('exception', data)
+
+    def test_sampling(self):
+        sampler = SamplingFilter({'berlioz': 10})
+        kept = [sampler.filter(self.record()) for i in range(100)]
+        self.assertEqual(kept.count(True), 10)
+        self.assertEqual(sampler.dropped, 90)
+        self.assertTrue(all(sampler.filter(self.record(level=logging.WARNING))
+                            for i in range(10)))
+        self.assertTrue(all(sampler.filter(self.record(name='other'))
+                            for i in range(10)))
+
+    def test_pipeline(self):
+        logger = logging.getLogger('berlioz.pipeline')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'logs', 'berlioz.log')
+            pipeline = LogPipeline(path, levels={'berlioz.pipeline':
+                                                 logging.DEBUG},
+                                   sampling={'berlioz.pipeline.hot': 5},
+                                   max_bytes=2000, backup_count=2)
+            pipeline.start(logger)
+            try:
+                for i in range(10):
+                    logger.getChild('hot').debug('hot %d', i)
+                try:
+                    1 / 0
+                except ZeroDivisionError:
+                    logger.exception('failed')
+                for i in range(30):
+                    logger.info('line %d', i, extra={'channel_id': str(i)})
+            finally:
+                pipeline.stop()
+                logger.setLevel(logging.NOTSET)
+
+            records = []
+            for name in sorted(glob.glob(path + '*'), reverse=True):
+                with open(name, encoding='utf-8') as infile:
+                    records.extend(json.loads(line) for line in infile)
+            self.assertEqual(len(glob.glob(path + '*')), 3)
+
+        # Rotation dropped the oldest records, the last ones are all there
+        self.assertEqual([r['message'] for r in records[-3:]],
+                         ['line 27', 'line 28', 'line 29'])
+        self.assertEqual(records[-1]['channel_id'], '29')
+        self.assertEqual(pipeline.sampler.dropped, 8)
+        self.assertEqual(logger.handlers, [])
+
+    def test_exception(self):
+        logger = logging.getLogger('berlioz.exception')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'berlioz.log')
+            pipeline = LogPipeline(path, when='midnight')
+            pipeline.start(logger)
+            try:
+                try:
+                    1 / 0
+                except ZeroDivisionError:
+                    logger.exception('failed')
+                logger.getChild('hot').error('sampled %d', 1)
+            finally:
+                pipeline.stop()
+            with open(path, encoding='utf-8') as infile:
+                records = [json.loads(line) for line in infile]
+        self.assertEqual(records[0]['message'], 'failed')
+        self.assertIn('ZeroDivisionError', records[0]['exception'])
+        self.assertEqual(records[1]['message'], 'sampled 1')
+
+
+class TestJobs(unittest.IsolatedAsyncioTestCase):
+    def scheduler(self, store=None, workers=1, metrics=None):
+        scheduler = Scheduler(store, workers=workers, metrics=metrics)
+        self.calls = []
+
+        async def record(name):
+            self.calls.append(name)
+
+        async def sleep(seconds):
+            await asyncio.sleep(seconds)
+
+        async def fail():
+            raise ValueError('broken')
+
+        scheduler.register('record', record)
+        scheduler.register('sleep', sleep)
+        scheduler.register('fail', fail)
+        return scheduler
+
+    async def test_order(self):
+        scheduler = self.scheduler()
+        scheduler.start()
+        try:
+            jobs = [scheduler.submit('record', [name], guild=guild,
+                                     priority=priority)
+                    for name, guild, priority in [
+                        ('a', '1', 0), ('b', '1', 0), ('c', '1', 0),
+                        ('d', '2', 0), ('e', '2', 5)]]
+            for job in jobs:
+                self.assertEqual(await job.ended, 'done')
+        finally:
+            scheduler.stop()
+        # Priority first, then guilds take turns
+        self.assertEqual(self.calls, ['e', 'a', 'd', 'b', 'c'])
+
+    async def test_outcomes(self):
+        metrics = Metrics()
+        scheduler = self.scheduler(workers=2, metrics=metrics)
+        scheduler.start()
+        try:
+            slow = scheduler.submit('sleep', [10], timeout=0.05)
+            failing = scheduler.submit('fail')
+            self.assertEqual(await slow.ended, 'timeout')
+            self.assertEqual(await failing.ended, 'failed')
+            self.assertEqual(failing.error, 'ValueError: broken')
+            self.assertGreaterEqual(slow.ran, 0.05)
+        finally:
+            scheduler.stop()
+        self.assertEqual(list(scheduler.history), [failing, slow])
+        self.assertEqual(sum(metrics.counters['berlioz_jobs_total'].values()),
+                         2)
+        self.assertIn('berlioz_job_seconds', metrics.histograms)
+
+        with self.assertRaises(KeyError):
+            scheduler.submit('missing')
+        with self.assertRaises(TypeError):
+            scheduler.submit('record', [object()])
+
+    async def test_cancel(self):
+        scheduler = self.scheduler()
+        scheduler.start()
+        try:
+            running = scheduler.submit('sleep', [10], key='sleep')
+            queued = scheduler.submit('record', ['queued'])
+            await asyncio.sleep(0.01)
+            self.assertIs(scheduler.find('sleep'), running)
+            self.assertEqual(running.state, 'running')
+            self.assertIs(scheduler.cancel(queued.id), queued)
+            self.assertIs(scheduler.cancel(running.id), running)
+            self.assertEqual(await running.ended, 'cancelled')
+            self.assertEqual(await queued.ended, 'cancelled')
+            self.assertIsNone(scheduler.find('sleep'))
+            self.assertIsNone(scheduler.cancel(running.id))
+            self.assertEqual(scheduler.live(), [])
+
+            # A job replaces the live one of its key
+            first = scheduler.submit('sleep', [10], key='sleep')
+            second = scheduler.submit('record', ['second'], key='sleep')
+            self.assertEqual(await first.ended, 'cancelled')
+            self.assertEqual(await second.ended, 'done')
+        finally:
+            scheduler.stop()
+        self.assertEqual(self.calls, ['second'])
+
+    async def test_persistence(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jobs.db')
+            scheduler = self.scheduler(JobStore(path), workers=0)
+            scheduler.start()
+            scheduler.submit('record', ['a'], guild='1', priority=2, key='a')
+            done = scheduler.submit('record', ['b'])
+            scheduler.cancel(done.id)
+            scheduler.stop()
+
+            # Restarted, the queued job runs
+            scheduler = self.scheduler(JobStore(path))
+            scheduler.start()
+            try:
+                job = scheduler.find('a')
+                self.assertEqual((job.id, job.guild, job.priority),
+                                 (1, '1', 2))
+                self.assertEqual(await job.ended, 'done')
+                # Ids go on after the stored ones
+                job = scheduler.submit('record', ['c'])
+                self.assertEqual(job.id, 2)
+                self.assertEqual(await job.ended, 'done')
+            finally:
+                scheduler.stop()
+            self.assertEqual(self.calls, ['a', 'c'])
+            store = JobStore(path)
+            self.assertEqual(store.load(), [])
+            store.close()
+
+    async def test_every(self):
+        scheduler = self.scheduler()
+        scheduler.start()
+        try:
+            scheduler.every(0.01, 'record', ['tick'])
+            await asyncio.sleep(0.1)
+        finally:
+            scheduler.stop()
+        self.assertGreater(len(self.calls), 2)
+        self.assertLessEqual(len(self.calls), 11)
+
+
+class TestJobsClosedLoop(unittest.TestCase):
+    def test_stop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jobs.db')
+            scheduler = Scheduler(JobStore(path))
+
+            async def sleep(seconds):
+                await asyncio.sleep(seconds)
+
+            scheduler.register('sleep', sleep)
+            loop = asyncio.new_event_loop()
+            try:
+                scheduler.start(loop)
+                scheduler.submit('sleep', [60])
+                loop.run_until_complete(asyncio.sleep(0.01))
+            finally:
+                loop.close()
+            # As after bot.run(), the running job staying stored
+            scheduler.stop()
+            store = JobStore(path)
+            self.assertEqual(len(store.load()), 1)
+            store.close()
+
+
+class TestStoreThread(unittest.IsolatedAsyncioTestCase):
+    async def test_order(self):
+        thread = StoreThread('test')
+        done = []
+        for i in range(20):
+            thread.submit(done.append, i)
+        self.assertEqual(await thread.call(len, done), 20)
+        with self.assertLogs('storethread', logging.ERROR):
+            thread.submit(done.pop, 100)
+            thread.stop()
+        self.assertEqual(done, list(range(20)))
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_lazyImport(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'heavymodule.py'), 'w') as out:
+                out.write('value = 42\n')
+            sys.path.insert(0, directory)
+            try:
+                module = lazyImport('heavymodule')
+                self.assertFalse(module.loaded)
+                self.assertNotIn('heavymodule', sys.modules)
+                self.assertEqual(module.value, 42)
+                self.assertTrue(module.loaded)
+                self.assertIs(module.load(), sys.modules['heavymodule'])
+            finally:
+                sys.path.remove(directory)
+                sys.modules.pop('heavymodule', None)
+
+    def test_missing(self):
+        module = lazyImport('no_such_module_here')
+        with self.assertRaises(ImportError):
+            module.anything
+
+    def test_startupImports(self):
+        # Importing the bot modules neither writes files nor starts threads,
+        # and leaves NumPy to the first audio rendering
+        code = ('import os, sys, threading, tcnexts.soundcloud, '
+                'tcnexts.store, tcnexts.ingest, discordbot.utils.jobs, '
+                'discordbot.utils.logpipeline, scaler.render; '
+                'print(os.listdir("."), threading.active_count(), '
+                '"numpy" in sys.modules)')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        environment = dict(os.environ, PYTHONPATH=root)
+        with tempfile.TemporaryDirectory() as directory:
+            output = subprocess.check_output(
+                [sys.executable, '-c', code], cwd=directory, env=environment,
+                universal_newlines=True)
+        self.assertEqual(output.strip(), '[] 1 False')
+
+
+class TestRateLimit(unittest.TestCase):
+    budgets = {'scale': {'user': (1, 2), 'channel': (2, 3)},
+               'collab set': {'channel': (0.5, 1)}}
+
+    def test_tokenBucket(self):
+        bucket = TokenBucket(2, 3, now=0)
+        self.assertEqual([bucket.consume(0) for i in range(4)],
+                         [True, True, True, False])
+        self.assertTrue(bucket.consume(0.5))
+        self.assertFalse(bucket.consume(0.5))
+        self.assertTrue(bucket.isFull(10))
+        self.assertEqual(bucket.tokens, 3)
+
+    def test_user(self):
+        limiter = RateLimiter(self.budgets)
+        allowed = [limiter.allow('scale', 'alice', 'general', now=0)
+                   for i in range(3)]
+        self.assertEqual(allowed, [True, True, False])
+        # Another user still has a budget, and the channel one token left
+        self.assertTrue(limiter.allow('scale', 'bob', 'general', now=0))
+        self.assertFalse(limiter.allow('scale', 'carol', 'general', now=0))
+        self.assertTrue(limiter.allow('scale', 'alice', 'general', now=1))
+
+    def test_denialCostsNothing(self):
+        limiter = RateLimiter(self.budgets)
+        limiter.allow('collab set', 'alice', 'general', now=0)
+        for i in range(10):
+            self.assertFalse(limiter.allow('collab set', 'alice', 'general',
+                                           now=1))
+        self.assertTrue(limiter.allow('collab set', 'alice', 'general', now=2))
+
+    def test_unlimited(self):
+        limiter = RateLimiter(self.budgets)
+        self.assertTrue(all(limiter.allow('collab next', 'alice', 'general',
+                                          now=0) for i in range(100)))
+        self.assertEqual(limiter.buckets, {})
+
+    def test_prune(self):
+        limiter = RateLimiter(self.budgets)
+        limiter.allow('scale', 'alice', 'general', now=0)
+        limiter.allow('scale', 'bob', 'general', now=9)
+        limiter.prune(now=9.5)
+        self.assertEqual(set(limiter.buckets), {('scale', 'user', 'bob')})
+
+
+class TestLoadgen(unittest.IsolatedAsyncioTestCase):
+    def test_parseMix(self):
+        self.assertEqual(parseMix('scale=8, collab next=3,collab set'),
+                         {'scale': 8, 'collab next': 3, 'collab set': 1})
+
+    def test_workload(self):
+        mix = {'scale': 3, 'collab next': 1, 'collab set': 0}
+        messages = list(Workload(mix, 'https://soundcloud.com/s', channels=25,
+                                 users=10).messages(400))
+        again = list(Workload(mix, 'https://soundcloud.com/s', channels=25,
+                              users=10).messages(400))
+        self.assertEqual([m.content for m in messages],
+                         [m.content for m in again])
+        scales = [m for m in messages if m.content.startswith('!scale ')]
+        self.assertTrue(250 < len(scales) < 350)
+        self.assertEqual(len(scales) + sum(m.content == '!collab next'
+                                           for m in messages), 400)
+        self.assertEqual(len({m.channel.server.id for m in messages}), 3)
+        self.assertEqual(len({m.id for m in messages}), 400)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([3], 0.99), 3)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+    async def test_replay(self):
+        handled = []
+
+        async def handler(message):
+            handled.append(message)
+            await asyncio.sleep(0.05)
+            if message == 3:
+                raise ValueError(message)
+
+        latencies, failures, elapsed = await replay(handler, range(20), 200)
+        self.assertEqual(len(handled), 20)
+        self.assertEqual(failures, 1)
+        # Sent over 0.1s without waiting for each other
+        self.assertLess(elapsed, 0.5)
+        self.assertGreaterEqual(latencies[0], 0.04)
+
+    async def test_lagMonitor(self):
+        monitor = LagMonitor(interval=0.01, threshold=0.05)
+        task = asyncio.ensure_future(monitor.run())
+        await asyncio.sleep(0.02)
+        time.sleep(0.1)
+        await asyncio.sleep(0.02)
+        task.cancel()
+        self.assertEqual(monitor.stalls, 1)
+        self.assertGreater(monitor.max_lag, 0.05)
+
+        figures = report([0.001, 0.002, 0.01], 0, 0.5, monitor, errors=2)
+        self.assertEqual(figures['throughput'], 6)
+        self.assertEqual(figures['p99'], 0.01)
+        self.assertIn('3 commands in 0.50s, 6/s', formatReport(figures))
+
+
+class TestShards(unittest.TestCase):
+    def test_shardFor(self):
+        self.assertEqual(shardFor('81384788765712384', 1), 0)
+        self.assertEqual(shardFor(81384788765712384, 4),
+                         (81384788765712384 >> 22) % 4)
+
+    def test_shardOptions(self):
+        self.assertEqual(shardOptions({}), {})
+        self.assertEqual(shardOptions({'BERLIOZ_SHARD_ID': '1',
+                                       'BERLIOZ_SHARD_COUNT': '3'}),
+                         {'shard_id': 1, 'shard_count': 3})
+
+    def test_launcher(self):
+        # Fake workers record the shard they were given, then exit
+        code = ('import os, sys; '
+                'open(os.path.join(sys.argv[1], os.environ["BERLIOZ_SHARD_ID"]'
+                ' + "-" + os.environ["BERLIOZ_SHARD_COUNT"]), "a").write("x")')
+        with tempfile.TemporaryDirectory() as directory:
+            launcher = ShardLauncher(2, [sys.executable, '-c', code, directory])
+            launcher.check(now=0)
+            for worker in launcher.workers:
+                worker.process.wait()
+
+            launcher.check(now=100)
+            launcher.check(now=100.5)
+            self.assertEqual([w.restarts for w in launcher.workers], [0, 0])
+            launcher.check(now=101)
+            self.assertEqual([w.restarts for w in launcher.workers], [1, 1])
+            self.assertEqual([w.backoff for w in launcher.workers], [2, 2])
+            for worker in launcher.workers:
+                worker.process.wait()
+
+            for shard in ('0-2', '1-2'):
+                with open(os.path.join(directory, shard)) as infile:
+                    self.assertEqual(infile.read(), 'xx')
+
+    def test_stop(self):
+        launcher = ShardLauncher(
+            1, [sys.executable, '-c', 'import time; time.sleep(60)'])
+        launcher.check()
+        self.assertTrue(launcher.workers[0].running())
+        launcher.stop()
+        self.assertFalse(launcher.workers[0].running())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,14 @@
+import argparse
+import logging
+import sys
+
+from discordbot.utils.shards import ShardLauncher
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Runs the bot as several processes, one per shard.')
+    parser.add_argument('shards', type=int, help='number of shards')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    ShardLauncher(args.shards, [sys.executable, 'main.py']).run()
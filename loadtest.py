@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+from urllib.parse import (parse_qs, urlsplit)
+
+from discordbot.utils.loadgen import (LagMonitor, Workload, formatReport,
+                                      parseMix, replay, report)
+
+default_mix = 'scale=8,collab next=3,collab set=1'
+
+
+class SetHandler(BaseHTTPRequestHandler):
+    '''Serves sets of server.pages pages of server.tracks tracks'''
+
+    def do_GET(self):
+        page = int(parse_qs(urlsplit(self.path).query).get('page', ['1'])[0])
+        tracks = self.server.tracks
+        articles = ''.join('<article><h2><a href="/loadtest/track-{0}">{0}</a>'
+                           '</h2></article>'.format(i)
+                           for i in range((page - 1) * tracks, page * tracks))
+        if page < self.server.pages:
+            articles += '<a rel="next" href="?page={}">More</a>'.format(page + 1)
+        body = ('<html><body><section class="tracklist">' + articles +
+                '</section></body></html>').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def startSetServer(pages, tracks):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SetHandler)
+    server.block_on_close = False
+    server.pages = pages
+    server.tracks = tracks
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fakeHttp(bot, latency, replies):
+    '''Replaces the Discord HTTP calls of bot by a wait of latency seconds'''
+    async def send_message(destination, content=None, *, tts=False,
+                           embed=None):
+        await asyncio.sleep(latency)
+        replies[destination.id] = replies.get(destination.id, 0) + 1
+
+    async def send_file(destination, fp, *, filename=None, content=None,
+                        tts=False):
+        await asyncio.sleep(latency)
+        replies[destination.id] = replies.get(destination.id, 0) + 1
+
+    bot.send_message = send_message
+    bot.send_file = send_file
+
+
+def run(args):
+    root = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, root)
+    # The bot writes its log, metrics and playlists in the working directory
+    directory = tempfile.TemporaryDirectory()
+    os.chdir(directory.name)
+
+    import main
+    from discordbot.utils.metrics import metrics
+    from discordbot.utils.ratelimit import limiter
+
+    bot = main.bot
+    if not args.rate_limits:
+        limiter.budgets = {}
+    replies = {}
+    fakeHttp(bot, args.http_latency, replies)
+    server = startSetServer(args.pages, args.tracks)
+    # collab set only takes soundcloud.com addresses
+    set_url = 'http://127.0.0.1:{}/soundcloud.com/loadtest/sets/load'.format(
+        server.server_port)
+
+    workload = Workload(parseMix(args.mix), set_url, channels=args.channels,
+                        users=args.users, seed=args.seed)
+    count = int(args.rate * args.duration)
+    monitor = LagMonitor()
+
+    async def session():
+        main.warmScaleCache()
+        watcher = asyncio.ensure_future(monitor.run())
+        try:
+            return await replay(main.on_message, workload.messages(count),
+                                args.rate)
+        finally:
+            watcher.cancel()
+
+    main.startBackground()
+    bot.load_extension('tcnexts.collab')
+    try:
+        latencies, failures, elapsed = bot.loop.run_until_complete(session())
+    finally:
+        bot.unload_extension('tcnexts.collab')
+        bot.loop.run_until_complete(asyncio.sleep(0))
+        main.stopBackground()
+        server.shutdown()
+        os.chdir(root)
+        directory.cleanup()
+
+    errors = sum(metrics.counters.get('berlioz_command_errors_total',
+                                      {}).values())
+    figures = report(latencies, failures, elapsed, monitor, errors)
+    figures['replies'] = sum(replies.values())
+    return figures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replays commands against the bot with a fake Discord '
+        'gateway and HTTP layer, and a local SoundCloud.')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='commands sent per second')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of commands to send')
+    parser.add_argument('--mix', default=default_mix,
+                        help='command weights, default "%(default)s"')
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--http-latency', type=float, default=0.05,
+                        help='seconds each fake Discord request takes')
+    parser.add_argument('--pages', type=int, default=3,
+                        help='pages of the served set')
+    parser.add_argument('--tracks', type=int, default=50,
+                        help='tracks per page of the served set')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the command rate limits')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print the figures as JSON')
+    parser.add_argument('--max-p99', type=float,
+                        help='fail if the p99 latency exceeds that many ms')
+    args = parser.parse_args()
+
+    figures = run(args)
+    print(json.dumps(figures) if args.json else formatReport(figures))
+    if args.max_p99 is not None and figures['p99'] * 1e3 > args.max_p99:
+        print('p99 latency above {}ms'.format(args.max_p99), file=sys.stderr)
+        sys.exit(1)
@@ -3,27 +3,138 @@ import datetime
 from discord.ext import commands
 import random
 import logging
-from scaler.scaler import (Key, Modes)
+import importlib.util
+import io
+import time
+from scaler.scaler import (Key, Modes, analyzeProgression, keyGraph,
+                           keysWithChords, keysWithNotes, note_index, parseKey,
+                           scale_types)
+from discordbot.utils.metrics import metrics
+from discordbot.utils.logpipeline import LogPipeline
+from discordbot.utils.jobs import (JobStore, Scheduler)
+from discordbot.utils.shards import shardOptions
+from discordbot.utils import checks
+from scaler.render import (RenderCache, default_tempo)
 
 description = '''Bot to manage The Composers Network.'''
-bot = commands.Bot(command_prefix='!', description=description)
+# Empty unless started by launcher.py
+shard = shardOptions()
+bot = commands.Bot(command_prefix='!', description=description, **shard)
 
-# Setting up logger
-discord_logger = logging.getLogger('discord')
-discord_logger.setLevel(logging.CRITICAL)
+# Files written by each process are suffixed with its shard
+suffix = '-shard{}'.format(shard['shard_id']) if shard else ''
+
+# Setting up logger, records are written by a background thread started
+# with startBackground()
+log_path = 'berlioz' + suffix + '.log'
+log_levels = {
+    '': logging.INFO,
+    'discord': logging.CRITICAL,
+}
+# Loggers of hot paths keep one record in n below warnings, as {name: n}
+log_sampling = {}
+log_pipeline = None
 log = logging.getLogger()
-log.setLevel(logging.INFO)
-handler = logging.FileHandler(filename='berlioz.log', encoding='utf-8',
-        mode='w')
-log.addHandler(handler)
 
 extensions = [
     'tcnexts.collab'
 ]
 
+# Metrics are written to metrics_path and served on metrics_port if not None
+metrics_path = 'metrics' + suffix + '.prom'
+metrics_port = None
+
+# Rendered !scale answers are cached and optionally built once connected,
+# then every warmup_interval seconds for the renderings evicted meanwhile
+prewarm_scales = True
+warmup_interval = 3600
+
+# Background jobs, their queue surviving restarts once startBackground()
+# opened it
+jobs_path = 'tmp/jobs' + suffix + '.db'
+scheduler = Scheduler(metrics=metrics)
+metrics.register(scheduler.collect)
+# Reachable from the extensions
+bot.scheduler = scheduler
+
+mode_names = {
+    'M': Modes.Major,
+    'nm': Modes.NaturalMinor,
+    'hm': Modes.HarmonicMinor,
+    'mm': Modes.MelodicMinor
+}
+
+scale_cache = {}
+
+# Renderings of !scale --play, as WAV when NumPy is installed
+render_cache = RenderCache()
+play_format = 'wav' if importlib.util.find_spec('numpy') else 'mid'
+
+def collectRenderMetrics(metrics):
+    for name, value in render_cache.stats().items():
+        metrics.set('berlioz_render_cache_' + name, value)
+
+metrics.register(collectRenderMetrics)
+
 def wrapCode(text: str):
     return '```' + text + '```'
 
+def renderScale(key: int, mode):
+    '''Returns the Discord-ready chord table of a key, rendering it once'''
+    try:
+        return scale_cache[(key, mode)]
+    except KeyError:
+        pass
+
+    text = wrapCode(Key(key, mode).ppChordScale())
+    scale_cache[(key, mode)] = text
+    return text
+
+def renderScaleType(tonic: str, name: str):
+    '''Returns the chord table of any scale type on a tonic, rendering it once'''
+    try:
+        return scale_cache[(tonic, name)]
+    except KeyError:
+        pass
+
+    text = wrapCode(scale_types[name].ppScale(tonic))
+    scale_cache[(tonic, name)] = text
+    return text
+
+def warmScaleCache():
+    '''Renders the chord tables of every key and mode'''
+    for mode in mode_names.values():
+        for key in range(-7, 8):
+            renderScale(key, mode)
+
+async def warmup():
+    '''Job building the !scale answers and the key graph'''
+    warmScaleCache()
+    keyGraph()
+    await render_cache.prerender([Key(key, mode) for mode in mode_names.values()
+                                  for key in range(-7, 8)],
+                                 file_format=play_format)
+
+scheduler.register('warmup', warmup)
+
+def startBackground():
+    '''
+    Starts the log writer and the job queue, left out of the import so that
+    importing main neither writes files nor starts threads
+    '''
+    global log_pipeline
+    log_pipeline = LogPipeline(log_path, levels=log_levels,
+                               sampling=log_sampling)
+    log_pipeline.start()
+    scheduler.store = JobStore(jobs_path)
+    scheduler.start(bot.loop)
+
+def stopBackground():
+    '''Stops what startBackground() started, writing the pending records'''
+    scheduler.stop()
+    if log_pipeline is not None:
+        log_pipeline.stop()
+
 @bot.event
 async def on_ready():
     print('Logged in as')
@@ -32,25 +143,225 @@ async def on_ready():
     print('------')
     if not hasattr(bot, 'uptime'):
         bot.uptime = datetime.datetime.utcnow()
+        # Done once connected so it does not delay the login
+        if prewarm_scales:
+            scheduler.every(warmup_interval, 'warmup')
+        bot.loop.create_task(metrics.watchLoop())
+        bot.loop.create_task(metrics.export(metrics_path))
+        if metrics_port is not None:
+            await metrics.serve(port=metrics_port)
+
+def commandName(message):
+    '''Returns the qualified name of the command invoked by message'''
+    if not message.content.startswith(bot.command_prefix):
+        return None
+
+    words = message.content[len(bot.command_prefix):].split()
+    names = []
+    group = bot
+    for word in words:
+        command = group.commands.get(word) if hasattr(group, 'commands') else None
+        if command is None:
+            break
+        names.append(command.name)
+        group = command
+
+    return ' '.join(names) or None
+
+@bot.event
+async def on_message(message):
+    start = time.perf_counter()
+    await bot.process_commands(message)
+    name = commandName(message)
+    if name is not None:
+        metrics.observe('berlioz_command_seconds',
+                        time.perf_counter() - start, command=name)
+        metrics.incr('berlioz_commands_total', command=name)
+
+@bot.event
+async def on_command_error(error, ctx):
+    # Rate limited commands are dropped without an answer
+    if isinstance(error, checks.RateLimited):
+        return
+    # Any message starting with the prefix, not an error of the bot
+    if isinstance(error, commands.CommandNotFound):
+        log.debug('%s', error)
+        return
+    if isinstance(error, commands.CheckFailure):
+        await bot.send_message(ctx.message.channel,
+                               'You are not allowed to use this command.')
+    name = ctx.command.qualified_name if ctx.command else 'unknown'
+    metrics.incr('berlioz_command_errors_total', command=name,
+                 error=type(error).__name__)
+    # Exceptions raised by a command come wrapped in CommandInvokeError
+    original = getattr(error, 'original', error)
+    log.error('Command %s failed: %s', name, original,
+              exc_info=(type(original), original, original.__traceback__))
+
+def parseSignature(text: str):
+    '''Returns the key signature written in text, None if there is none'''
+    try:
+        key = int(text)
+    except ValueError:
+        return None
+    return key if -7 <= key <= 7 else None
 
 @bot.command()
-async def scale(key: int, mode: str):
-    m = ''
-    if mode == 'M':
-        m = Modes.Major
-    elif mode == 'nm':
-        m = Modes.NaturalMinor
-    elif mode == 'hm':
-        m = Modes.HarmonicMinor
-    elif mode == 'mm':
-        m = Modes.MelodicMinor
+@checks.rate_limited()
+async def scale(key: str, mode: str, *options: str):
+    # Signatures go with the four classic modes, tonics with any scale type
+    if mode in mode_names and parseSignature(key) is not None:
+        text = renderScale(int(key), mode_names[mode])
+        if '--play' not in options:
+            await bot.say(text)
+            return
+        k = Key(int(key), mode_names[mode])
+        data = await bot.loop.run_in_executor(None, render_cache.get, k,
+                                              default_tempo, 'close',
+                                              play_format)
+        await bot.upload(io.BytesIO(data), content=text,
+                         filename='{}{}.{}'.format(key, mode, play_format))
+    elif mode in scale_types and key in note_index:
+        if '--play' in options:
+            await bot.say('Only signatures are played: '
+                          '`!scale <signature> M|nm|hm|mm --play`')
+            return
+        await bot.say(renderScaleType(key, mode))
+    else:
+        await bot.say('\n'.join([
+            '`!scale <signature> M|nm|hm|mm [--play]`',
+            '`!scale <tonic> <scale>`, not played, with scale one of : ' +
+            ', '.join(scale_types)]))
+
+# Longest progression !progression builds, and how many it lists
+max_progression_length = 8
+progression_samples = 3
+
+def keyName(key):
+    return key.getName() + ('m' if key.isMinor() else '') + ' ' + key.mode.name
+
+@bot.group(invoke_without_command=True)
+@checks.rate_limited()
+async def progression(key: int, mode: str, length: int=4):
+    if mode not in mode_names or not -7 <= key <= 7:
+        await bot.say('`!progression <signature> M|nm|hm|mm [length]`, '
+                      'signatures from -7 to 7')
+        return
+    m = mode_names[mode]
+    if not 1 <= length <= max_progression_length:
+        await bot.say('Progressions have 1 to {} chords.'.format(
+            max_progression_length))
+        return
 
     k = Key(key, m)
+    try:
+        lines = [' - '.join(k.sampleProgression(length))
+                 for i in range(progression_samples)]
+    except ValueError:
+        await bot.say('No progression of {} chords.'.format(length))
+        return
+    await bot.say(wrapCode(keyName(k) + '\n' + '\n'.join(lines)))
+
+@progression.command()
+@checks.rate_limited()
+async def analyze(*chords: str):
+    try:
+        matches = analyzeProgression(chords)
+    except ValueError as e:
+        await bot.say(str(e))
+        return
+    if not matches:
+        await bot.say('No key holds these chords.')
+        return
+
+    lines = ['{:12s} {}'.format(keyName(k), ' '.join(label or '?'
+                                                     for label in labels))
+             for k, labels in matches]
+    await bot.say(wrapCode('\n'.join(lines)))
+
+def listKeys(keys):
+    if not keys:
+        return 'No key holds all of them.'
+    return wrapCode('\n'.join(keyName(k) for k in keys))
+
+@bot.group(invoke_without_command=True)
+@checks.rate_limited()
+async def whichkey(*chords: str):
+    try:
+        keys = keysWithChords(chords)
+    except ValueError as e:
+        await bot.say(str(e))
+        return
+    await bot.say(listKeys(keys))
+
+@whichkey.command()
+@checks.rate_limited()
+async def notes(*names: str):
+    unknown = [name for name in names if name not in note_index]
+    if unknown:
+        await bot.say('Unknown notes: ' + ' '.join(unknown))
+        return
+    await bot.say(listKeys(keysWithNotes(names)))
+
+@bot.command()
+@checks.rate_limited()
+async def modulate(start: str, target: str):
+    try:
+        k, t = parseKey(start), parseKey(target)
+    except ValueError as e:
+        await bot.say(str(e) + '\n`!modulate <key> <key>`, keys such as '
+                      'C, F#m, Ahm (harmonic) or Cmm (melodic minor)')
+        return
+
+    graph = keyGraph()
+    lines = ['{} to {}: {} steps'.format(keyName(k), keyName(t),
+                                          graph.distance(k, t))]
+    previous = k
+    for relation, step in graph.path(k, t):
+        lines.append('{:12s} {:22s} {} common tones'.format(
+            relation, keyName(step), graph.commonTones(previous, step)))
+        previous = step
+    await bot.say(wrapCode('\n'.join(lines)))
+
+def serverId(ctx):
+    server = ctx.message.server
+    return server.id if server else None
+
+def listJobs(jobs):
+    lines = ['{:>5} {:16s} {:9s} {:>9s} {:>9s}'.format(
+        'id', 'kind', 'state', 'waited', 'ran')]
+    for job in jobs:
+        lines.append('{:5d} {:16s} {:9s} {:8.2f}s {:8.2f}s'.format(
+            job.id, job.kind, job.state, job.waited, job.ran))
+    return wrapCode('\n'.join(lines))
+
+@bot.group(pass_context=True, invoke_without_command=True)
+@checks.rate_limited()
+async def jobs(ctx):
+    guild = serverId(ctx)
+    live = sorted(scheduler.live(guild), key=lambda job: job.id)
+    done = [job for job in scheduler.history if job.guild == guild]
+    if not live and not done:
+        await bot.say('No jobs.')
+        return
+    await bot.say(listJobs(live + done))
 
-    await bot.say(wrapCode(k.ppChordScale()))
+@jobs.command(pass_context=True)
+@checks.rate_limited()
+@commands.has_permissions(manage_messages=True)
+async def cancel(ctx, job_id: int):
+    # Jobs of other servers are left alone
+    job = scheduler.jobs.get(job_id)
+    if job is None or job.guild != serverId(ctx):
+        await bot.say('No job {} queued or running here.'.format(job_id))
+        return
+    # Ingests are not resumed once cancelled
+    await scheduler.revoke(job_id)
+    await bot.say('Job {} cancelled.'.format(job_id))
 
 
 if __name__ == '__main__':
+    startBackground()
     with open('token', 'r') as f:
         for extension in extensions:
             try:
@@ -62,3 +373,7 @@ if __name__ == '__main__':
         token = f.readline().strip()
         bot.run(token)
 
+    # Lets the extensions write their pending state
+    for extension in extensions:
+        bot.unload_extension(extension)
+    stopBackground()
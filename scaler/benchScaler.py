@@ -0,0 +1,214 @@
+import random
+import timeit
+import unittest
+
+from scaler import (Key, Modes, Enharmonic, note_index, scalesFor,
+                    analyzeProgression, triadIndex, keyReference,
+                    pitchIndex, keysWithNotes, keysWithChords, keyGraph,
+                    modulationPath)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Size of the simulated burst of !scale commands
+burst = 1000
+
+# Slowest accepted time per call, in seconds. Cached lookups get a few
+# microseconds, what builds or searches keys gets up to a few milliseconds.
+limits = {
+    'Key.build': 500e-6,
+    'Key': 5e-6,
+    'ppChordScale': 250e-6,
+    'getCircleProgression': 20e-6,
+    'toIndex': 2e-6,
+    'toNote': 2e-6,
+    'scalesFor': 5e-3,
+    'sampleProgression': 100e-6,
+    'analyzeProgression': 500e-6,
+    'keysWithNotes': 50e-6,
+    'keysWithChords': 50e-6,
+    'modulationPath': 20e-6,
+}
+
+
+def measure(function, number, repeat=5):
+    '''Returns the best time per call of function over repeat runs'''
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def commandBurst(size):
+    '''Random (signature, mode) pairs, as a busy channel would send them'''
+    rng = random.Random(0)
+    modes = list(Modes)
+    return [(rng.randint(-7, 7), rng.choice(modes)) for i in range(size)]
+
+
+class Benchmark(unittest.TestCase):
+    def check(self, name, per_call):
+        print('\n  {:22s}: {:10.3f} us per call (limit {:.0f} us)'.format(
+            name, per_call * 1e6, limits[name] * 1e6), end='')
+        self.assertLess(per_call, limits[name], name + ' got slower')
+
+
+class BenchKey(Benchmark):
+    def setUp(self):
+        Key.buildTable()
+        self.commands = commandBurst(burst)
+
+    def test_build(self):
+        def built():
+            for signature, mode in self.commands:
+                Key.build(signature, mode)
+
+        self.check('Key.build', measure(built, 1) / burst)
+
+    def test_shared(self):
+        def shared():
+            for signature, mode in self.commands:
+                Key(signature, mode)
+
+        self.check('Key', measure(shared, 1) / burst)
+
+    def test_ppChordScale(self):
+        keys = [Key(signature, mode) for signature, mode in self.commands]
+
+        def render():
+            for k in keys:
+                k.ppChordScale()
+
+        self.check('ppChordScale', measure(render, 1) / burst)
+
+    def test_getCircleProgression(self):
+        keys = [Key(signature, mode) for signature, mode in self.commands]
+
+        def progressions():
+            for k in keys:
+                k.getCircleProgression()
+
+        self.check('getCircleProgression', measure(progressions, 1) / burst)
+
+
+class BenchProgression(Benchmark):
+    def setUp(self):
+        triadIndex()
+        rng = random.Random(0)
+        self.keys = [Key(signature, mode)
+                     for signature, mode in commandBurst(burst)]
+        # Progressions typed by users, taken from random keys
+        self.sequences = []
+        for k in self.keys[:100]:
+            self.sequences.append(rng.sample(keyReference(k)['chords'], 4))
+
+    def test_sampleProgression(self):
+        def samples():
+            for k in self.keys:
+                k.sampleProgression(8)
+
+        self.check('sampleProgression', measure(samples, 1) / burst)
+
+    def test_analyzeProgression(self):
+        def analyses():
+            for sequence in self.sequences:
+                analyzeProgression(sequence)
+
+        self.check('analyzeProgression',
+                   measure(analyses, 1) / len(self.sequences))
+
+
+class BenchPitchIndex(Benchmark):
+    def setUp(self):
+        pitchIndex()
+        rng = random.Random(0)
+        names = list(note_index)
+        self.notes = [rng.sample(names, rng.randint(1, 6))
+                      for i in range(burst)]
+        self.chords = [rng.sample(keyReference(Key(signature, mode))['chords'],
+                                  rng.randint(1, 4))
+                       for signature, mode in commandBurst(burst)]
+
+    def test_keysWithNotes(self):
+        keys = [Key(signature, mode) for mode in Modes
+                for signature in range(-7, 8)]
+
+        def scan():
+            for notes in self.notes[:100]:
+                [k for k in keys if all(n in k.harmonic_scale or
+                                        Enharmonic.toIndex(n) in
+                                        k.enharmonic_scale for n in notes)]
+
+        def queries():
+            for notes in self.notes:
+                keysWithNotes(notes)
+
+        scan_time = measure(scan, 1) / 100
+        query_time = measure(queries, 1) / burst
+        print('\n  {:22s}: {:10.1f}x faster than scanning keys'.format(
+            'keysWithNotes', scan_time / query_time), end='')
+        self.check('keysWithNotes', query_time)
+
+    def test_keysWithChords(self):
+        def queries():
+            for chords in self.chords:
+                keysWithChords(chords)
+
+        self.check('keysWithChords', measure(queries, 1) / burst)
+
+
+class BenchKeyGraph(Benchmark):
+    def test_modulationPath(self):
+        keyGraph()
+        commands = commandBurst(2 * burst)
+        pairs = [(Key(*commands[i]), Key(*commands[i + 1]))
+                 for i in range(0, len(commands), 2)]
+
+        def queries():
+            for key, target in pairs:
+                modulationPath(key, target)
+
+        self.check('modulationPath', measure(queries, 1) / burst)
+
+
+class BenchEnharmonic(Benchmark):
+    def setUp(self):
+        self.names = list(note_index) * 100
+        self.pairs = [note_index[n] for n in self.names]
+
+    def test_toIndex(self):
+        def lookups():
+            for name in self.names:
+                Enharmonic.toIndex(name)
+
+        self.check('toIndex', measure(lookups, 1) / len(self.names))
+
+    def test_toNote(self):
+        def lookups():
+            for enh_index, order in self.pairs:
+                Enharmonic.toNote(enh_index, order)
+
+        self.check('toNote', measure(lookups, 1) / len(self.pairs))
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class BenchBatch(Benchmark):
+    def test_scalesFor(self):
+        signatures = list(range(-7, 8))
+
+        def loop():
+            for mode in Modes:
+                for signature in signatures:
+                    Key.build(signature, mode)
+
+        def batch():
+            scalesFor(signatures, Modes)
+
+        loop_time = measure(loop, 10)
+        batch_time = measure(batch, 10)
+        print('\n  {:22s}: {:10.1f}x faster than Key.build'.format(
+            'scalesFor', loop_time / batch_time), end='')
+        self.check('scalesFor', batch_time)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import io
+import math
+import struct
+import threading
+import wave
+from collections import OrderedDict
+
+from discordbot.utils.lazy import lazyImport
+
+# Only imported once audio is rendered, MIDI renderings doing without it
+np = lazyImport('numpy')
+
+ticks_per_beat = 480
+default_tempo = 120
+
+# MIDI note of C4, the octave the tonic is played in
+middle_c = 60
+velocity = 80
+
+# Lengths in beats of each part of a rendering
+scale_note = 0.5
+chord_note = 1
+
+# Degrees of the circle progression, as in Key.getCircleProgression
+circle_degrees = [(3 * i) % 7 for i in range(7)]
+
+# Moves the (root, third, fifth) MIDI notes of a close triad
+voicings = {
+    'close': lambda r, t, f: (r, t, f),
+    'open': lambda r, t, f: (r - 12, f, t + 12),
+    'first': lambda r, t, f: (t, f, r + 12),
+    'second': lambda r, t, f: (f - 12, r, t),
+}
+
+sample_rate = 22050
+render_entries = 256
+
+
+def ladder(key):
+    '''Returns the MIDI notes of two ascending octaves of the scale of key'''
+    pitches = list(key.enharmonic_scale) * 2 + [key.enharmonic_scale[0]]
+    notes = [middle_c + pitches[0]]
+    for pitch in pitches[1:]:
+        notes.append(notes[-1] + (pitch - notes[-1]) % 12)
+    return notes
+
+
+def keyNotes(key, voicing='close'):
+    '''
+    Lists the notes of the scale, triads and circle progression of a key
+
+    :param key: any Key
+    :param voicing: one of voicings
+    :return: (start, length, MIDI note) triples, in beats
+    :rtype: list
+    '''
+    try:
+        voice = voicings[voicing]
+    except KeyError:
+        raise ValueError('unknown voicing ' + voicing)
+
+    steps = ladder(key)
+    degrees = len(key.enharmonic_scale)
+    notes = []
+    start = 0
+    for note in steps[:degrees + 1]:
+        notes.append((start, scale_note, note))
+        start += scale_note
+    start += chord_note
+
+    for degree in list(range(degrees)) + circle_degrees:
+        for note in voice(steps[degree], steps[degree + 2], steps[degree + 4]):
+            notes.append((start, chord_note, note))
+        start += chord_note
+    return notes
+
+
+def varLength(value):
+    '''Encodes a MIDI variable-length quantity'''
+    data = [value & 0x7f]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def renderMidi(notes, tempo=default_tempo, out=None):
+    '''
+    Writes notes as a single track Standard MIDI file
+
+    :param notes: (start, length, MIDI note) triples, in beats
+    :param tempo: beats per minute
+    :param out: binary file object, a new BytesIO if None
+    :return: the MIDI file
+    :rtype: bytes
+    '''
+    events = []
+    for start, length, note in notes:
+        events.append((round(start * ticks_per_beat), 1,
+                       bytes((0x90, note, velocity))))
+        # Note offs sort first so that repeated notes restart
+        events.append((round((start + length) * ticks_per_beat), 0,
+                       bytes((0x80, note, 0))))
+    events.sort()
+
+    track = bytearray(b'\x00\xff\x51\x03')
+    track += struct.pack('>I', round(60e6 / tempo))[1:]
+    previous = 0
+    for tick, _, message in events:
+        track += varLength(tick - previous)
+        track += message
+        previous = tick
+    track += b'\x00\xff\x2f\x00'
+
+    if out is None:
+        out = io.BytesIO()
+    out.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, ticks_per_beat))
+    out.write(b'MTrk' + struct.pack('>I', len(track)))
+    out.write(track)
+    return out.getvalue() if isinstance(out, io.BytesIO) else None
+
+
+def renderWav(notes, tempo=default_tempo, rate=sample_rate, out=None):
+    '''
+    Synthesizes notes as a mono 16-bit WAV file, decaying sines
+
+    :param notes: (start, length, MIDI note) triples, in beats
+    :param tempo: beats per minute
+    :param rate: samples per second
+    :param out: binary file object, a new BytesIO if None
+    :return: the WAV file
+    :rtype: bytes
+    '''
+    beat = 60 / tempo
+    end = max(start + length for start, length, _ in notes)
+    signal = np.zeros(int(math.ceil(end * beat * rate)) + 1)
+    for start, length, note in notes:
+        first = int(start * beat * rate)
+        t = np.arange(int(length * beat * rate)) / rate
+        frequency = 440 * 2 ** ((note - 69) / 12)
+        signal[first:first + len(t)] += (np.sin(2 * np.pi * frequency * t) *
+                                         np.exp(-3 * t))
+
+    peak = np.abs(signal).max() or 1
+    samples = (signal / peak * 0.8 * 32767).astype('<i2')
+
+    if out is None:
+        out = io.BytesIO()
+    with wave.open(out, 'wb') as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(rate)
+        writer.writeframes(samples.tobytes())
+    return out.getvalue() if isinstance(out, io.BytesIO) else None
+
+
+renderers = {
+    'mid': renderMidi,
+    'wav': renderWav,
+}
+
+
+class RenderCache():
+    '''
+    Renderings of keys, stored once per distinct content
+
+    Requests are keyed by (signature, mode, tempo, voicing, format) and point
+    to the digest of their file, so that enharmonic keys such as C# and Db
+    share one rendering.
+    '''
+
+    def __init__(self, size=render_entries):
+        self.size = size
+        self.index = OrderedDict()
+        self.blobs = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, tempo=default_tempo, voicing='close', file_format='mid'):
+        '''Returns the rendering of key, rendering it on a miss'''
+        request = (key.signature, key.mode, tempo, voicing, file_format)
+        with self.lock:
+            digest = self.index.get(request)
+            if digest is not None:
+                self.index.move_to_end(request)
+                self.hits += 1
+                return self.blobs[digest]
+
+        # Rendered unlocked, two threads may render the same key once each
+        data = renderers[file_format](keyNotes(key, voicing), tempo)
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.misses += 1
+            self.blobs.setdefault(digest, data)
+            self.index[request] = digest
+            while len(self.index) > self.size:
+                _, dropped = self.index.popitem(last=False)
+                if dropped not in self.index.values():
+                    del self.blobs[dropped]
+            return self.blobs[digest]
+
+    async def prerender(self, keys, tempo=default_tempo, voicing='close',
+                        file_format='mid'):
+        '''Renders keys one by one in the default executor'''
+        loop = asyncio.get_event_loop()
+        for key in keys:
+            await loop.run_in_executor(None, self.get, key, tempo, voicing,
+                                       file_format)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.index), 'blobs': len(self.blobs)}
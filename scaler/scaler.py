@@ -1,5 +1,6 @@
 from enum import Enum
-import logging
+import functools
+import random
 
 
 class Modes(Enum):
@@ -24,31 +25,156 @@ class Chords(Enum):
     Augmented = 4
 
 
-logging.basicConfig(level=logging.DEBUG)
-
 # 0 = C
 
 
-scale_division = {}
-scale_division[Modes.Major] = [2, 2, 1, 2, 2, 2, 1]
-scale_division[Modes.NaturalMinor] = [2, 1, 2, 2, 1, 2, 2]
-scale_division[Modes.HarmonicMinor] = [2, 1, 2, 2, 1, 3, 1]
-scale_division[Modes.MelodicMinor] = [2, 1, 2, 2, 2, 2, 1]
-
-scaleChords = {}
-scaleChords[Modes.Major] = [Chords.Major, Chords.Minor, Chords.Minor,
-                            Chords.Major, Chords.Major, Chords.Minor,
-                            Chords.Diminished]
-scaleChords[Modes.NaturalMinor] = [Chords.Minor, Chords.Diminished,
-                                   Chords.Major, Chords.Minor, Chords.Minor,
-                                   Chords.Major, Chords.Major]
-scaleChords[Modes.HarmonicMinor] = [Chords.Minor, Chords.Diminished,
-                                    Chords.Augmented, Chords.Minor,
-                                    Chords.Major, Chords.Major,
-                                    Chords.Diminished]
-scaleChords[Modes.MelodicMinor] = [Chords.Minor, Chords.Diminished, 
-                                   Chords.Major, Chords.Minor, Chords.Minor, 
-                                   Chords.Major, Chords.Major]
+def rotate(steps, degree):
+    '''Returns the steps of the mode starting on degree of a scale'''
+    return tuple(steps[degree:]) + tuple(steps[:degree])
+
+
+major_steps = (2, 2, 1, 2, 2, 2, 1)
+
+# Semitones between the successive degrees of each scale, from the tonic
+scale_patterns = {
+    'major': major_steps,
+    'natural-minor': rotate(major_steps, 5),
+    'harmonic-minor': (2, 1, 2, 2, 1, 3, 1),
+    'melodic-minor': (2, 1, 2, 2, 2, 2, 1),
+    'ionian': major_steps,
+    'dorian': rotate(major_steps, 1),
+    'phrygian': rotate(major_steps, 2),
+    'lydian': rotate(major_steps, 3),
+    'mixolydian': rotate(major_steps, 4),
+    'aeolian': rotate(major_steps, 5),
+    'locrian': rotate(major_steps, 6),
+    'major-pentatonic': (2, 2, 3, 2, 3),
+    'minor-pentatonic': (3, 2, 2, 3, 2),
+    'whole-tone': (2, 2, 2, 2, 2, 2),
+    'blues': (3, 2, 1, 1, 3, 2),
+    'augmented': (3, 1, 3, 1, 3, 1),
+    'octatonic-hw': (1, 2) * 4,
+    'octatonic-wh': (2, 1) * 4,
+}
+
+# Chords by quality, in order of preference when several fit a degree
+triad_intervals = {'M': (0, 4, 7), 'm': (0, 3, 7), 'd': (0, 3, 6),
+                   'A': (0, 4, 8), 'sus4': (0, 5, 7), 'sus2': (0, 2, 7)}
+
+seventh_intervals = {'maj7': (0, 4, 7, 11), '7': (0, 4, 7, 10),
+                     'm7': (0, 3, 7, 10), 'mMaj7': (0, 3, 7, 11),
+                     'm7b5': (0, 3, 6, 10), 'dim7': (0, 3, 6, 9),
+                     'augMaj7': (0, 4, 8, 11), 'aug7': (0, 4, 8, 10)}
+
+chord_suffixes = {'M': '', 'm': 'm', 'd': 'dim', 'A': 'aug', 'sus4': 'sus4',
+                  'sus2': 'sus2'}
+
+
+class ScaleType():
+    '''
+    A scale pattern and the chords on each of its degrees
+
+    Chords only depend on the pattern, so they are computed once for all
+    tonics. A degree gets the chord stacking every other degree of the scale
+    when it is a known one, else the first chord of the tables that fits in
+    the scale, or None.
+    '''
+    __slots__ = ('name', 'steps', 'offsets', 'triads', 'sevenths')
+
+    flat_names = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A',
+                  'Bb', 'B']
+    sharp_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A',
+                   'A#', 'B']
+
+    def __init__(self, name, steps):
+        if sum(steps) != 12:
+            raise ValueError('steps of {} do not add up to 12'.format(name))
+        self.name = name
+        self.steps = tuple(steps)
+        offsets = [0]
+        for step in steps[:-1]:
+            offsets.append(offsets[-1] + step)
+        self.offsets = tuple(offsets)
+        self.triads = tuple(self.chordOn(d, triad_intervals)
+                            for d in range(len(offsets)))
+        self.sevenths = tuple(self.chordOn(d, seventh_intervals)
+                              for d in range(len(offsets)))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return 'ScaleType({!r}, {})'.format(self.name, self.steps)
+
+    def chordOn(self, degree, qualities):
+        '''Returns the quality of the chord on degree, None if none fits'''
+        size = len(next(iter(qualities.values())))
+        count = len(self.offsets)
+        root = self.offsets[degree]
+        stacked = tuple((self.offsets[(degree + 2 * i) % count] - root) % 12
+                        for i in range(size))
+        for quality, intervals in qualities.items():
+            if intervals == stacked:
+                return quality
+
+        pitches = set(self.offsets)
+        for quality, intervals in qualities.items():
+            if all((root + i) % 12 in pitches for i in intervals):
+                return quality
+        return None
+
+    def notes(self, tonic_name):
+        '''Spells the scale, one letter per degree for seven-note scales'''
+        tonic = Enharmonic.toIndex(tonic_name)
+        pitches = [(tonic + offset) % 12 for offset in self.offsets]
+        if len(pitches) == 7:
+            order = Enharmonic.toOrder(tonic_name)
+            names = [spelling_table.get((pitch, (order + i) % 7))
+                     for i, pitch in enumerate(pitches)]
+            if None not in names:
+                return names
+
+        flats = 'b' in tonic_name[1:] or tonic_name == 'F'
+        names = ScaleType.flat_names if flats else ScaleType.sharp_names
+        return [tonic_name] + [names[pitch] for pitch in pitches[1:]]
+
+    def chords(self, tonic_name):
+        '''Returns the (note, triad, seventh chord) names of each degree'''
+        return [(note,
+                 note + chord_suffixes[triad] if triad else '-',
+                 note + seventh if seventh else '-')
+                for note, triad, seventh in zip(self.notes(tonic_name),
+                                                self.triads, self.sevenths)]
+
+    def ppScale(self, tonic_name):
+        '''Pretty-prints the notes, triads and seventh chords of the scale'''
+        rows = list(zip(*self.chords(tonic_name)))
+        width = max(len(name) for row in rows for name in row)
+        lines = [tonic_name + ' ' + self.name]
+        for row in rows:
+            lines.append('| ' + ' | '.join(name.ljust(width) for name in row)
+                         + ' |')
+        return '\n'.join(lines)
+
+
+scale_types = {name: ScaleType(name, steps)
+               for name, steps in scale_patterns.items()}
+
+mode_scales = {
+    Modes.Major: scale_types['major'],
+    Modes.NaturalMinor: scale_types['natural-minor'],
+    Modes.HarmonicMinor: scale_types['harmonic-minor'],
+    Modes.MelodicMinor: scale_types['melodic-minor'],
+}
+
+quality_chords = {'d': Chords.Diminished, 'm': Chords.Minor,
+                  'M': Chords.Major, 'A': Chords.Augmented}
+
+scale_division = {mode: list(scale.steps)
+                  for mode, scale in mode_scales.items()}
+
+scaleChords = {mode: [quality_chords[q] for q in scale.triads]
+               for mode, scale in mode_scales.items()}
 
 class Key():
     keys = ['C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#', 
@@ -56,9 +182,28 @@ class Key():
     keysm = ['A', 'E', 'B', 'F#', 'C#', 'G#', 'D#', 'A#', 
              'Ab', 'Eb', 'Bb', 'F', 'C', 'G', 'D']
 
-    def __init__(self, key_signature, mode):
+    __slots__ = ('signature', 'mode', 'enharmonic_scale', 'harmonic_scale',
+                 'triad_scale', 'degree_scale', '_frozen')
+
+    # Shared, immutable keys indexed by (signature, mode)
+    table = {}
+
+    def __new__(cls, key_signature, mode):
+        '''Returns the shared key for the signature, building it on first use'''
+        try:
+            return cls.table[(key_signature, mode)]
+        except KeyError:
+            pass
+
+        key = cls.build(key_signature, mode)
+        cls.table[(key_signature, mode)] = key
+        return key
+
+    @classmethod
+    def build(cls, key_signature, mode):
         '''Key constructor. Checks the signature and generate scales'''
         Key.keyCheck(key_signature)
+        self = object.__new__(cls)
         self.signature = key_signature
         self.mode = mode
 
@@ -68,19 +213,45 @@ class Key():
         self.buildTriadScale()
         self.buildDegreeScale()
 
+        self.freeze()
+        return self
+
+    @staticmethod
+    def buildTable():
+        '''Builds every key of the table ahead of time'''
+        for mode in Modes:
+            for signature in range(-7, 8):
+                Key(signature, mode)
+
+    def freeze(self):
+        '''Turns the scales into tuples and forbids further changes'''
+        self.enharmonic_scale = tuple(self.enharmonic_scale)
+        self.harmonic_scale = tuple(self.harmonic_scale)
+        self.triad_scale = tuple(tuple(t) for t in self.triad_scale)
+        self.degree_scale = tuple(self.degree_scale)
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('Key objects are immutable')
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError('Key objects are immutable')
+
+    def __repr__(self):
+        return 'Key({}, {})'.format(self.signature, self.mode)
+
     def buildEnharmonicScale(self):
         enharmonic_root = Enharmonic.toIndex(self.getName())
-        self.enharmonic_scale = [enharmonic_root]
-        offset = 0
-        for i in range(0, 6):
-            offset += scale_division[self.mode][i]
-            self.enharmonic_scale.append((enharmonic_root + offset) % 12)
+        self.enharmonic_scale = [(enharmonic_root + offset) % 12
+                                 for offset in mode_scales[self.mode].offsets]
 
     def buildHarmonicScale(self):
         tonic_order = Enharmonic.toOrder(self.getName())
         self.harmonic_scale = []
         self.triad_scale = []
-        for i in range(0, 7):
+        for i in range(len(self.enharmonic_scale)):
             self.harmonic_scale.append(
                 Enharmonic.toNote(self.enharmonic_scale[i], (i +
                                   tonic_order) % 7))
@@ -141,38 +312,24 @@ class Key():
 
     def ppChordScale(self):
         '''Pretty-prints the chord scale'''
-        r = ''
-        r += '-'*43
-        r += '\n'
+        rule = '-'*43
+        lines = [rule]
         # Scale
         for i in range(2, -1, -1):
-            r += '| {:3s} | {:3s} | {:3s} | {:3s} | {:3s} | {:3s} | {:3s} |\n'.format(
-                self.triad_scale[0][i],
-                self.triad_scale[1][i],
-                self.triad_scale[2][i],
-                self.triad_scale[3][i],
-                self.triad_scale[4][i],
-                self.triad_scale[5][i],
-                self.triad_scale[6][i])
-
-
-        r += '\n'
-        r += '-'*43
-        # Chords
-        
+            lines.append('| ' + ' | '.join('{:3s}'.format(triad[i])
+                                           for triad in self.triad_scale) + ' |')
 
-        r += '\n'
-        r += '|'
-        for i in range(0, 7):
-            r += ' {:3s}{}|'.format(self.triad_scale[i][0],
-                                    self.degree_scale[i][0])
-        r += '\n'
-        r += '|'
-        for i in range(0, 7):
-            r += ' {:4s}|'.format(self.degree_scale[i][1])
-        r += '\n'
+        lines.append('')
+        lines.append(rule)
+        # Chords
+        lines.append('|' + ''.join(' {:3s}{}|'.format(triad[0], degree[0])
+                                   for triad, degree in zip(self.triad_scale,
+                                                            self.degree_scale)))
+        lines.append('|' + ''.join(' {:4s}|'.format(degree[1])
+                                   for degree in self.degree_scale))
+        lines.append('')
 
-        return r
+        return '\n'.join(lines)
 
     def getCircleProgression(self):
         progression = []
@@ -183,6 +340,21 @@ class Key():
 
         return progression
 
+    def getProgressions(self, length=4):
+        '''
+        Returns every progression of length chords leaving and ending on I
+
+        :raises ValueError: for a length above max_listed_length, see
+                            sampleProgression
+        '''
+        return [[self.degree_scale[d][1] for d in path]
+                for path in degreePaths(0, length)]
+
+    def sampleProgression(self, length=4, rng=random):
+        '''Picks one of the progressions of getProgressions uniformly'''
+        return [self.degree_scale[d][1]
+                for d in sampleDegreePath(0, length, rng=rng)]
+
     def isMinor(self):
         '''Returns True if key is minor'''
         return Modes.isMinor(self.mode)
@@ -196,8 +368,8 @@ class Key():
 
     def degreeOf(self, note_name):
         '''Returns the degree of a note'''
-        if note_name in harmonic_scale:
-            return harmonic_scale.index(note_name) + 1
+        if note_name in self.harmonic_scale:
+            return self.harmonic_scale.index(note_name) + 1
 
     def buildTriad(self, degree):
         '''Builds a triad for degree in the key'''
@@ -240,14 +412,14 @@ class Key():
         '''
         if number > 7 or number < 0:
             raise Exception("invalid parameter")
-        return keys[number]
+        return Key.keys[number]
 
     @staticmethod
     def keyFlats(number):
         '''Returns the key which has number of flats'''
         if number > 7 or number < 0:
             raise Exception("invalid parameter")
-        return keys[-number]
+        return Key.keys[-number]
 
 
 class Enharmonic():
@@ -274,61 +446,673 @@ class Enharmonic():
     @staticmethod
     def toIndex(note_name):
         '''Gets the enharmonic number for note_name'''
-        if note_name in Enharmonic.sharp:
-            return Enharmonic.sharp.index(note_name)
-        elif note_name in Enharmonic.flat:
-            return Enharmonic.flat.index(note_name)
-        elif note_name in Enharmonic.dflat:
-            return Enharmonic.dflat.index(note_name)
-        elif note_name in Enharmonic.dsharp:
-            return Enharmonic.dsharp.index(note_name)
-        else:
+        try:
+            return note_index[note_name][0]
+        except KeyError:
             raise Exception("no such note" + str(note_name))
 
+    @staticmethod
+    def toIndices(note_names):
+        '''Gets the enharmonic numbers for a sequence of note names'''
+        return [Enharmonic.toIndex(n) for n in note_names]
+
     @staticmethod
     def toNote(enh_index, targetOrder):
-        if Enharmonic.toOrder(Enharmonic.flat[enh_index]) == targetOrder:
-            return Enharmonic.flat[enh_index]
-        elif Enharmonic.toOrder(Enharmonic.sharp[enh_index]) == targetOrder:
-            return Enharmonic.sharp[enh_index]
-        elif Enharmonic.toOrder(Enharmonic.dflat[enh_index]) == targetOrder:
-                return Enharmonic.dflat[enh_index]
-        elif Enharmonic.toOrder(Enharmonic.dsharp[enh_index]) == targetOrder:
-            return Enharmonic.dsharp[enh_index]
-        else:
+        '''Spells enh_index with the letter of order targetOrder'''
+        try:
+            return spelling_table[(enh_index, targetOrder)]
+        except KeyError:
             print("(enhDeg: " + str(enh_index) + " target: " + str(targetOrder) + 
                   ")")
-            print("Candidates were : " + flatEnharmonics[enh_index] + " and " + 
-                  sharpEnharmonics[enh_index])
-            print("minor " + dflatEnharmonics[enh_index])
+            print("Candidates were : " + Enharmonic.flat[enh_index] + " and " +
+                  Enharmonic.sharp[enh_index])
             raise Exception("degree lookup failed")
 
-
     @staticmethod
     def toOrder(note_name):
-        letter = note_name[0]
-        return Enharmonic.order_set.index(letter)
+        '''Gets the order of the letter of note_name (C = 0)'''
+        try:
+            return note_index[note_name][1]
+        except KeyError:
+            return Enharmonic.order_set.index(note_name[0])
+
+    intervals = [(0, 'P1'),
+                 (1, 'm2'),
+                 (2, 'M2'),
+                 (3, 'm3'),
+                 (4, 'M3'),
+                 (5, 'P4'),
+                 (6, 'A4'), 
+                 (7, 'P5'), 
+                 (8, 'm6'),
+                 (9, 'M6'),
+                 (10, 'm7'), 
+                 (11, 'M7'),
+                 (12, 'P8')]
 
     @staticmethod
     def interval(enh1, enh2):
-        intervals = [(0, 'P1'),
-                     (1, 'm2'),
-                     (2, 'M2'),
-                     (3, 'm3'),
-                     (4, 'M3'),
-                     (5, 'P4'),
-                     (6, 'A4'), 
-                     (7, 'P5'), 
-                     (8, 'm6'),
-                     (9, 'M6'),
-                     (10, 'm7'), 
-                     (11, 'M7'),
-                     (12, 'P8')]
         delta = (enh2 - enh1) % 12
-        return intervals[delta]
+        return Enharmonic.intervals[delta]
+
+
+def buildNoteIndex():
+    '''
+    Builds the note name lookup tables
+
+    :return: note name -> (enharmonic index, letter order), and
+             (enharmonic index, letter order) -> note name
+    :rtype: (dict, dict)
+    '''
+    names = {}
+    spellings = {}
+    # Lookup order decides the spelling when several names would match
+    for enharmonics in (Enharmonic.flat, Enharmonic.sharp, Enharmonic.dflat,
+                        Enharmonic.dsharp):
+        for enh_index, name in enumerate(enharmonics):
+            order = Enharmonic.order_set.index(name[0])
+            names.setdefault(name, (enh_index, order))
+            spellings.setdefault((enh_index, order), name)
+
+    return names, spellings
+
+
+note_index, spelling_table = buildNoteIndex()
+
+
+class ScaleBatch():
+    '''Scales and triads of many keys at once, stored as integer arrays'''
+    __slots__ = ('signatures', 'modes', 'enharmonic', 'orders', 'triads',
+                 'qualities')
+
+    degrees = ['i', 'ii', 'iii', 'iv', 'v', 'vi', 'vii']
+
+    def __init__(self, signatures, modes, enharmonic, orders, triads,
+                 qualities):
+        self.signatures = signatures
+        self.modes = modes
+        self.enharmonic = enharmonic
+        self.orders = orders
+        self.triads = triads
+        self.qualities = qualities
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def key(self, i):
+        '''Returns the (signature, mode) pair of row i'''
+        return int(self.signatures[i]), self.modes[i]
+
+    def harmonicScale(self, i):
+        '''Spells the scale of row i with note names'''
+        return [spelling_table[(int(e), int(o))]
+                for e, o in zip(self.enharmonic[i], self.orders[i])]
+
+    def chordScale(self, i):
+        '''Returns the chord type of each degree of row i'''
+        return [Chords(int(q)) for q in self.qualities[i]]
+
+    def degreeLabels(self, i):
+        '''Returns the roman numeral of each degree of row i'''
+        labels = []
+        for degree, q in zip(ScaleBatch.degrees, self.qualities[i]):
+            chord = Chords(int(q))
+            if chord == Chords.Diminished:
+                labels.append(degree + u'\xb0')
+            elif chord == Chords.Minor:
+                labels.append(degree)
+            elif chord == Chords.Major:
+                labels.append(degree.upper())
+            else:
+                labels.append(degree.upper() + '+')
+        return labels
+
+
+def tonicIndex(key_signature, minor):
+    '''
+    Returns the enharmonic index of the tonic of a key, minor telling if its
+    mode is a minor one. Works on NumPy arrays of signatures as well.
+    '''
+    # Tonics move by a fifth (7 semitones) per sharp, the relative minor
+    # sitting a major sixth (9 semitones) above
+    return (7 * key_signature + 9 * minor) % 12
+
+
+def scalesFor(signatures=range(-7, 8), modes=Modes):
+    '''
+    Computes the scales of every (signature, mode) combination in one go
+
+    :param signatures: key signatures, negative for flats
+    :param modes: modes to combine with each signature
+    :return: one row per combination, signatures varying fastest
+    :rtype: ScaleBatch
+    '''
+    # NumPy is only needed by the batch computations
+    import numpy as np
+
+    modes = list(modes)
+    signatures = np.asarray(list(signatures), dtype=np.int16)
+    if np.any(signatures < -7) or np.any(signatures > 7):
+        raise Exception("not a key")
+
+    sig = np.tile(signatures, len(modes))
+    mode_index = np.repeat(np.arange(len(modes)), len(signatures))
+    minor = np.array([Modes.isMinor(m) for m in modes])[mode_index]
+
+    # Tonic letters move by 4 per sharp, the relative minor sitting 5 above
+    tonic = tonicIndex(sig, minor)
+    tonic_order = (4 * sig + 5 * minor) % 7
+
+    divisions = np.array([scale_division[m] for m in modes], dtype=np.int16)
+    offsets = np.zeros_like(divisions)
+    offsets[:, 1:] = np.cumsum(divisions[:, :-1], axis=1)
+
+    enharmonic = (tonic[:, None] + offsets[mode_index]) % 12
+    orders = (tonic_order[:, None] + np.arange(7)) % 7
+
+    triad_degrees = (np.arange(7)[:, None] + np.array([0, 2, 4])) % 7
+    triads = enharmonic[:, triad_degrees]
+
+    # Stacked thirds of 3 or 4 semitones map onto the Chords values
+    low = (triads[..., 1] - triads[..., 0]) % 12
+    high = (triads[..., 2] - triads[..., 1]) % 12
+    qualities = (low - 3) * 2 + (high - 3) + 1
+
+    return ScaleBatch(sig.astype(np.int8),
+                      [modes[i] for i in mode_index],
+                      enharmonic.astype(np.int8),
+                      orders.astype(np.int8),
+                      triads.astype(np.int8),
+                      qualities.astype(np.int8))
+
+reference_fields = ['signature', 'mode', 'key', 'scale', 'chords', 'triads',
+                    'degrees', 'circle']
+
+
+def keyReference(key):
+    '''Returns the reference entry of a key as a dict of plain values'''
+    return {
+        'signature': key.signature,
+        'mode': key.mode.name,
+        'key': key.getName() + ('m' if key.isMinor() else ''),
+        'scale': list(key.harmonic_scale),
+        'chords': [triad[0] + chord_suffixes[degree[0]]
+                   for triad, degree in zip(key.triad_scale,
+                                            key.degree_scale)],
+        'triads': [list(triad) for triad in key.triad_scale],
+        'degrees': [degree[1] for degree in key.degree_scale],
+        'circle': key.getCircleProgression(),
+    }
+
+
+def referenceEntries(signatures=range(-7, 8), modes=Modes):
+    '''Yields the reference entry of every key, mode by mode'''
+    for mode in modes:
+        for signature in signatures:
+            yield keyReference(Key(signature, mode))
+
+
+def writeJson(entries, out):
+    '''Writes entries as a JSON array, one entry per line'''
+    import json
+
+    out.write('[')
+    separator = '\n'
+    for entry in entries:
+        out.write(separator)
+        out.write(json.dumps(entry, ensure_ascii=False))
+        separator = ',\n'
+    out.write('\n]\n')
+
+
+def writeCsv(entries, out):
+    '''Writes entries as CSV, lists joined with spaces and triads with dashes'''
+    import csv
+
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(reference_fields)
+    for entry in entries:
+        writer.writerow([entry['signature'], entry['mode'], entry['key'],
+                         ' '.join(entry['scale']),
+                         ' '.join(entry['chords']),
+                         ' '.join('-'.join(t) for t in entry['triads']),
+                         ' '.join(entry['degrees']),
+                         ' '.join(entry['circle'])])
+
+
+def writeMarkdown(entries, out):
+    '''Writes entries as one Markdown section and table per key'''
+    for entry in entries:
+        out.write('## {} {} ({:+d})\n\n'.format(entry['key'], entry['mode'],
+                                               entry['signature']))
+        out.write('| Degree | ' + ' | '.join(entry['degrees']) + ' |\n')
+        out.write('|---' * 8 + '|\n')
+        out.write('| Chord | ' + ' | '.join(entry['chords']) + ' |\n')
+        out.write('| Notes | ' + ' | '.join(' '.join(t)
+                                            for t in entry['triads']) + ' |\n')
+        out.write('\nCircle: ' + ' - '.join(entry['circle']) + '\n\n')
+
+
+export_formats = {
+    'json': writeJson,
+    'csv': writeCsv,
+    'md': writeMarkdown,
+}
+
+
+def exportReference(out, export_format='json', signatures=range(-7, 8),
+                    modes=Modes):
+    '''
+    Streams the reference tables of every key to a file
+
+    :param out: text file object to write to
+    :param export_format: one of export_formats
+    '''
+    try:
+        writer = export_formats[export_format]
+    except KeyError:
+        raise ValueError('unknown export format ' + export_format)
+    writer(referenceEntries(signatures, modes), out)
+
+
+# Degrees each degree usually moves to, 0 being the tonic. The tonic goes
+# anywhere, the others move towards it along the circle of fifths.
+degree_transitions = (
+    (1, 2, 3, 4, 5, 6),
+    (4, 6),
+    (3, 5),
+    (0, 1, 4, 6),
+    (0, 5),
+    (1, 3),
+    (0,),
+)
+
+
+# Longest degree sequences listed by degreePaths, about 3000 of them. Their
+# number about triples with each chord, longer ones are drawn with
+# sampleDegreePath instead.
+max_listed_length = 10
+
+
+@functools.lru_cache(maxsize=None)
+def degreePaths(start, length, end=0):
+    '''
+    Returns every degree sequence of length chords going from start to end.
+    The cache holds at most one entry per start, end and length up to
+    max_listed_length.
+
+    :raises ValueError: for a length above max_listed_length
+    '''
+    if length > max_listed_length:
+        raise ValueError('progressions of more than {} chords are only '
+                         'sampled'.format(max_listed_length))
+    if length <= 1:
+        return ((start,),) if length == 1 and start == end else ()
+    return tuple((start,) + path for following in degree_transitions[start]
+                 for path in degreePaths(following, length - 1, end))
+
+
+@functools.lru_cache(maxsize=None)
+def degreePathCount(start, length, end=0):
+    '''Returns len(degreePaths(start, length, end)) without listing them'''
+    if length <= 1:
+        return 1 if length == 1 and start == end else 0
+    return sum(degreePathCount(following, length - 1, end)
+               for following in degree_transitions[start])
+
+
+def sampleDegreePath(start, length, end=0, rng=random):
+    '''Draws one of degreePaths(start, length, end), all equally likely'''
+    if degreePathCount(start, length, end) == 0:
+        raise ValueError('no progression of {} chords'.format(length))
+
+    path = [start]
+    for remaining in range(length - 1, 0, -1):
+        # Each move is weighted by the number of paths it leads to
+        choices = degree_transitions[path[-1]]
+        weights = [degreePathCount(c, remaining, end) for c in choices]
+        path.append(rng.choices(choices, weights)[0])
+    return path
+
+
+chord_qualities = {'': 'M', 'M': 'M', 'maj': 'M', 'm': 'm', 'min': 'm',
+                   'dim': 'd', 'o': 'd', u'\xb0': 'd', 'aug': 'A', '+': 'A',
+                   'sus4': 'sus4', 'sus2': 'sus2'}
+
+
+def parseChord(chord_name):
+    '''Splits a chord name such as F#m or Bbdim into (root, quality)'''
+    for size in (3, 2, 1):
+        root = chord_name[:size]
+        quality = chord_qualities.get(chord_name[size:])
+        if root in note_index and quality is not None:
+            return root, quality
+    raise ValueError('not a chord: ' + chord_name)
+
+
+def triadPitchClasses(root, quality):
+    '''Returns the enharmonic indices of a triad as a frozenset'''
+    tonic = Enharmonic.toIndex(root)
+    return frozenset((tonic + i) % 12 for i in triad_intervals[quality])
+
+
+@functools.lru_cache(maxsize=None)
+def triadIndex():
+    '''Maps the pitch classes of every triad to its (key, degree) pairs'''
+    index = {}
+    for mode in Modes:
+        for signature in range(-7, 8):
+            key = Key(signature, mode)
+            for degree, triad in enumerate(key.triad_scale):
+                pitches = frozenset(Enharmonic.toIndices(triad))
+                index.setdefault(pitches, []).append((key, degree))
+    return index
+
+
+def analyzeProgression(chord_names, count=3):
+    '''
+    Finds the keys a chord sequence most likely belongs to
+
+    Keys are ranked by the number of chords they hold, then by whether the
+    sequence starts or ends on their tonic, then by how many roots they spell
+    the same way, then by their number of accidentals.
+
+    :param chord_names: chords such as ['C', 'Am', 'F', 'G']
+    :param count: number of keys to return
+    :return: (key, degree labels) pairs, best first, with None as the label
+             of the chords outside the key
+    :rtype: list
+    '''
+    chords = [parseChord(name) for name in chord_names]
+    index = triadIndex()
+    last = len(chords) - 1
+    scores = {}
+    for position, (root, quality) in enumerate(chords):
+        for key, degree in index.get(triadPitchClasses(root, quality), ()):
+            score = scores.get(key)
+            if score is None:
+                score = scores[key] = [0, 0, 0, [None] * len(chords)]
+            score[0] += 1
+            if degree == 0 and position in (0, last):
+                score[1] += 1
+            if root in key.harmonic_scale:
+                score[2] += 1
+            score[3][position] = key.degree_scale[degree][1]
+
+    ranked = sorted(scores.items(),
+                    key=lambda item: (-item[1][0], -item[1][1], -item[1][2],
+                                      abs(item[0].signature),
+                                      item[0].mode.value))
+    return [(key, score[3]) for key, score in ranked[:count]]
+
+
+def pitchMask(enh_indices):
+    '''Returns the 12-bit set of enharmonic indices, bit 0 being C'''
+    mask = 0
+    for enh_index in enh_indices:
+        mask |= 1 << enh_index
+    return mask
+
+
+class PitchIndex():
+    '''
+    Reverse index from pitch-class sets to the keys holding them
+
+    Each key gets a bit, so that the keys holding a note or a triad are one
+    integer and a query is the bitwise and of those integers.
+    '''
+    __slots__ = ('keys', 'scales', 'triads', 'note_keys', 'chord_keys')
+
+    def __init__(self, signatures=range(-7, 8), modes=Modes):
+        self.keys = [(signature, mode) for mode in modes
+                     for signature in signatures]
+        # Scale mask and triad masks of each key
+        self.scales = []
+        self.triads = []
+        # Pitch class or triad mask -> keys holding it
+        self.note_keys = [0] * 12
+        self.chord_keys = {}
+
+        for bit, (signature, mode) in enumerate(self.keys):
+            tonic = tonicIndex(signature, Modes.isMinor(mode))
+            scale = [tonic]
+            for step in scale_division[mode][:-1]:
+                scale.append((scale[-1] + step) % 12)
+
+            triads = tuple(pitchMask((scale[d], scale[(d + 2) % 7],
+                                      scale[(d + 4) % 7])) for d in range(7))
+            self.scales.append(pitchMask(scale))
+            self.triads.append(triads)
+            for enh_index in scale:
+                self.note_keys[enh_index] |= 1 << bit
+            for triad in triads:
+                self.chord_keys[triad] = self.chord_keys.get(triad, 0) | 1 << bit
+
+    def withNotes(self, mask):
+        '''Returns the key bits of the scales holding every note of mask'''
+        found = (1 << len(self.keys)) - 1
+        enh_index = 0
+        while mask:
+            if mask & 1:
+                found &= self.note_keys[enh_index]
+            mask >>= 1
+            enh_index += 1
+        return found
+
+    def withChords(self, triads):
+        '''Returns the key bits of the scales holding every triad mask'''
+        found = (1 << len(self.keys)) - 1
+        for triad in triads:
+            found &= self.chord_keys.get(triad, 0)
+        return found
+
+    def toKeys(self, found):
+        '''Turns key bits into the shared Key objects'''
+        keys = []
+        bit = 0
+        while found:
+            if found & 1:
+                keys.append(Key(*self.keys[bit]))
+            found >>= 1
+            bit += 1
+        return keys
+
+
+@functools.lru_cache(maxsize=None)
+def pitchIndex():
+    '''Returns the PitchIndex of every key, built on first use'''
+    return PitchIndex()
+
+
+def keysWithNotes(note_names):
+    '''Returns the keys whose scale holds all the notes'''
+    index = pitchIndex()
+    return index.toKeys(index.withNotes(
+        pitchMask(Enharmonic.toIndices(note_names))))
+
+
+def keysWithChords(chord_names):
+    '''Returns the keys holding all the chords, such as ['Dm', 'G']'''
+    index = pitchIndex()
+    triads = [pitchMask(triadPitchClasses(*parseChord(name)))
+              for name in chord_names]
+    return index.toKeys(index.withChords(triads))
+
+
+def wrapSignature(key_signature):
+    '''Brings a signature past 7 sharps or flats back to its enharmonic key'''
+    if key_signature > 7:
+        return key_signature - 12
+    if key_signature < -7:
+        return key_signature + 12
+    return key_signature
+
+
+def keyFor(enh_index, mode, tonic_name=None):
+    '''
+    Returns the key of mode on the tonic enh_index
+
+    Among enharmonic keys, the one spelling its tonic tonic_name wins, then
+    the one with the fewest accidentals, then the flat one.
+    '''
+    signatures = [signature for signature in range(-7, 8)
+                  if tonicIndex(signature, Modes.isMinor(mode)) == enh_index]
+    keys = [Key(signature, mode) for signature in signatures]
+    return min(keys, key=lambda k: (k.getName() != tonic_name,
+                                    abs(k.signature), k.signature))
+
+
+key_suffixes = {'': Modes.Major, 'm': Modes.NaturalMinor,
+                'hm': Modes.HarmonicMinor, 'mm': Modes.MelodicMinor}
+
+
+def parseKey(key_name):
+    '''
+    Returns the key named as a tonic with a mode suffix, such as 'Eb', 'F#m',
+    'Ahm' or 'Cmm' ('' major, 'm' natural, 'hm' harmonic, 'mm' melodic minor)
+
+    :raises ValueError: for an unknown tonic or suffix
+    '''
+    for length in (2, 1, 0):
+        split = len(key_name) - length
+        tonic, suffix = key_name[:split], key_name[split:]
+        if suffix in key_suffixes and tonic in note_index:
+            return keyFor(Enharmonic.toIndex(tonic), key_suffixes[suffix],
+                          tonic)
+    raise ValueError('Unknown key: ' + key_name)
+
+
+def transposeKey(key, semitones):
+    '''Returns the key of the same mode semitones higher'''
+    return keyFor((tonicIndex(key.signature, key.isMinor()) + semitones) % 12,
+                  key.mode)
+
+
+# Relations between keys, in the order modulation paths prefer them
+key_relations = ('relative', 'parallel', 'dominant', 'subdominant',
+                 'enharmonic')
+
+
+def relatedSignatures(key_signature, mode):
+    '''Yields (relation, signature, mode) for every key next to a key'''
+    minors = [m for m in Modes if Modes.isMinor(m)]
+    if Modes.isMinor(mode):
+        yield 'relative', key_signature, Modes.Major
+        # Parallel keys past seven sharps or flats are spelled enharmonically,
+        # as fifths are
+        yield 'parallel', wrapSignature(key_signature + 3), Modes.Major
+        for other in minors:
+            if other != mode:
+                yield 'parallel', key_signature, other
+    else:
+        for other in minors:
+            yield 'relative', key_signature, other
+        for other in minors:
+            yield 'parallel', wrapSignature(key_signature - 3), other
+    yield 'dominant', wrapSignature(key_signature + 1), mode
+    yield 'subdominant', wrapSignature(key_signature - 1), mode
+    if abs(key_signature) >= 5:
+        yield 'enharmonic', (key_signature - 12 if key_signature > 0
+                             else key_signature + 12), mode
+
+
+class KeyGraph():
+    '''
+    Relations between every key, and the shortest modulation between any two
+
+    Keys are the nodes of PitchIndex, in the same order. Common tones are
+    counted on its scale masks and every shortest path is found up front, so
+    queries are table lookups.
+    '''
+    __slots__ = ('keys', 'nodes', 'edges', 'common', 'paths')
+
+    def __init__(self, index):
+        self.keys = index.keys
+        self.nodes = {k: node for node, k in enumerate(self.keys)}
+        self.common = [[bin(a & b).count('1') for b in index.scales]
+                       for a in index.scales]
+        # Neighbours as (relation, node), smoothest modulations first
+        self.edges = []
+        for node, k in enumerate(self.keys):
+            edges = [(relation, self.nodes[(signature, mode)])
+                     for relation, signature, mode in relatedSignatures(*k)]
+            edges.sort(key=lambda edge: (-self.common[node][edge[1]],
+                                         key_relations.index(edge[0])))
+            self.edges.append(edges)
+        # paths[a][b] is the list of (relation, node) steps from a to b
+        self.paths = [self.shortestPaths(node)
+                      for node in range(len(self.keys))]
+
+    def shortestPaths(self, start):
+        '''Breadth first search of the paths from start to every node'''
+        paths = {start: []}
+        frontier = [start]
+        while frontier:
+            following = []
+            for node in frontier:
+                for relation, target in self.edges[node]:
+                    if target not in paths:
+                        paths[target] = paths[node] + [(relation, target)]
+                        following.append(target)
+            frontier = following
+        return paths
+
+    def node(self, key):
+        return self.nodes[(key.signature, key.mode)]
+
+    def related(self, key):
+        '''Returns the (relation, Key) pairs of the keys next to key'''
+        return [(relation, Key(*self.keys[target]))
+                for relation, target in self.edges[self.node(key)]]
+
+    def commonTones(self, key, other):
+        '''Returns the number of pitch classes the scales of two keys share'''
+        return self.common[self.node(key)][self.node(other)]
+
+    def path(self, key, target):
+        '''Returns the (relation, Key) steps of a shortest modulation'''
+        return [(relation, Key(*self.keys[node]))
+                for relation, node in
+                self.paths[self.node(key)][self.node(target)]]
+
+    def distance(self, key, target):
+        '''Returns the number of steps of a shortest modulation'''
+        return len(self.paths[self.node(key)][self.node(target)])
+
+
+@functools.lru_cache(maxsize=None)
+def keyGraph():
+    '''Returns the KeyGraph of every key, built on first use'''
+    return KeyGraph(pitchIndex())
+
+
+def relatedKeys(key):
+    '''Returns the keys next to key as {relation: [Key]}'''
+    related = {}
+    for relation, other in keyGraph().related(key):
+        related.setdefault(relation, []).append(other)
+    return related
+
+
+def modulationPath(key, target):
+    '''Returns the (relation, Key) steps of a shortest modulation'''
+    return keyGraph().path(key, target)
+
 
 if __name__ == '__main__':
-    #for i in range(-7, 8):
-    for m in Modes:
-        k = Key(-2, m)
-        print(k.ppChordScale())
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description='Exports the chord tables of every key and mode.')
+    parser.add_argument('output', nargs='?',
+                        help='file to write, standard output if missing')
+    parser.add_argument('-f', '--format', choices=sorted(export_formats),
+                        default='md', help='output format')
+    args = parser.parse_args()
+
+    if args.output is None:
+        exportReference(sys.stdout, args.format)
+    else:
+        with open(args.output, 'w', encoding='utf-8', newline='') as out:
+            exportReference(out, args.format)
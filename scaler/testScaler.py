@@ -1,133 +1,586 @@
+import asyncio
+import csv
+import io
+import json
+import random
 import unittest
 
-from scaler import (keyBreakdown, scaleMode, Modes, keySharps, keyFlats, enhIndex,
-                    flatEnharmonic, sharpEnharmonic, noteOrder)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scaler import (Modes, Key, Enharmonic,
+                    note_index, spelling_table, Chords, scalesFor,
+                    keyReference, exportReference, degreePaths,
+                    degreePathCount, degree_transitions, parseChord,
+                    analyzeProgression, pitchMask, pitchIndex,
+                    keysWithNotes, keysWithChords, ScaleType, scale_types,
+                    scaleChords, scale_division, rotate, parseKey,
+                    transposeKey, wrapSignature, keyGraph, relatedKeys,
+                    modulationPath)
+from render import (RenderCache, keyNotes, ladder, renderMidi, renderWav,
+                    varLength)
 
 class TestKeyBreakdown(unittest.TestCase):
     def test_keyBreakdown(self):
-        self.assertEqual(keyBreakdown(-7), ('Cb', 0, 7))
-        self.assertEqual(keyBreakdown(-6), ('Gb', 0, 6))
-        self.assertEqual(keyBreakdown(-5), ('Db', 0, 5))
-        self.assertEqual(keyBreakdown(-4), ('Ab', 0, 4))
-        self.assertEqual(keyBreakdown(-3), ('Eb', 0, 3))
-        self.assertEqual(keyBreakdown(-2), ('Bb', 0, 2))
-        self.assertEqual(keyBreakdown(-1), ('F', 0, 1))
-        self.assertEqual(keyBreakdown(0), ('C', 0, 0))
-        self.assertEqual(keyBreakdown(1), ('G', 1, 0))
-        self.assertEqual(keyBreakdown(2), ('D', 2, 0))
-        self.assertEqual(keyBreakdown(3), ('A', 3, 0))
-        self.assertEqual(keyBreakdown(4), ('E', 4, 0))
-        self.assertEqual(keyBreakdown(5), ('B', 5, 0))
-        self.assertEqual(keyBreakdown(6), ('F#', 6, 0))
-        self.assertEqual(keyBreakdown(7), ('C#', 7, 0))
+        expected = [('Cb', 0, 7), ('Gb', 0, 6), ('Db', 0, 5), ('Ab', 0, 4),
+                    ('Eb', 0, 3), ('Bb', 0, 2), ('F', 0, 1), ('C', 0, 0),
+                    ('G', 1, 0), ('D', 2, 0), ('A', 3, 0), ('E', 4, 0),
+                    ('B', 5, 0), ('F#', 6, 0), ('C#', 7, 0)]
+        for signature, breakdown in zip(range(-7, 8), expected):
+            key = Key(signature, Modes.Major)
+            self.assertEqual((key.getName(), Key.sharps(signature),
+                              Key.flats(signature)), breakdown)
 
     def test_scaleMode(self):
         # Major scale
-        self.assertEqual(scaleMode(-7, Modes.Major), 
+        self.assertEqual(list(Key(-7, Modes.Major).harmonic_scale), 
                          ['Cb', 'Db', 'Eb', 'Fb', 'Gb', 'Ab', 'Bb'])
-        self.assertEqual(scaleMode(-6, Modes.Major), 
+        self.assertEqual(list(Key(-6, Modes.Major).harmonic_scale), 
                          ['Gb', 'Ab', 'Bb', 'Cb', 'Db', 'Eb', 'F'])
-        self.assertEqual(scaleMode(-5, Modes.Major), 
+        self.assertEqual(list(Key(-5, Modes.Major).harmonic_scale), 
                          ['Db', 'Eb', 'F', 'Gb', 'Ab', 'Bb', 'C'])
-        self.assertEqual(scaleMode(-4, Modes.Major), 
+        self.assertEqual(list(Key(-4, Modes.Major).harmonic_scale), 
                          ['Ab', 'Bb', 'C', 'Db', 'Eb', 'F', 'G'])
-        self.assertEqual(scaleMode(-3, Modes.Major), 
+        self.assertEqual(list(Key(-3, Modes.Major).harmonic_scale), 
                          ['Eb', 'F', 'G', 'Ab', 'Bb', 'C', 'D'])
-        self.assertEqual(scaleMode(-2, Modes.Major), 
+        self.assertEqual(list(Key(-2, Modes.Major).harmonic_scale), 
                          ['Bb', 'C', 'D', 'Eb', 'F', 'G', 'A'])
-        self.assertEqual(scaleMode(-1, Modes.Major), 
+        self.assertEqual(list(Key(-1, Modes.Major).harmonic_scale), 
                          ['F', 'G', 'A', 'Bb', 'C', 'D', 'E'])
-        self.assertEqual(scaleMode(0, Modes.Major), 
+        self.assertEqual(list(Key(0, Modes.Major).harmonic_scale), 
                          ['C', 'D', 'E', 'F', 'G', 'A', 'B'])
-        self.assertEqual(scaleMode(1, Modes.Major), 
+        self.assertEqual(list(Key(1, Modes.Major).harmonic_scale), 
                          ['G', 'A', 'B', 'C', 'D', 'E', 'F#'])
-        self.assertEqual(scaleMode(2, Modes.Major), 
+        self.assertEqual(list(Key(2, Modes.Major).harmonic_scale), 
                          ['D', 'E', 'F#', 'G', 'A', 'B', 'C#'])
-        self.assertEqual(scaleMode(3, Modes.Major), 
+        self.assertEqual(list(Key(3, Modes.Major).harmonic_scale), 
                          ['A', 'B', 'C#', 'D', 'E', 'F#', 'G#'])
-        self.assertEqual(scaleMode(4, Modes.Major), 
+        self.assertEqual(list(Key(4, Modes.Major).harmonic_scale), 
                          ['E', 'F#', 'G#', 'A', 'B', 'C#', 'D#'])
-        self.assertEqual(scaleMode(5, Modes.Major), 
+        self.assertEqual(list(Key(5, Modes.Major).harmonic_scale), 
                          ['B', 'C#', 'D#', 'E', 'F#', 'G#', 'A#'])
-        self.assertEqual(scaleMode(6, Modes.Major), 
+        self.assertEqual(list(Key(6, Modes.Major).harmonic_scale), 
                          ['F#', 'G#', 'A#', 'B', 'C#', 'D#', 'E#'])
-        self.assertEqual(scaleMode(7, Modes.Major), 
+        self.assertEqual(list(Key(7, Modes.Major).harmonic_scale), 
                          ['C#', 'D#', 'E#', 'F#', 'G#', 'A#', 'B#'])
 
     def test_keySharps(self):
-        self.assertEqual(keySharps(0), 'C')
-        self.assertEqual(keySharps(1), 'G')
-        self.assertEqual(keySharps(2), 'D')
-        self.assertEqual(keySharps(3), 'A')
-        self.assertEqual(keySharps(4), 'E')
-        self.assertEqual(keySharps(5), 'B')
-        self.assertEqual(keySharps(6), 'F#')
-        self.assertEqual(keySharps(7), 'C#')
+        self.assertEqual(Key.keySharps(0), 'C')
+        self.assertEqual(Key.keySharps(1), 'G')
+        self.assertEqual(Key.keySharps(2), 'D')
+        self.assertEqual(Key.keySharps(3), 'A')
+        self.assertEqual(Key.keySharps(4), 'E')
+        self.assertEqual(Key.keySharps(5), 'B')
+        self.assertEqual(Key.keySharps(6), 'F#')
+        self.assertEqual(Key.keySharps(7), 'C#')
 
     def test_keyFlats(self):
-        self.assertEqual(keyFlats(0), 'C')
-        self.assertEqual(keyFlats(1), 'F')
-        self.assertEqual(keyFlats(2), 'Bb')
-        self.assertEqual(keyFlats(3), 'Eb')
-        self.assertEqual(keyFlats(4), 'Ab')
-        self.assertEqual(keyFlats(5), 'Db')
-        self.assertEqual(keyFlats(6), 'Gb')
-        self.assertEqual(keyFlats(7), 'Cb')
+        self.assertEqual(Key.keyFlats(0), 'C')
+        self.assertEqual(Key.keyFlats(1), 'F')
+        self.assertEqual(Key.keyFlats(2), 'Bb')
+        self.assertEqual(Key.keyFlats(3), 'Eb')
+        self.assertEqual(Key.keyFlats(4), 'Ab')
+        self.assertEqual(Key.keyFlats(5), 'Db')
+        self.assertEqual(Key.keyFlats(6), 'Gb')
+        self.assertEqual(Key.keyFlats(7), 'Cb')
 
     def test_enharmonics(self):
-        self.assertEqual(enhIndex('C#'), enhIndex('Db'))
-        self.assertEqual(enhIndex('D#'), enhIndex('Eb'))
-        self.assertEqual(enhIndex('E#'), enhIndex('F'))
-        self.assertEqual(enhIndex('F#'), enhIndex('Gb'))
-        self.assertEqual(enhIndex('G#'), enhIndex('Ab'))
-        self.assertEqual(enhIndex('A#'), enhIndex('Bb'))
-        self.assertEqual(enhIndex('B#'), enhIndex('C'))
-
-        self.assertEqual(enhIndex('Cb'), enhIndex('B'))
-        self.assertEqual(enhIndex('Fb'), enhIndex('E'))
-
-
-        self.assertEqual(flatEnharmonic('C#'), 'Db')
-        self.assertEqual(flatEnharmonic('D#'), 'Eb')
-        self.assertEqual(flatEnharmonic('E#'), 'F')
-        self.assertEqual(flatEnharmonic('E'), 'Fb')
-        self.assertEqual(flatEnharmonic('F#'), 'Gb')
-        self.assertEqual(flatEnharmonic('G#'), 'Ab')
-        self.assertEqual(flatEnharmonic('A#'), 'Bb')
-        self.assertEqual(flatEnharmonic('B'), 'Cb')
-        self.assertEqual(flatEnharmonic('B#'), 'C')
+        self.assertEqual(Enharmonic.toIndex('C#'), Enharmonic.toIndex('Db'))
+        self.assertEqual(Enharmonic.toIndex('D#'), Enharmonic.toIndex('Eb'))
+        self.assertEqual(Enharmonic.toIndex('E#'), Enharmonic.toIndex('F'))
+        self.assertEqual(Enharmonic.toIndex('F#'), Enharmonic.toIndex('Gb'))
+        self.assertEqual(Enharmonic.toIndex('G#'), Enharmonic.toIndex('Ab'))
+        self.assertEqual(Enharmonic.toIndex('A#'), Enharmonic.toIndex('Bb'))
+        self.assertEqual(Enharmonic.toIndex('B#'), Enharmonic.toIndex('C'))
+
+        self.assertEqual(Enharmonic.toIndex('Cb'), Enharmonic.toIndex('B'))
+        self.assertEqual(Enharmonic.toIndex('Fb'), Enharmonic.toIndex('E'))
+
+
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('C#')], 'Db')
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('D#')], 'Eb')
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('E#')], 'F')
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('E')], 'Fb')
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('F#')], 'Gb')
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('G#')], 'Ab')
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('A#')], 'Bb')
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('B')], 'Cb')
+        self.assertEqual(Enharmonic.flat[Enharmonic.toIndex('B#')], 'C')
         
-        self.assertEqual(sharpEnharmonic('C'), 'B#')
-        self.assertEqual(sharpEnharmonic('Db'), 'C#')
-        self.assertEqual(sharpEnharmonic('Eb'), 'D#')
-        self.assertEqual(sharpEnharmonic('Fb'), 'E')
-        self.assertEqual(sharpEnharmonic('F'), 'E#')
-        self.assertEqual(sharpEnharmonic('Gb'), 'F#')
-        self.assertEqual(sharpEnharmonic('Ab'), 'G#')
-        self.assertEqual(sharpEnharmonic('Bb'), 'A#')
+        self.assertEqual(Enharmonic.sharp[Enharmonic.toIndex('C')], 'B#')
+        self.assertEqual(Enharmonic.sharp[Enharmonic.toIndex('Db')], 'C#')
+        self.assertEqual(Enharmonic.sharp[Enharmonic.toIndex('Eb')], 'D#')
+        self.assertEqual(Enharmonic.sharp[Enharmonic.toIndex('Fb')], 'E')
+        self.assertEqual(Enharmonic.sharp[Enharmonic.toIndex('F')], 'E#')
+        self.assertEqual(Enharmonic.sharp[Enharmonic.toIndex('Gb')], 'F#')
+        self.assertEqual(Enharmonic.sharp[Enharmonic.toIndex('Ab')], 'G#')
+        self.assertEqual(Enharmonic.sharp[Enharmonic.toIndex('Bb')], 'A#')
 
     def test_noteOrder(self):
-        self.assertEqual(noteOrder('B#'), 6)
-        self.assertEqual(noteOrder('C'), 0)
-        self.assertEqual(noteOrder('C#'), 0)
-        self.assertEqual(noteOrder('Db'), 1)
-        self.assertEqual(noteOrder('D'), 1)
-        self.assertEqual(noteOrder('D#'), 1)
-        self.assertEqual(noteOrder('Eb'), 2)
-        self.assertEqual(noteOrder('E'), 2)
-        self.assertEqual(noteOrder('Fb'), 3)
-        self.assertEqual(noteOrder('E#'), 2)
-        self.assertEqual(noteOrder('F'), 3)
-        self.assertEqual(noteOrder('F#'), 3)
-        self.assertEqual(noteOrder('Gb'), 4)
-        self.assertEqual(noteOrder('G'), 4)
-        self.assertEqual(noteOrder('G#'), 4)
-        self.assertEqual(noteOrder('Ab'), 5)
-        self.assertEqual(noteOrder('A'), 5)
-        self.assertEqual(noteOrder('A#'), 5)
-        self.assertEqual(noteOrder('Bb'), 6)
-        self.assertEqual(noteOrder('B'), 6)
-        self.assertEqual(noteOrder('Cb'), 0)
+        self.assertEqual(Enharmonic.toOrder('B#'), 6)
+        self.assertEqual(Enharmonic.toOrder('C'), 0)
+        self.assertEqual(Enharmonic.toOrder('C#'), 0)
+        self.assertEqual(Enharmonic.toOrder('Db'), 1)
+        self.assertEqual(Enharmonic.toOrder('D'), 1)
+        self.assertEqual(Enharmonic.toOrder('D#'), 1)
+        self.assertEqual(Enharmonic.toOrder('Eb'), 2)
+        self.assertEqual(Enharmonic.toOrder('E'), 2)
+        self.assertEqual(Enharmonic.toOrder('Fb'), 3)
+        self.assertEqual(Enharmonic.toOrder('E#'), 2)
+        self.assertEqual(Enharmonic.toOrder('F'), 3)
+        self.assertEqual(Enharmonic.toOrder('F#'), 3)
+        self.assertEqual(Enharmonic.toOrder('Gb'), 4)
+        self.assertEqual(Enharmonic.toOrder('G'), 4)
+        self.assertEqual(Enharmonic.toOrder('G#'), 4)
+        self.assertEqual(Enharmonic.toOrder('Ab'), 5)
+        self.assertEqual(Enharmonic.toOrder('A'), 5)
+        self.assertEqual(Enharmonic.toOrder('A#'), 5)
+        self.assertEqual(Enharmonic.toOrder('Bb'), 6)
+        self.assertEqual(Enharmonic.toOrder('B'), 6)
+        self.assertEqual(Enharmonic.toOrder('Cb'), 0)
+
+class TestKeyTable(unittest.TestCase):
+    def test_shared(self):
+        self.assertIs(Key(-2, Modes.Major), Key(-2, Modes.Major))
+        self.assertIsNot(Key(-2, Modes.Major), Key(-2, Modes.NaturalMinor))
+        self.assertIsNot(Key(-2, Modes.Major), Key(2, Modes.Major))
+
+    def test_sameAsBuilt(self):
+        Key.buildTable()
+        self.assertEqual(len(Key.table), 15 * len(Modes))
+        for (signature, mode), key in Key.table.items():
+            built = Key.build(signature, mode)
+            self.assertEqual(key.harmonic_scale, built.harmonic_scale)
+            self.assertEqual(key.triad_scale, built.triad_scale)
+            self.assertEqual(key.degree_scale, built.degree_scale)
+
+    def test_immutable(self):
+        k = Key(0, Modes.Major)
+        with self.assertRaises(AttributeError):
+            k.signature = 1
+        with self.assertRaises(AttributeError):
+            k.other = 1
+        with self.assertRaises(AttributeError):
+            del k.mode
+        self.assertEqual(k.getHarmonicScale(),
+                         ('C', 'D', 'E', 'F', 'G', 'A', 'B'))
+
+    def test_invalid(self):
+        with self.assertRaises(Exception):
+            Key(8, Modes.Major)
+        self.assertNotIn((8, Modes.Major), Key.table)
+
+
+class TestNoteIndex(unittest.TestCase):
+    def test_bidirectional(self):
+        for name, (enh_index, order) in note_index.items():
+            self.assertEqual(Enharmonic.toIndex(name), enh_index)
+            self.assertEqual(Enharmonic.toOrder(name), order)
+            self.assertEqual(note_index[spelling_table[(enh_index, order)]],
+                             (enh_index, order))
+
+    def test_spelling(self):
+        self.assertEqual(Enharmonic.toNote(0, 0), 'C')
+        self.assertEqual(Enharmonic.toNote(0, 6), 'B#')
+        self.assertEqual(Enharmonic.toNote(4, 3), 'Fb')
+        self.assertEqual(Enharmonic.toNote(7, 3), 'F##')
+        self.assertEqual(Enharmonic.toNote(9, 6), 'Bbb')
+        self.assertEqual(Enharmonic.toIndices(['C', 'E', 'G']), [0, 4, 7])
+        with self.assertRaises(Exception):
+            Enharmonic.toNote(0, 3)
+        with self.assertRaises(Exception):
+            Enharmonic.toIndex('H')
+
+
+class TestChordScale(unittest.TestCase):
+    def test_ppChordScale(self):
+        self.assertEqual(Key(0, Modes.Major).ppChordScale(), '\n'.join([
+            '-'*43,
+            '| G   | A   | B   | C   | D   | E   | F   |',
+            '| E   | F   | G   | A   | B   | C   | D   |',
+            '| C   | D   | E   | F   | G   | A   | B   |',
+            '',
+            '-'*43,
+            '| C  M| D  m| E  m| F  M| G  M| A  m| B  d|',
+            '| I   | ii  | iii | IV  | V   | vi  | vii\xb0|',
+            '']))
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestScalesFor(unittest.TestCase):
+    def test_sameAsKey(self):
+        qualities = {'d': Chords.Diminished, 'm': Chords.Minor,
+                     'M': Chords.Major, 'A': Chords.Augmented}
+        batch = scalesFor()
+        self.assertEqual(len(batch), 15 * len(Modes))
+        for i in range(len(batch)):
+            k = Key(*batch.key(i))
+            self.assertEqual(list(batch.enharmonic[i]), list(k.enharmonic_scale))
+            self.assertEqual(batch.harmonicScale(i), list(k.harmonic_scale))
+            self.assertEqual(batch.chordScale(i),
+                             [qualities[d[0]] for d in k.degree_scale])
+            self.assertEqual(batch.degreeLabels(i),
+                             [d[1] for d in k.degree_scale])
+            self.assertEqual([list(t) for t in batch.triads[i]],
+                             [Enharmonic.toIndices(t) for t in k.triad_scale])
+
+    def test_subset(self):
+        batch = scalesFor([-1, 1], [Modes.HarmonicMinor])
+        self.assertEqual(batch.key(0), (-1, Modes.HarmonicMinor))
+        self.assertEqual(batch.harmonicScale(1),
+                         ['E', 'F#', 'G', 'A', 'B', 'C', 'D#'])
+        with self.assertRaises(Exception):
+            scalesFor([8], [Modes.Major])
+
+
+class TestExport(unittest.TestCase):
+    def test_keyReference(self):
+        entry = keyReference(Key(-2, Modes.Major))
+        self.assertEqual(entry['key'], 'Bb')
+        self.assertEqual(entry['chords'], ['Bb', 'Cm', 'Dm', 'Eb', 'F', 'Gm',
+                                           'Adim'])
+        self.assertEqual(entry['triads'][4], ['F', 'A', 'C'])
+        self.assertEqual(entry['circle'], Key(-2, Modes.Major)
+                         .getCircleProgression())
+        self.assertEqual(keyReference(Key(0, Modes.NaturalMinor))['key'], 'Am')
+
+    def test_json(self):
+        out = io.StringIO()
+        exportReference(out, 'json')
+        entries = json.loads(out.getvalue())
+        self.assertEqual(len(entries), 60)
+        self.assertEqual(entries[0], keyReference(Key(-7, Modes.Major)))
+
+    def test_csv(self):
+        out = io.StringIO()
+        exportReference(out, 'csv', modes=[Modes.HarmonicMinor])
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 15)
+        self.assertEqual(rows[7]['key'], 'Am')
+        self.assertEqual(rows[7]['degrees'], u'i ii\xb0 III+ iv V VI vii\xb0')
+
+    def test_markdown(self):
+        out = io.StringIO()
+        exportReference(out, 'md', signatures=[0], modes=[Modes.Major])
+        self.assertEqual(out.getvalue().splitlines()[:5], [
+            '## C Major (+0)',
+            '',
+            u'| Degree | I | ii | iii | IV | V | vi | vii\xb0 |',
+            '|---|---|---|---|---|---|---|---|',
+            '| Chord | C | Dm | Em | F | G | Am | Bdim |'])
+
+    def test_unknownFormat(self):
+        with self.assertRaises(ValueError):
+            exportReference(io.StringIO(), 'xml')
+
+
+class TestProgression(unittest.TestCase):
+    def test_degreePaths(self):
+        self.assertEqual(degreePaths(0, 3), ((0, 3, 0), (0, 4, 0), (0, 6, 0)))
+        self.assertEqual(degreePaths(0, 2), ())
+        for length in range(1, 8):
+            paths = degreePaths(0, length)
+            self.assertEqual(len(paths), degreePathCount(0, length))
+            for path in paths:
+                for a, b in zip(path, path[1:]):
+                    self.assertIn(b, degree_transitions[a])
+
+    def test_getProgressions(self):
+        self.assertEqual(Key(0, Modes.Major).getProgressions(3),
+                         [['I', 'IV', 'I'], ['I', 'V', 'I'],
+                          ['I', u'vii\xb0', 'I']])
+        # Longer ones are too many to list, but may still be drawn
+        key = Key(0, Modes.Major)
+        with self.assertRaises(ValueError):
+            key.getProgressions(16)
+        self.assertEqual(len(key.sampleProgression(20)), 20)
+
+    def test_sampleProgression(self):
+        key = Key(-3, Modes.HarmonicMinor)
+        rng = random.Random(0)
+        progressions = key.getProgressions(5)
+        for i in range(20):
+            self.assertIn(key.sampleProgression(5, rng), progressions)
+        with self.assertRaises(ValueError):
+            key.sampleProgression(2)
+
+    def test_parseChord(self):
+        self.assertEqual(parseChord('C'), ('C', 'M'))
+        self.assertEqual(parseChord('F#m'), ('F#', 'm'))
+        self.assertEqual(parseChord('Bbdim'), ('Bb', 'd'))
+        self.assertEqual(parseChord('Ebb+'), ('Ebb', 'A'))
+        with self.assertRaises(ValueError):
+            parseChord('H7')
+
+    def test_analyzeProgression(self):
+        key, labels = analyzeProgression(['C', 'Am', 'F', 'G'])[0]
+        self.assertIs(key, Key(0, Modes.Major))
+        self.assertEqual(labels, ['I', 'vi', 'IV', 'V'])
+
+        key, labels = analyzeProgression(['Am', 'Dm', 'E', 'Am'])[0]
+        self.assertIs(key, Key(0, Modes.HarmonicMinor))
+        self.assertEqual(labels, ['i', 'iv', 'V', 'i'])
+
+    def test_spelling(self):
+        self.assertIs(analyzeProgression(['C#', 'F#', 'G#'])[0][0],
+                      Key(7, Modes.Major))
+        self.assertIs(analyzeProgression(['Db', 'Gb', 'Ab'])[0][0],
+                      Key(-5, Modes.Major))
+
+
+class TestPitchIndex(unittest.TestCase):
+    def test_pitchMask(self):
+        self.assertEqual(pitchMask([0, 4, 7]), 0b10010001)
+        self.assertEqual(pitchMask([]), 0)
+
+    def test_matchesKeys(self):
+        index = pitchIndex()
+        self.assertEqual(len(index.keys), 60)
+        for bit, (signature, mode) in enumerate(index.keys):
+            key = Key(signature, mode)
+            self.assertEqual(index.scales[bit],
+                             pitchMask(key.enharmonic_scale))
+            self.assertEqual(index.triads[bit],
+                             tuple(pitchMask(Enharmonic.toIndices(t))
+                                   for t in key.triad_scale))
+
+    def test_keysWithNotes(self):
+        self.assertEqual(keysWithNotes(['C', 'E', 'G#']),
+                         [Key(s, m) for m in (Modes.HarmonicMinor,
+                                              Modes.MelodicMinor)
+                          for s in (-4, 0, 4)])
+        # Enharmonic spellings are the same pitch class
+        self.assertEqual(keysWithNotes(['B#', 'Fb', 'G#']),
+                         keysWithNotes(['C', 'E', 'Ab']))
+        self.assertEqual(len(keysWithNotes([])), 60)
+
+    def test_keysWithChords(self):
+        self.assertEqual(keysWithChords(['Dm', 'G', 'C']),
+                         [Key(0, Modes.Major), Key(0, Modes.NaturalMinor)])
+        self.assertEqual(keysWithChords(['C+', 'E']),
+                         [Key(0, Modes.HarmonicMinor),
+                          Key(0, Modes.MelodicMinor)])
+        self.assertEqual(keysWithChords(['C', 'F#']), [])
+
+    def test_bruteForce(self):
+        rng = random.Random(0)
+        names = list(note_index)
+        for i in range(50):
+            notes = rng.sample(names, rng.randint(1, 5))
+            pitches = set(Enharmonic.toIndices(notes))
+            expected = [Key(s, m) for m in Modes for s in range(-7, 8)
+                        if pitches <= set(Key(s, m).enharmonic_scale)]
+            self.assertEqual(keysWithNotes(notes), expected)
+
+
+class TestKeyGraph(unittest.TestCase):
+    def test_parseKey(self):
+        self.assertIs(parseKey('Eb'), Key(-3, Modes.Major))
+        self.assertIs(parseKey('F#m'), Key(3, Modes.NaturalMinor))
+        self.assertIs(parseKey('Ahm'), Key(0, Modes.HarmonicMinor))
+        self.assertIs(parseKey('Cmm'), Key(-3, Modes.MelodicMinor))
+        # Keys missing from the tables go to their enharmonic key
+        self.assertIs(parseKey('G#'), Key(-4, Modes.Major))
+        self.assertIs(parseKey('C#'), Key(7, Modes.Major))
+        for name in ('', 'H', 'Cx', 'mm'):
+            with self.assertRaises(ValueError):
+                parseKey(name)
+
+    def test_transposeKey(self):
+        self.assertIs(transposeKey(Key(0, Modes.Major), 2), Key(2, Modes.Major))
+        self.assertIs(transposeKey(Key(0, Modes.NaturalMinor), 1),
+                      Key(-5, Modes.NaturalMinor))
+        self.assertIs(transposeKey(Key(3, Modes.HarmonicMinor), -12),
+                      Key(3, Modes.HarmonicMinor))
+
+    def test_wrapSignature(self):
+        self.assertEqual(wrapSignature(8), -4)
+        self.assertEqual(wrapSignature(-8), 4)
+        self.assertEqual(wrapSignature(7), 7)
+
+    def test_relatedKeys(self):
+        related = relatedKeys(Key(0, Modes.Major))
+        self.assertEqual(related['dominant'], [Key(1, Modes.Major)])
+        self.assertEqual(related['subdominant'], [Key(-1, Modes.Major)])
+        self.assertIn(Key(0, Modes.NaturalMinor), related['relative'])
+        self.assertIn(Key(-3, Modes.NaturalMinor), related['parallel'])
+        self.assertNotIn('enharmonic', related)
+        # Past seven sharps or flats, fifths go on from the enharmonic key
+        self.assertEqual(relatedKeys(Key(7, Modes.Major))['dominant'],
+                         [Key(-4, Modes.Major)])
+        self.assertEqual(relatedKeys(Key(-7, Modes.Major))['enharmonic'],
+                         [Key(5, Modes.Major)])
+        # Cb major has B minor for parallel, A# minor has Bb major
+        self.assertIn(Key(2, Modes.NaturalMinor),
+                      relatedKeys(Key(-7, Modes.Major))['parallel'])
+        self.assertIn(Key(-2, Modes.Major),
+                      relatedKeys(Key(7, Modes.NaturalMinor))['parallel'])
+
+    def test_commonTones(self):
+        graph = keyGraph()
+        c = Key(0, Modes.Major)
+        self.assertEqual(graph.commonTones(c, Key(0, Modes.NaturalMinor)), 7)
+        self.assertEqual(graph.commonTones(c, Key(1, Modes.Major)), 6)
+        self.assertEqual(graph.commonTones(c, Key(6, Modes.Major)), 2)
+        self.assertEqual(graph.commonTones(Key(7, Modes.Major),
+                                           Key(-5, Modes.Major)), 7)
+
+    def test_modulationPath(self):
+        c = Key(0, Modes.Major)
+        self.assertEqual(modulationPath(c, c), [])
+        self.assertEqual(modulationPath(c, Key(0, Modes.NaturalMinor)),
+                         [('relative', Key(0, Modes.NaturalMinor))])
+        self.assertEqual(modulationPath(c, Key(2, Modes.Major)),
+                         [('dominant', Key(1, Modes.Major)),
+                          ('dominant', Key(2, Modes.Major))])
+
+    def test_shortestPaths(self):
+        graph = keyGraph()
+        keys = [Key(s, m) for m in Modes for s in range(-7, 8)]
+        for key in keys:
+            related = [other for relation, other in graph.related(key)]
+            for target in keys:
+                path = graph.path(key, target)
+                # Each step goes to a related key and ends on target
+                current = key
+                for relation, step in path:
+                    self.assertIn((relation, step), graph.related(current))
+                    current = step
+                self.assertIs(current, target)
+                # No neighbour is more than one step closer
+                for other in related:
+                    self.assertLessEqual(graph.distance(key, target),
+                                         graph.distance(other, target) + 1)
+
+
+class TestScaleTypes(unittest.TestCase):
+    def test_modeTables(self):
+        # The Key tables and the derived ones must agree
+        codes = {Chords.Diminished: 'd', Chords.Minor: 'm', Chords.Major: 'M',
+                 Chords.Augmented: 'A'}
+        for mode in Modes:
+            key = Key(0, mode)
+            self.assertEqual(sum(scale_division[mode]), 12)
+            self.assertEqual([codes[c] for c in scaleChords[mode]],
+                             [d[0] for d in key.degree_scale])
+
+    def test_melodicMinor(self):
+        self.assertEqual(scaleChords[Modes.MelodicMinor],
+                         [Chords.Minor, Chords.Minor, Chords.Augmented,
+                          Chords.Major, Chords.Major, Chords.Diminished,
+                          Chords.Diminished])
+
+    def test_churchModes(self):
+        names = ['ionian', 'dorian', 'phrygian', 'lydian', 'mixolydian',
+                 'aeolian', 'locrian']
+        major = scale_types['major']
+        for degree, name in enumerate(names):
+            scale = scale_types[name]
+            self.assertEqual(scale.steps, rotate(major.steps, degree))
+            self.assertEqual(scale.triads, rotate(major.triads, degree))
+            self.assertEqual(scale.sevenths, rotate(major.sevenths, degree))
+        self.assertEqual(scale_types['dorian'].notes('D'),
+                         ['D', 'E', 'F', 'G', 'A', 'B', 'C'])
+        self.assertEqual(scale_types['lydian'].notes('F'),
+                         ['F', 'G', 'A', 'B', 'C', 'D', 'E'])
+
+    def test_sevenths(self):
+        self.assertEqual(scale_types['major'].sevenths,
+                         ('maj7', 'm7', 'm7', 'maj7', '7', 'm7', 'm7b5'))
+        self.assertEqual(scale_types['harmonic-minor'].sevenths[6], 'dim7')
+
+    def test_otherSizes(self):
+        self.assertEqual(len(scale_types['major-pentatonic']), 5)
+        self.assertEqual(scale_types['major-pentatonic'].triads[0], 'M')
+        self.assertEqual(set(scale_types['whole-tone'].triads), {'A'})
+        self.assertEqual(set(scale_types['octatonic-hw'].sevenths), {'dim7'})
+        self.assertEqual(scale_types['minor-pentatonic'].notes('Bb'),
+                         ['Bb', 'Db', 'Eb', 'F', 'Ab'])
+        self.assertEqual(scale_types['blues'].notes('A'),
+                         ['A', 'C', 'D', 'D#', 'E', 'G'])
+
+    def test_ppScale(self):
+        self.assertEqual(scale_types['dorian'].ppScale('D').splitlines(), [
+            'D dorian',
+            '| D     | E     | F     | G     | A     | B     | C     |',
+            '| Dm    | Em    | F     | G     | Am    | Bdim  | C     |',
+            '| Dm7   | Em7   | Fmaj7 | G7    | Am7   | Bm7b5 | Cmaj7 |'])
+
+    def test_badSteps(self):
+        with self.assertRaises(ValueError):
+            ScaleType('broken', (2, 2, 2))
+
+
+class TestRender(unittest.TestCase):
+    def test_ladder(self):
+        self.assertEqual(ladder(Key(0, Modes.Major))[:8],
+                         [60, 62, 64, 65, 67, 69, 71, 72])
+        self.assertEqual(ladder(Key(0, Modes.HarmonicMinor))[:3], [69, 71, 72])
+
+    def test_keyNotes(self):
+        notes = keyNotes(Key(0, Modes.Major))
+        # Scale with its octave, then 7 triads and the 7 of the circle
+        self.assertEqual(len(notes), 8 + 3 * 14)
+        self.assertEqual([n[2] for n in notes[8:11]], [60, 64, 67])
+        circle = [n[2] for n in notes[8 + 21:]][::3]
+        self.assertEqual(circle, [60, 65, 71, 64, 69, 62, 67])
+        self.assertEqual([n[2] for n in keyNotes(Key(0, Modes.Major),
+                                                 'open')[8:11]],
+                         [48, 67, 76])
+        with self.assertRaises(ValueError):
+            keyNotes(Key(0, Modes.Major), 'drop2')
+
+    def test_varLength(self):
+        self.assertEqual(varLength(0), b'\x00')
+        self.assertEqual(varLength(0x7f), b'\x7f')
+        self.assertEqual(varLength(0x80), b'\x81\x00')
+        self.assertEqual(varLength(0x0fffffff), b'\xff\xff\xff\x7f')
+
+    def test_renderMidi(self):
+        data = renderMidi([(0, 1, 60), (1, 1, 60)], tempo=60)
+        self.assertEqual(data[:14], b'MThd\x00\x00\x00\x06\x00\x00\x00\x01'
+                                    b'\x01\xe0')
+        self.assertEqual(data[14:18], b'MTrk')
+        self.assertEqual(data[22:], b'\x00\xff\x51\x03\x0f\x42\x40'
+                                    b'\x00\x90\x3c\x50'
+                                    b'\x83\x60\x80\x3c\x00'
+                                    b'\x00\x90\x3c\x50'
+                                    b'\x83\x60\x80\x3c\x00'
+                                    b'\x00\xff\x2f\x00')
+        out = io.BytesIO()
+        self.assertEqual(renderMidi([(0, 1, 60)], out=out), out.getvalue())
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_renderWav(self):
+        import wave
+        data = renderWav([(0, 1, 69)], tempo=60, rate=8000)
+        with wave.open(io.BytesIO(data)) as reader:
+            self.assertEqual(reader.getnchannels(), 1)
+            self.assertEqual(reader.getframerate(), 8000)
+            self.assertEqual(reader.getnframes(), 8001)
+
+    def test_cache(self):
+        cache = RenderCache(size=2)
+        first = cache.get(Key(7, Modes.Major))
+        self.assertIs(cache.get(Key(7, Modes.Major)), first)
+        # C# and Db sound the same and share their rendering
+        self.assertIs(cache.get(Key(-5, Modes.Major)), first)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2,
+                                         'entries': 2, 'blobs': 1})
+        cache.get(Key(0, Modes.Major), tempo=90)
+        cache.get(Key(0, Modes.Major), voicing='open')
+        self.assertEqual(cache.stats()['blobs'], 2)
+
+    def test_prerender(self):
+        cache = RenderCache()
+        keys = [Key(s, Modes.Major) for s in range(-7, 8)]
+        asyncio.run(cache.prerender(keys))
+        self.assertEqual(cache.stats()['entries'], 15)
+        cache.get(keys[0])
+        self.assertEqual(cache.hits, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
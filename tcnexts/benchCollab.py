@@ -0,0 +1,136 @@
+import asyncio
+import gzip
+import os
+import tempfile
+import time
+import timeit
+import tracemalloc
+import unittest
+
+from soundcloud import (TracklistParser, chunk_size)
+from store import (SqlitePlaylistStore, WriteBehindStore)
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+# Saved page of a set, gzipped, and the number of tracks it lists
+fixture_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures', 'soundcloud_set.html.gz')
+tracks = 5000
+
+# Slowest accepted times, in seconds, and peak memory of a parse. The parse
+# limits allow for a slow CI machine reading the whole fixture, the store
+# ones for SQLite writing to a slow disk.
+limits = {
+    'parse': 2.5,
+    'parse peak MB': 5,
+    'WriteBehindStore.advance': 50e-6,
+    'SqlitePlaylistStore.advance': 2e-3,
+    'saveCursors': 50e-3,
+}
+
+
+def measure(parse, html):
+    '''Returns (seconds, peak bytes, links) for one parse of html'''
+    start = time.perf_counter()
+    links = parse(html)
+    elapsed = time.perf_counter() - start
+
+    # Traced separately, tracing slows the parse down
+    tracemalloc.start()
+    parse(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, links
+
+
+def soupParse(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    links = []
+    for section in soup.find_all('section'):
+        if 'tracklist' in section.get('class', []):
+            for article in section.find_all('article'):
+                links.append(article.h2.a['href'])
+    return links
+
+
+def streamParse(html):
+    parser = TracklistParser()
+    links = []
+    for i in range(0, len(html), chunk_size):
+        parser.feed(html[i:i + chunk_size])
+        links += parser.drain()
+        if parser.done:
+            break
+    return links
+
+
+class Benchmark(unittest.TestCase):
+    def check(self, name, value, unit='us', scale=1e6):
+        print('\n  {:28s}: {:10.3f} {} (limit {:.0f} {})'.format(
+            name, value * scale, unit, limits[name] * scale, unit), end='')
+        self.assertLess(value, limits[name], name + ' got slower')
+
+
+class BenchParse(Benchmark):
+    def setUp(self):
+        with gzip.open(fixture_path, 'rt', encoding='utf-8') as infile:
+            self.html = infile.read()
+
+    def test_streaming(self):
+        elapsed, peak, links = measure(streamParse, self.html)
+        self.assertEqual(len(links), tracks)
+        self.check('parse', elapsed, 'ms', 1e3)
+        self.check('parse peak MB', peak / 1e6, 'MB', 1)
+
+    @unittest.skipIf(BeautifulSoup is None, 'bs4 is not installed')
+    def test_soup(self):
+        elapsed, peak, links = measure(soupParse, self.html)
+        self.assertEqual(len(links), tracks)
+        print('\n  {:28s}: {:10.3f} ms {:8.1f} MB peak'.format(
+            'full soup, for reference', elapsed * 1e3, peak / 1e6), end='')
+
+
+class BenchPersistence(Benchmark):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SqlitePlaylistStore(
+            os.path.join(self.directory.name, 'collab.db'))
+        self.urls = ['/user/track-' + str(i) for i in range(tracks)]
+        for channel in range(10):
+            self.store.setPlaylist(str(channel), self.urls)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_writeBehindAdvance(self):
+        playlists = WriteBehindStore(self.store)
+
+        async def advance():
+            await playlists.advance('0')
+            start = time.perf_counter()
+            for i in range(tracks - 1):
+                await playlists.advance('0')
+            return (time.perf_counter() - start) / (tracks - 1)
+
+        per_call = asyncio.run(advance())
+        playlists.stop()
+        self.check('WriteBehindStore.advance', per_call)
+
+    def test_storeAdvance(self):
+        per_call = min(timeit.repeat(lambda: self.store.advance('1'),
+                                     number=200, repeat=5)) / 200
+        self.check('SqlitePlaylistStore.advance', per_call)
+
+    def test_saveCursors(self):
+        cursors = {str(channel): channel for channel in range(10)}
+        elapsed = min(timeit.repeat(lambda: self.store.saveCursors(cursors),
+                                    number=1, repeat=5))
+        self.check('saveCursors', elapsed, 'ms', 1e3)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,91 +1,178 @@
-from bs4 import BeautifulSoup
-from urllib.request import urlopen
 from discord.ext import commands
+from discordbot.utils import checks
+from discordbot.utils.metrics import metrics
+from discordbot.utils.shards import shardFor
+from tcnexts.ingest import (Ingester, job_kind)
+from tcnexts.soundcloud import SoundCloudClient
+from tcnexts.store import (SqlitePlaylistStore, WriteBehindStore,
+                           migrateFiles)
 
-import json
+import asyncio
+import logging
 
 test_url='https://soundcloud.com/mvy/sets/private-pl/s-qhbqj'
 sc_prefix='https://soundcloud.com'
 
+log = logging.getLogger(__name__)
+
 
 class Collab:
+    '''
+    Collaboration games playlists. The playlist store, its migration and the
+    SoundCloud client are set up by the first collab command, or the first
+    stored ingest job, rather than while the bot starts.
+    '''
 
     def __init__(self, bot):
         self.bot = bot
+        self.client = None
+        self.store = None
+        self.playlists = None
+        self.ingester = None
+        self.setting_up = None
+        # Stored ingests may be queued before any collab command
+        bot.scheduler.register(job_kind, self.ingest, cancel=self.revoke)
+        metrics.register(self.collectMetrics)
+
+    async def ready(self):
+        '''Sets the extension up once, the calls meanwhile waiting for it'''
+        if self.setting_up is None:
+            self.setting_up = self.bot.loop.create_task(self.setUp())
+        task = self.setting_up
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            # Tried again by the next command
+            if task is self.setting_up and task.done():
+                self.setting_up = None
+            raise
+
+    async def setUp(self):
+        self.store = await self.bot.loop.run_in_executor(None, openStore)
+        self.client = SoundCloudClient(metrics=metrics)
+        self.playlists = WriteBehindStore(self.store)
+        self.playlists.start(self.bot.loop)
+        self.ingester = Ingester(self.client, self.playlists,
+                                 self.bot.scheduler, metrics=metrics)
+        try:
+            await self.ingester.resumeAll(self.ownsGuild)
+        except Exception as e:
+            log.exception('Could not resume the ingests: %s', e)
+
+    async def ingest(self, *args):
+        '''Runs a stored ingest job queued before the extension was set up'''
+        await self.ready()
+        await self.ingester.run(*args)
+
+    async def revoke(self, *args):
+        '''Cancels such a job for good'''
+        await self.ready()
+        await self.ingester.revoke(*args)
+
+    def ownsGuild(self, guild_id):
+        '''
+        True if this shard handles guild_id, the ingests of private channels
+        being left to shard 0
+        '''
+        if not self.bot.shard_count:
+            return True
+        shard = 0 if guild_id is None else shardFor(guild_id,
+                                                    self.bot.shard_count)
+        return shard == self.bot.shard_id
+
+    def collectMetrics(self, metrics):
+        if self.ingester is None:
+            return
+        for name, value in self.client.cache.stats().items():
+            metrics.set('berlioz_playlist_cache_' + name, value)
+        metrics.set('berlioz_playlist_fetches_coalesced',
+                    self.client.coalesced)
+        metrics.set('berlioz_playlists_loaded', len(self.playlists.playlists))
+        metrics.set('berlioz_playlists_dirty', len(self.playlists.dirty))
+        metrics.set('berlioz_playlists_loading', self.ingester.loadingCount())
+
+    def __unload(self):
+        metrics.collectors.remove(self.collectMetrics)
+        self.bot.scheduler.unregister(job_kind)
+        if self.setting_up is not None and not self.setting_up.done():
+            self.setting_up.cancel()
+        if self.ingester is None:
+            if self.store is not None:
+                self.store.close()
+            return
+        # Unfinished ingests resume from their checkpoint on the next start
+        self.ingester.stop()
+        self.playlists.stop()
+        self.store.close()
+        if not self.bot.loop.is_closed():
+            self.bot.loop.create_task(self.client.close())
 
     @commands.group(pass_context=True)
     async def collab(self, ctx):
         if ctx.invoked_subcommand is None:
-            await self.bot.say('Incorrect collab subcommand.')
-            await self.bot.say('Currently available commands are :')
-            await self.bot.say('`!collab set <url>`')
-            await self.bot.say('`!collab next`')
+            await self.bot.say('\n'.join([
+                'Incorrect collab subcommand.',
+                'Currently available commands are :',
+                '`!collab set <url>`',
+                '`!collab next`']))
 
     @collab.command(pass_context=True)
+    @checks.rate_limited()
     async def set(self, ctx, url):
         if 'soundcloud.com' not in url:
             await self.bot.say('Not a soundcloud address.')
             return
 
-        html = urlopen(url).read().decode('utf-8')
-        soup = BeautifulSoup(html, 'html.parser')
-        for section in soup.find_all('section'):
-            links = []
-
-            if 'tracklist' in section['class']:
-                articles = section.find_all('article')
-                for article in articles:
-                    links.append(article.h2.a['href'])
-
-        with open('tmp/data' + ctx.message.channel.id + '.txt', 'w') as outfile:
-            data = {
-                'urls': links,
-                'current': 0
-            }
-
-            json.dump(data, outfile)
-
-        outfile.close()
+        await self.ready()
+        channel_id = ctx.message.channel.id
+        server = ctx.message.server
+        try:
+            links = await self.client.cachedTracklist(url)
+            if links is None:
+                # The first page is enough to start, the others follow
+                count = await self.ingester.start(
+                    channel_id, url, server.id if server else None)
+            else:
+                await self.ingester.replace(channel_id, links)
+                count = len(links)
+        except Exception as e:
+            log.warning('Could not fetch %s: %s', url, e)
+            await self.bot.say('Could not read the playlist, please try again '
+                'later.')
+            return
 
-        await self.bot.say('Collaboration games playlist initialised with ' +
-            len[links] + ' songs.')
+        message = ('Collaboration games playlist initialised with ' +
+            str(count) + ' songs.')
+        if self.ingester.loading(channel_id):
+            message += ' More are loading.'
+        await self.bot.say(message)
 
     @collab.command(pass_context=True)
+    @checks.rate_limited()
     async def next(self, ctx):
-        with open('tmp/data' + ctx.message.channel.id + '.txt', 'r') as infile:
-            data = json.load(infile)
-
-        infile.close()
-
-        if data == None:
-            await self.bot.say('Playlist is empty, please initialise with ' +
-                '`!collab set <url>` first.')
+        await self.ready()
+        channel_id = ctx.message.channel.id
+        url = await self.playlists.advance(channel_id)
+
+        if url is None:
+            if await self.playlists.getPlaylist(channel_id) is None:
+                await self.bot.say('Playlist is empty, please initialise with ' +
+                    '`!collab set <url>` first.')
+            elif self.ingester.loading(channel_id):
+                await self.bot.say('The next songs are still loading, please '
+                    'try again in a moment.')
+            else:
+                await self.bot.say('The playlist has been exhausted. Please '
+                    'reset it if you need more songs.')
             return
 
-        number = data['current']
-        urls = data['urls']
-
-        if number < 0:
-            await self.bot.say('Error in reading the playlist, please contact a ' 
-                ' TCN IT scientist.')
-            return 
-
-        if number >= len(urls):
-            await self.bot.say('The playlist has been exhausted. Please reset it '
-                'if you need more songs.')
-            return 
-
-        await self.bot.say(sc_prefix + urls[number])
-        number += 1
-
-        with open('tmp/data' + ctx.message.channel.id + '.txt', 'w') as outfile:
-            data = {
-                'urls': urls,
-                'current': number
-            }
-            json.dump(data, outfile)
+        await self.bot.say(sc_prefix + url)
 
-        outfile.close()
+def openStore():
+    '''Opens the playlist store, moving the former playlist files into it'''
+    store = SqlitePlaylistStore()
+    migrateFiles(store)
+    return store
 
 def setup(bot):
     bot.add_cog(Collab(bot))
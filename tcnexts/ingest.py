@@ -0,0 +1,170 @@
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+# Kind of the jobs loading the pages after the first, and the seconds they
+# may take before going back to their checkpoint
+job_kind = 'collab ingest'
+ingest_timeout = 3600
+
+
+class Ingester():
+    '''
+    Loads sets into the channel playlists page by page, in the background
+
+    Each page is stored with the address of the next one. The pages after
+    the first are loaded by a job of the scheduler that goes on from the last
+    stored page, so an ingest interrupted by an error or a restart is taken
+    up again by resumeAll().
+    '''
+
+    def __init__(self, client, playlists, scheduler, metrics=None):
+        self.client = client
+        self.playlists = playlists
+        self.scheduler = scheduler
+        self.metrics = metrics
+        scheduler.register(job_kind, self.run, cancel=self.revoke)
+
+    @staticmethod
+    def key(channel_id):
+        return job_kind + ' ' + channel_id
+
+    def job(self, channel_id):
+        '''Returns the queued or running ingest job of a channel, if any'''
+        return self.scheduler.find(Ingester.key(channel_id))
+
+    def loading(self, channel_id):
+        '''True while pages of the set of a channel are still being loaded'''
+        return self.job(channel_id) is not None
+
+    def loadingCount(self):
+        return sum(job.kind == job_kind for job in self.scheduler.live())
+
+    def stopJob(self, channel_id):
+        '''Stops the ingest job of a channel, if any, keeping its checkpoint'''
+        job = self.job(channel_id)
+        if job is not None:
+            self.scheduler.cancel(job.id)
+
+    async def cancel(self, channel_id):
+        '''
+        Stops the ingest of a channel for good, the playlist keeping the
+        tracks loaded so far
+        '''
+        async with self.playlists.lock(channel_id):
+            self.stopJob(channel_id)
+            await self.playlists.stopIngest(channel_id)
+
+    async def revoke(self, channel_id, *args):
+        '''Cancel function of the ingest jobs, given their args'''
+        await self.cancel(channel_id)
+
+    async def start(self, channel_id, url, guild=None):
+        '''
+        Replaces the playlist of a channel with the set at url
+
+        The playlist is left untouched if the first page cannot be read.
+
+        A set cached but stale is only loaded again if SoundCloud tells it
+        changed.
+
+        :return: number of tracks of the first page, the next ones being
+                 loaded in the background
+        '''
+        links, next_url, info = await self.client.fetchFirstPage(url)
+        if info['status'] == 304:
+            await self.replace(channel_id, links)
+            return len(links)
+
+        # Replaced under the channel lock, so that of several sets started at
+        # once the last one wins rather than all of them loading
+        async with self.playlists.lock(channel_id):
+            self.stopJob(channel_id)
+            start = time.perf_counter()
+            await self.playlists.startIngest(channel_id, url, links, next_url,
+                                             guild)
+            self.observe(start)
+            if next_url is not None:
+                self.resume(channel_id, url, guild, info['etag'],
+                            info['modified'])
+        if next_url is None:
+            await self.complete(channel_id, url, info['etag'],
+                                info['modified'])
+        return len(links)
+
+    async def replace(self, channel_id, links):
+        '''Replaces the playlist of a channel, stopping its ingest if any'''
+        async with self.playlists.lock(channel_id):
+            self.stopJob(channel_id)
+            start = time.perf_counter()
+            await self.playlists.writePlaylist(channel_id, links)
+            self.observe(start)
+
+    def resume(self, channel_id, url, guild=None, etag=None, modified=None):
+        '''
+        Queues the loading of the set from its checkpoint, etag and modified
+        being the validators to cache the set with once complete
+        '''
+        return self.scheduler.submit(job_kind,
+                                     [channel_id, url, etag, modified],
+                                     guild=guild, timeout=ingest_timeout,
+                                     key=Ingester.key(channel_id))
+
+    def observe(self, start):
+        if self.metrics is not None:
+            self.metrics.observe('berlioz_collab_set_stage_seconds',
+                                 time.perf_counter() - start, stage='persist')
+
+    async def append(self, channel_id, links, next_url):
+        start = time.perf_counter()
+        await self.playlists.appendTracks(channel_id, links, next_url)
+        self.observe(start)
+
+    async def complete(self, channel_id, url, etag=None, modified=None):
+        '''Caches a complete set, for the next !collab set of it'''
+        data = await self.playlists.getPlaylist(channel_id)
+        if data is not None:
+            await self.client.rememberTracklist(url, data[0], etag, modified)
+
+    async def run(self, channel_id, url, etag=None, modified=None):
+        '''
+        Job loading the pages of the set from the stored checkpoint. Failures
+        keep the checkpoint, for resumeAll to take it up on the next start.
+        '''
+        checkpoint = (await self.playlists.getIngests()).get(channel_id)
+        if checkpoint is None or checkpoint[0] != url:
+            # Complete, or replaced by another set meanwhile
+            return
+        async for links, next_url in self.client.iterPages(checkpoint[1]):
+            await self.append(channel_id, links, next_url)
+        await self.complete(channel_id, url, etag, modified)
+
+    async def resumeAll(self, owns=None):
+        '''
+        Resumes the ingests left unfinished
+
+        :param owns: function telling whether this process handles a guild
+                     id, None when it handles them all
+        :return: number of ingests resumed or already queued
+        '''
+        ingests = await self.playlists.getIngests()
+        resumed = 0
+        for channel_id, (url, next_url, guild) in ingests.items():
+            # Other shards take up the channels of their guilds
+            if owns is not None and not owns(guild):
+                continue
+            resumed += 1
+            # Jobs stored by the scheduler are already queued
+            if not self.loading(channel_id):
+                log.info('Resuming the ingest of %s for %s', url, channel_id)
+                self.resume(channel_id, url, guild)
+        return resumed
+
+    def stop(self):
+        '''Cancels the ingests, their checkpoint staying stored'''
+        for job in self.scheduler.live():
+            if job.kind == job_kind:
+                self.scheduler.cancel(job.id)
+        self.scheduler.unregister(job_kind)
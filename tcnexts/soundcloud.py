@@ -0,0 +1,411 @@
+import aiohttp
+import asyncio
+import codecs
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
+from urllib.parse import (parse_qsl, urlencode, urljoin, urlsplit,
+                          urlunsplit)
+
+# Seconds before a SoundCloud request is abandoned
+fetch_timeout = 10
+# Requests allowed in flight at once, across all channels
+max_fetches = 4
+# Connections kept in the shared pool
+max_connections = 8
+# Bytes read from the response between two parser feeds
+chunk_size = 16384
+# Seconds a fetched set is served without asking SoundCloud again
+cache_ttl = 3600
+# Sets kept in memory, the others staying on disk only
+cache_entries = 128
+cache_path = 'tmp/cache'
+# Pages followed at most for one set
+max_pages = 1000
+
+
+class TracklistParser(HTMLParser):
+    '''
+    Collects the track links of a set page fed in chunks
+
+    Links found so far are taken with drain(), and done is set as soon as
+    the tracklist section closes so the rest of the page can be skipped.
+    The address of the following page of the set, given by a link or anchor
+    with rel="next" before that, is kept in next.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+        self.next = None
+        self.done = False
+        # Sections opened since entering the tracklist, 0 when outside
+        self.depth = 0
+        self.in_article = False
+        self.in_title = False
+        self.found = False
+
+    def drain(self):
+        '''Returns the links found since the last call'''
+        links = self.links
+        self.links = []
+        return links
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+
+        if tag in ('a', 'link') and self.next is None:
+            attributes = dict(attrs)
+            if 'next' in (attributes.get('rel') or '').split():
+                self.next = attributes.get('href')
+                return
+
+        if tag == 'section':
+            if self.depth:
+                self.depth += 1
+            elif 'tracklist' in (dict(attrs).get('class') or '').split():
+                self.depth = 1
+        elif not self.depth:
+            return
+        elif tag == 'article':
+            self.in_article = True
+            self.found = False
+        elif tag == 'h2' and self.in_article:
+            self.in_title = True
+        elif tag == 'a' and self.in_title and not self.found:
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+            self.found = True
+
+    def handle_endtag(self, tag):
+        if self.done or not self.depth:
+            return
+
+        if tag == 'section':
+            self.depth -= 1
+            self.done = not self.depth
+        elif tag == 'article':
+            self.in_article = False
+        elif tag == 'h2' and self.in_title:
+            self.in_title = False
+            # Only the first title of an article holds the track
+            self.found = True
+
+
+def parseTracklist(html):
+    '''Extracts the track links of a SoundCloud set page'''
+    parser = TracklistParser()
+    parser.feed(html)
+    return parser.drain()
+
+
+def normalizeUrl(url, query=False):
+    '''
+    Reduces the different ways of writing a set address to one
+
+    The query is dropped, unless query is set as for the addresses of the
+    following pages of a set. It is then kept with its parameters sorted and
+    their numbers written without leading zeros.
+    '''
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    parameters = ''
+    if query:
+        parameters = urlencode(sorted(
+            (name, str(int(value)) if value.isdigit() else value)
+            for name, value in parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), host,
+                       parts.path.rstrip('/') or '/', parameters, ''))
+
+
+class PlaylistCache():
+    '''
+    LRU of parsed track lists backed by one JSON file per set
+
+    Entries are dicts with the url, its links, the etag and last-modified
+    validators and the time they were fetched.
+    '''
+
+    def __init__(self, ttl=cache_ttl, size=cache_entries, path=cache_path):
+        self.ttl = ttl
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def filename(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.json')
+
+    def get(self, url):
+        '''Returns the entry of url if it is held in memory'''
+        entry = self.entries.get(url)
+        if entry is not None:
+            self.entries.move_to_end(url)
+        return entry
+
+    def put(self, entry):
+        '''Keeps entry in memory, evicting the least recently used'''
+        self.entries[entry['url']] = entry
+        self.entries.move_to_end(entry['url'])
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def load(self, url):
+        '''Reads the entry of url from disk, None if there is none'''
+        try:
+            with open(self.filename(url), 'r') as infile:
+                entry = json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('url') != url:
+            return None
+        self.put(entry)
+        return entry
+
+    def save(self, entry):
+        '''Writes entry to disk'''
+        os.makedirs(self.path, exist_ok=True)
+        filename = self.filename(entry['url'])
+        # Shard processes and executor threads may write the same set at
+        # once, each through its own temporary file
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with open(descriptor, 'w') as outfile:
+                json.dump(entry, outfile)
+            os.replace(temporary, filename)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def isFresh(self, entry):
+        return time.time() - entry['fetched'] < self.ttl
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'revalidations': self.revalidations}
+
+
+class SoundCloudClient():
+    '''Fetches SoundCloud pages without blocking the event loop'''
+
+    def __init__(self, timeout=fetch_timeout, concurrency=max_fetches,
+                 connections=max_connections, cache=None, metrics=None):
+        self.timeout = timeout
+        self.metrics = metrics
+        self.connections = connections
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+        self.cache = cache if cache is not None else PlaylistCache()
+        self.inflight = {}
+        self.coalesced = 0
+
+    def getSession(self):
+        '''Returns the pooled HTTP session, opening it on first use'''
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def iterTracklist(self, url, headers=None, info=None):
+        '''
+        Streams a set page and yields its track links as they are parsed
+
+        Reading stops once the tracklist section is closed. Chunks are parsed
+        in the default executor. The status and validators of the response
+        and the absolute address of the next page, None on the last one, are
+        stored in info when given, a 304 answer yielding no link.
+        '''
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        deadline = start + self.timeout
+        parser = TracklistParser()
+        parsing = 0.0
+
+        async with self.semaphore:
+            response = await asyncio.wait_for(
+                self.getSession().get(url, headers=headers), self.timeout)
+            try:
+                if info is not None:
+                    info['status'] = response.status
+                    info['etag'] = response.headers.get('ETag')
+                    info['modified'] = response.headers.get('Last-Modified')
+                if response.status == 304 and headers:
+                    return
+                if response.status != 200:
+                    raise Exception('unexpected status ' +
+                                    str(response.status) + ' for ' + url)
+
+                decoder = codecs.getincrementaldecoder(
+                    response.charset or 'utf-8')(errors='replace')
+                while not parser.done:
+                    chunk = await asyncio.wait_for(
+                        response.content.read(chunk_size),
+                        deadline - loop.time())
+                    text = decoder.decode(chunk, final=not chunk)
+                    parsing += await loop.run_in_executor(None, self.feed,
+                                                          parser, text)
+                    for link in parser.drain():
+                        yield link
+                    if not chunk:
+                        break
+                if info is not None:
+                    info['next'] = (urljoin(url, parser.next)
+                                    if parser.next else None)
+            finally:
+                if parser.done:
+                    # Drop the connection rather than reading the rest
+                    response.close()
+                else:
+                    response.release()
+                if self.metrics is not None:
+                    self.metrics.observe('berlioz_collab_set_stage_seconds',
+                                         parsing, stage='parse')
+                    self.metrics.observe('berlioz_collab_set_stage_seconds',
+                                         loop.time() - start - parsing,
+                                         stage='fetch')
+
+    @staticmethod
+    def feed(parser, text):
+        '''Feeds text to parser and returns the time it took'''
+        start = time.perf_counter()
+        parser.feed(text)
+        return time.perf_counter() - start
+
+    async def shared(self, name, function, *args):
+        '''
+        Returns the result of function(*args), awaiting the call already in
+        flight under name if there is one
+        '''
+        task = self.inflight.get(name)
+        if task is None:
+            task = asyncio.ensure_future(function(*args))
+            self.inflight[name] = task
+            task.add_done_callback(lambda done: self.inflight.pop(name, None))
+        else:
+            self.coalesced += 1
+
+        # A cancelled caller must not cancel the fetch of the others
+        return await asyncio.shield(task)
+
+    async def fetchPage(self, page_url):
+        '''Returns the links of one page of a set and the next page address'''
+        links, next_url = await self.shared(
+            ('page', normalizeUrl(page_url, query=True)), self.loadPage,
+            page_url)
+        return list(links), next_url
+
+    async def fetchFirstPage(self, url):
+        '''
+        Fetches the first page of a set about to be loaded page by page
+
+        A stale cached copy of the set is revalidated with a conditional
+        request. When SoundCloud answers that the set did not change, the
+        cached links of the whole set come back with a 304 status and no
+        next page.
+
+        :return: (links, next page address, info), info holding the status
+                 and the validators of the answer
+        '''
+        key = normalizeUrl(url)
+        links, next_url, info = await self.shared(('first', key),
+                                                  self.loadFirstPage, url, key)
+        return list(links), next_url, dict(info)
+
+    async def cacheEntry(self, key):
+        '''Returns the cached entry of a set, from memory or disk, or None'''
+        entry = self.cache.get(key)
+        if entry is None:
+            loop = asyncio.get_event_loop()
+            entry = await loop.run_in_executor(None, self.cache.load, key)
+        return entry
+
+    async def loadFirstPage(self, url, key):
+        entry = await self.cacheEntry(key)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('modified'):
+                headers['If-Modified-Since'] = entry['modified']
+
+        info = {}
+        links = [link async for link in
+                 self.iterTracklist(url, headers, info)]
+        if info['status'] != 304:
+            self.cache.misses += 1
+            return links, info['next'], info
+
+        # The first page did not change, the set is taken as unchanged
+        self.cache.revalidations += 1
+        entry = dict(entry, fetched=time.time())
+        self.cache.put(entry)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.cache.save, entry)
+        return entry['links'], None, info
+
+    async def loadPage(self, page_url):
+        info = {}
+        links = [link async for link in self.iterTracklist(page_url, info=info)]
+        return links, info['next']
+
+    async def iterPages(self, page_url):
+        '''
+        Fetches a set page after page from page_url on
+
+        :return: async generator of (links, next page address) pairs, the
+                 last address being None
+        '''
+        seen = set()
+        while page_url is not None:
+            if page_url in seen or len(seen) >= max_pages:
+                raise Exception('too many pages in ' + page_url)
+            seen.add(page_url)
+            links, page_url = await self.fetchPage(page_url)
+            yield links, page_url
+
+    async def cachedTracklist(self, url):
+        '''
+        Returns the links of a set if the cache holds it fresh, else None,
+        stale sets being revalidated by fetchFirstPage
+        '''
+        entry = await self.cacheEntry(normalizeUrl(url))
+        if entry is None or not self.cache.isFresh(entry):
+            return None
+        self.cache.put(entry)
+        self.cache.hits += 1
+        return list(entry['links'])
+
+    async def rememberTracklist(self, url, links, etag=None, modified=None):
+        '''
+        Caches the links of a set loaded page by page, with the validators of
+        its first page
+        '''
+        entry = {
+            'url': normalizeUrl(url),
+            'links': list(links),
+            'etag': etag,
+            'modified': modified,
+            'fetched': time.time()
+        }
+        self.cache.put(entry)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.cache.save, entry)
+
+    async def close(self):
+        '''Closes the pooled session'''
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
@@ -0,0 +1,421 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from discordbot.utils.storethread import (StoreThread, cancelTasks)
+
+store_path = 'tmp/collab.db'
+# Seconds between two writes of the moved cursors
+flush_interval = 2
+
+log = logging.getLogger(__name__)
+
+
+class PlaylistStore():
+    '''Storage of the collab playlists and of their cursors, per channel'''
+
+    def setPlaylist(self, channel_id, urls, current=0):
+        '''Replaces the playlist of a channel'''
+        raise NotImplementedError
+
+    def getPlaylist(self, channel_id):
+        '''Returns (urls, current) for a channel, None if it has no playlist'''
+        raise NotImplementedError
+
+    def advance(self, channel_id):
+        '''
+        Hands out the track under the cursor and moves the cursor forward
+
+        :return: the track url, None once the playlist is exhausted
+        '''
+        raise NotImplementedError
+
+    def saveCursors(self, cursors):
+        '''Sets the cursors of several channels, given as {channel_id: current}'''
+        raise NotImplementedError
+
+    def startIngest(self, channel_id, url, guild_id=None):
+        '''
+        Empties the playlist of a channel, to be filled from the set url.
+        guild_id tells which shard resumes the ingest.
+        '''
+        raise NotImplementedError
+
+    def appendTracks(self, channel_id, urls, next_url):
+        '''
+        Adds a page of tracks to the playlist being ingested, along with the
+        address of the next page to fetch, None once the set is complete
+        '''
+        raise NotImplementedError
+
+    def stopIngest(self, channel_id):
+        '''
+        Forgets the ingest of a channel, the playlist keeping the tracks
+        added so far
+        '''
+        raise NotImplementedError
+
+    def getIngests(self):
+        '''
+        Returns the unfinished ingests as
+        {channel_id: (url, next_url, guild_id)}
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqlitePlaylistStore(PlaylistStore):
+    '''
+    Playlists stored in SQLite, tracks and cursors in separate tables
+
+    Advancing a cursor is a single row update. The connection may be used
+    from any thread, and several processes may open the same database.
+    Ingests record the next page to fetch in the transaction adding the
+    tracks of the previous one, so a resumed ingest never repeats a track.
+    '''
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS tracks (
+            channel_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (channel_id, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS cursors (
+            channel_id TEXT PRIMARY KEY,
+            current INTEGER NOT NULL CHECK (current >= 0),
+            length INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ingests (
+            channel_id TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            next_url TEXT NOT NULL,
+            guild_id TEXT
+        );
+    '''
+
+    def __init__(self, path=store_path, timeout=30):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        # Seconds to wait for the write lock held by another process
+        self.conn = sqlite3.connect(path, timeout=timeout,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SqlitePlaylistStore.schema)
+        self.migrate()
+
+    def migrate(self):
+        '''Adds the columns missing from databases of former versions'''
+        columns = [row[1] for row in
+                   self.conn.execute('PRAGMA table_info(ingests)')]
+        if 'guild_id' not in columns:
+            try:
+                self.conn.execute('ALTER TABLE ingests ADD COLUMN guild_id TEXT')
+            except sqlite3.OperationalError:
+                # Added meanwhile by another shard
+                pass
+
+    def transaction(self, queries):
+        '''Runs queries(cursor) atomically and returns its result'''
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = queries(cursor)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return result
+
+    def setPlaylist(self, channel_id, urls, current=0):
+        def queries(cursor):
+            cursor.execute('DELETE FROM tracks WHERE channel_id = ?',
+                           (channel_id,))
+            cursor.executemany(
+                'INSERT INTO tracks (channel_id, position, url) '
+                'VALUES (?, ?, ?)',
+                [(channel_id, i, url) for i, url in enumerate(urls)])
+            cursor.execute(
+                'INSERT OR REPLACE INTO cursors (channel_id, current, length) '
+                'VALUES (?, ?, ?)', (channel_id, current, len(urls)))
+            cursor.execute('DELETE FROM ingests WHERE channel_id = ?',
+                           (channel_id,))
+
+        self.transaction(queries)
+
+    def getPlaylist(self, channel_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT current FROM cursors WHERE channel_id = ?',
+                (channel_id,)).fetchone()
+            if row is None:
+                return None
+            urls = [url for url, in self.conn.execute(
+                'SELECT url FROM tracks WHERE channel_id = ? '
+                'ORDER BY position', (channel_id,))]
+        return urls, row[0]
+
+    def advance(self, channel_id):
+        def queries(cursor):
+            cursor.execute(
+                'UPDATE cursors SET current = current + 1 '
+                'WHERE channel_id = ? AND current < length', (channel_id,))
+            if cursor.rowcount == 0:
+                return None
+            row = cursor.execute(
+                'SELECT url FROM tracks JOIN cursors USING (channel_id) '
+                'WHERE channel_id = ? AND position = current - 1',
+                (channel_id,)).fetchone()
+            return row[0]
+
+        return self.transaction(queries)
+
+    def saveCursors(self, cursors):
+        def queries(cursor):
+            cursor.executemany(
+                'UPDATE cursors SET current = ? WHERE channel_id = ?',
+                [(current, channel_id)
+                 for channel_id, current in cursors.items()])
+
+        self.transaction(queries)
+
+    def startIngest(self, channel_id, url, guild_id=None):
+        def queries(cursor):
+            cursor.execute('DELETE FROM tracks WHERE channel_id = ?',
+                           (channel_id,))
+            cursor.execute(
+                'INSERT OR REPLACE INTO cursors (channel_id, current, length) '
+                'VALUES (?, 0, 0)', (channel_id,))
+            cursor.execute(
+                'INSERT OR REPLACE INTO ingests '
+                '(channel_id, url, next_url, guild_id) VALUES (?, ?, ?, ?)',
+                (channel_id, url, url, guild_id))
+
+        self.transaction(queries)
+
+    def appendTracks(self, channel_id, urls, next_url):
+        def queries(cursor):
+            length, = cursor.execute(
+                'SELECT length FROM cursors WHERE channel_id = ?',
+                (channel_id,)).fetchone()
+            cursor.executemany(
+                'INSERT INTO tracks (channel_id, position, url) '
+                'VALUES (?, ?, ?)',
+                [(channel_id, length + i, url) for i, url in enumerate(urls)])
+            cursor.execute('UPDATE cursors SET length = ? WHERE channel_id = ?',
+                           (length + len(urls), channel_id))
+            if next_url is None:
+                cursor.execute('DELETE FROM ingests WHERE channel_id = ?',
+                               (channel_id,))
+            else:
+                cursor.execute(
+                    'UPDATE ingests SET next_url = ? WHERE channel_id = ?',
+                    (next_url, channel_id))
+
+        self.transaction(queries)
+
+    def stopIngest(self, channel_id):
+        def queries(cursor):
+            cursor.execute('DELETE FROM ingests WHERE channel_id = ?',
+                           (channel_id,))
+
+        self.transaction(queries)
+
+    def getIngests(self):
+        with self.lock:
+            return {channel_id: (url, next_url, guild_id)
+                    for channel_id, url, next_url, guild_id in
+                    self.conn.execute('SELECT channel_id, url, next_url, '
+                                      'guild_id FROM ingests')}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class Playlist():
+    '''Tracks of a channel and position of the next one to hand out'''
+    __slots__ = ('urls', 'current')
+
+    def __init__(self, urls, current=0):
+        self.urls = urls
+        self.current = current
+
+
+class WriteBehindStore():
+    '''
+    Serves the playlists from memory in front of a PlaylistStore
+
+    Playlists are loaded on first use. Cursor moves are written in batches
+    every interval seconds, by a single worker thread so writes keep their
+    order, and once more when stopping. Commands on one channel are
+    serialised by a per-channel lock, different channels never wait for
+    each other.
+    '''
+
+    def __init__(self, store, interval=flush_interval):
+        self.store = store
+        self.interval = interval
+        self.playlists = {}
+        self.locks = {}
+        self.dirty = set()
+        self.thread = StoreThread('playlists')
+        self.loop = None
+        self.task = None
+
+    def lock(self, channel_id):
+        '''Returns the lock of a channel'''
+        try:
+            return self.locks[channel_id]
+        except KeyError:
+            lock = self.locks[channel_id] = asyncio.Lock()
+            return lock
+
+    async def load(self, channel_id):
+        '''
+        Returns the Playlist of a channel, None if it has none. Must be called
+        with the channel lock held.
+        '''
+        try:
+            return self.playlists[channel_id]
+        except KeyError:
+            pass
+
+        # Reads do not need to wait behind the pending writes
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, self.store.getPlaylist,
+                                          channel_id)
+        playlist = self.playlists[channel_id] = Playlist(*data) if data else None
+        return playlist
+
+    async def getPlaylist(self, channel_id):
+        async with self.lock(channel_id):
+            playlist = await self.load(channel_id)
+        if playlist is None:
+            return None
+        return list(playlist.urls), playlist.current
+
+    async def setPlaylist(self, channel_id, urls):
+        async with self.lock(channel_id):
+            await self.writePlaylist(channel_id, urls)
+
+    async def writePlaylist(self, channel_id, urls):
+        '''setPlaylist, for callers already holding the channel lock'''
+        self.playlists[channel_id] = Playlist(list(urls))
+        self.dirty.discard(channel_id)
+        await self.thread.call(self.store.setPlaylist, channel_id, urls)
+
+    async def startIngest(self, channel_id, url, urls, next_url,
+                          guild_id=None):
+        '''
+        Replaces the playlist of a channel with the first page of the set
+        url, next_url being the page to fetch after it. Must be called with
+        the channel lock held.
+        '''
+        self.playlists[channel_id] = Playlist(list(urls))
+        self.dirty.discard(channel_id)
+        await self.thread.call(self.store.startIngest, channel_id, url, guild_id)
+        await self.thread.call(self.store.appendTracks, channel_id, urls, next_url)
+
+    async def appendTracks(self, channel_id, urls, next_url):
+        async with self.lock(channel_id):
+            playlist = await self.load(channel_id)
+            playlist.urls.extend(urls)
+            await self.thread.call(self.store.appendTracks, channel_id, urls,
+                            next_url)
+
+    async def stopIngest(self, channel_id):
+        await self.thread.call(self.store.stopIngest, channel_id)
+
+    async def getIngests(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.store.getIngests)
+
+    async def advance(self, channel_id):
+        async with self.lock(channel_id):
+            playlist = await self.load(channel_id)
+            if playlist is None or playlist.current >= len(playlist.urls):
+                return None
+
+            url = playlist.urls[playlist.current]
+            playlist.current += 1
+            self.dirty.add(channel_id)
+            return url
+
+    def takeDirty(self):
+        cursors = {channel_id: self.playlists[channel_id].current
+                   for channel_id in self.dirty}
+        self.dirty.clear()
+        return cursors
+
+    async def flush(self):
+        '''Writes the cursors moved since the last flush'''
+        if self.dirty:
+            await self.thread.call(self.store.saveCursors, self.takeDirty())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.exception('Could not write the playlist cursors: %s', e)
+
+    def start(self, loop):
+        '''Starts the periodic flush on loop'''
+        self.loop = loop
+        self.task = loop.create_task(self.run())
+
+    def stop(self):
+        '''
+        Writes the pending cursors and stops the periodic flush. May be called
+        once the loop is closed, as after bot.run().
+        '''
+        self.thread.stop()
+        # Moves made since the last flush, written here as the thread is gone
+        if self.dirty:
+            self.store.saveCursors(self.takeDirty())
+        if self.task is not None:
+            cancelTasks(self.loop, [self.task])
+            self.task = None
+
+
+def migrateFiles(store, directory='tmp'):
+    '''
+    Moves the playlists of the former tmp/data<channel_id>.txt files into
+    store. Migrated files are renamed with a .migrated suffix.
+
+    :return: number of migrated playlists
+    '''
+    migrated = 0
+    for path in glob.glob(os.path.join(directory, 'data*.txt')):
+        channel_id = os.path.basename(path)[len('data'):-len('.txt')]
+        try:
+            with open(path, 'r') as infile:
+                data = json.load(infile)
+            urls = data['urls']
+            current = data['current']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning('Could not migrate %s: %s', path, e)
+            continue
+
+        if store.getPlaylist(channel_id) is None:
+            store.setPlaylist(channel_id, urls, max(0, min(current, len(urls))))
+        try:
+            os.replace(path, path + '.migrated')
+        except FileNotFoundError:
+            # Moved by another shard migrating at the same time
+            continue
+        migrated += 1
+
+    return migrated
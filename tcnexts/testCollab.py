@@ -0,0 +1,796 @@
+import asyncio
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+from urllib.parse import (parse_qs, urlsplit)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from store import (PlaylistStore, SqlitePlaylistStore, WriteBehindStore,
+                   migrateFiles)
+
+from soundcloud import (SoundCloudClient, TracklistParser, PlaylistCache,
+                        normalizeUrl, parseTracklist)
+
+from ingest import Ingester
+
+from discordbot.utils.jobs import Scheduler
+from discordbot.utils.shards import shardFor
+
+
+def playlistPage(tracks, comments=1, first=0, next_url=None):
+    '''Builds a page shaped like a SoundCloud set'''
+    articles = ''.join('<article class="audible"><h2 itemprop="name">'
+                       '<a itemprop="url" href="/user/track-{0}">Track {0}</a>'
+                       '<a href="/user">User</a></h2><h2><a href="/no">x</a>'
+                       '</h2></article>'.format(i)
+                       for i in range(first, first + tracks))
+    if next_url is not None:
+        articles += '<a rel="next" href="{}">More</a>'.format(next_url)
+    others = ''.join('<article><h2><a href="/other-{}">x</a></h2><p>{}</p>'
+                     '</article>'.format(i, 'text ' * 20)
+                     for i in range(comments))
+    return ('<html><body><section class="header"><h1>Set</h1></section>'
+            '<section class="tracklist"><section class="inner">' + articles +
+            '</section></section><section class="comments">' + others +
+            '</section></body></html>')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        if self.path.startswith('/slow'):
+            time.sleep(0.5)
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path.startswith('/paged'):
+            self.sendPage()
+            return
+
+        etag = '"{}"'.format(self.server.tracks)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = playlistPage(self.server.tracks).encode('utf-8')
+        try:
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client gave up on a slow page
+            pass
+
+    def sendPage(self):
+        # /paged?page=n, page 1 without a query
+        page = int(parse_qs(urlsplit(self.path).query).get('page', ['1'])[0])
+        if page == self.server.fail_page:
+            self.send_response(500)
+            self.end_headers()
+            return
+        etag = '"{}-{}"'.format(self.server.pages, self.server.tracks)
+        if page == 1 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        next_url = ('/paged?page={}'.format(page + 1)
+                    if page < self.server.pages else None)
+        body = playlistPage(self.server.tracks, first=(page - 1) *
+                            self.server.tracks, next_url=next_url)
+        body = body.encode('utf-8')
+        self.send_response(200)
+        if page == 1:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer():
+    '''Local HTTP server answering with fake SoundCloud sets'''
+
+    def __init__(self, tracks=3):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.block_on_close = False
+        self.server.tracks = tracks
+        self.server.pages = 1
+        self.server.fail_page = None
+        self.server.requests = 0
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,), daemon=True)
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_port, path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestTracklistParser(unittest.TestCase):
+    def test_parseTracklist(self):
+        self.assertEqual(parseTracklist(playlistPage(2)),
+                         ['/user/track-0', '/user/track-1'])
+
+    def test_parseChunks(self):
+        html = playlistPage(50, comments=50)
+        parser = TracklistParser()
+        links = []
+        for i in range(0, len(html), 7):
+            parser.feed(html[i:i + 7])
+            links += parser.drain()
+            if parser.done:
+                break
+        self.assertEqual(links, ['/user/track-' + str(i) for i in range(50)])
+        self.assertLess(i, html.index('class="comments"'))
+
+    def test_nextPage(self):
+        parser = TracklistParser()
+        parser.feed(playlistPage(2, next_url='/set?page=2'))
+        self.assertEqual(parser.drain(), ['/user/track-0', '/user/track-1'])
+        self.assertEqual(parser.next, '/set?page=2')
+        parser = TracklistParser()
+        parser.feed('<head><link rel="next" href="/p2"></head>' +
+                    playlistPage(1))
+        self.assertEqual(parser.next, '/p2')
+
+    def test_normalizeUrl(self):
+        self.assertEqual(
+            normalizeUrl('HTTPS://www.SoundCloud.com/mvy/sets/pl/?si=x#t'),
+            'https://soundcloud.com/mvy/sets/pl')
+        self.assertEqual(normalizeUrl('https://m.soundcloud.com/mvy/sets/pl'),
+                         'https://soundcloud.com/mvy/sets/pl')
+        self.assertEqual(
+            normalizeUrl('https://soundcloud.com/pl/?page=01&a=b', query=True),
+            normalizeUrl('https://soundcloud.com/pl?a=b&page=1', query=True))
+
+    def test_lru(self):
+        cache = PlaylistCache(size=2)
+        for url in ('a', 'b', 'c'):
+            cache.put({'url': url, 'links': [], 'fetched': 0})
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+
+    def test_concurrentSaves(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = PlaylistCache(path=directory)
+            entry = {'url': 'a', 'links': ['/a'] * 1000, 'fetched': 0}
+            errors = []
+
+            def save():
+                try:
+                    for i in range(20):
+                        cache.save(entry)
+                except OSError as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=save) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(os.listdir(directory),
+                             [os.path.basename(cache.filename('a'))])
+            self.assertEqual(cache.load('a'), entry)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestSoundCloudClient(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.stub = StubServer().__enter__()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.stub.__exit__()
+        self.directory.cleanup()
+
+    def client(self, ttl=60, **kwargs):
+        cache = PlaylistCache(ttl=ttl, path=self.directory.name)
+        return SoundCloudClient(cache=cache, **kwargs)
+
+    async def fetchSet(self, client, path):
+        '''Fetches and caches a single page set as !collab set does'''
+        url = self.stub.url(path)
+        links, next_url, info = await client.fetchFirstPage(url)
+        if info['status'] != 304:
+            await client.rememberTracklist(url, links, info['etag'],
+                                           info['modified'])
+        return links
+
+    async def test_fetchFirstPage(self):
+        client = self.client()
+        try:
+            links, next_url, info = await client.fetchFirstPage(
+                self.stub.url('/set'))
+        finally:
+            await client.close()
+        self.assertEqual(links, ['/user/track-0', '/user/track-1',
+                                 '/user/track-2'])
+        self.assertIsNone(next_url)
+        self.assertEqual((info['status'], info['etag']), (200, '"3"'))
+
+    async def test_largeSet(self):
+        self.stub.server.tracks = 2000
+        client = self.client()
+        try:
+            links = []
+            async for link in client.iterTracklist(self.stub.url('/set')):
+                links.append(link)
+            again, _, _ = await client.fetchFirstPage(self.stub.url('/set'))
+        finally:
+            await client.close()
+        self.assertEqual(len(links), 2000)
+        self.assertEqual(links, again)
+
+    async def test_cache(self):
+        client = self.client()
+        try:
+            first = await self.fetchSet(client, '/set')
+            second = await client.cachedTracklist(self.stub.url('/set/?a=b'))
+        finally:
+            await client.close()
+        self.assertEqual(first, second)
+        self.assertEqual(self.stub.server.requests, 1)
+        self.assertEqual(client.cache.stats(),
+                         {'hits': 1, 'misses': 1, 'revalidations': 0})
+
+    async def test_revalidation(self):
+        client = self.client(ttl=0)
+        try:
+            first = await self.fetchSet(client, '/set')
+            self.assertIsNone(await client.cachedTracklist(
+                self.stub.url('/set')))
+            second = await self.fetchSet(client, '/set')
+            self.stub.server.tracks = 4
+            third = await self.fetchSet(client, '/set')
+        finally:
+            await client.close()
+        self.assertEqual(first, second)
+        self.assertEqual(len(third), 4)
+        self.assertEqual(self.stub.server.requests, 3)
+        self.assertEqual(client.cache.stats(),
+                         {'hits': 0, 'misses': 2, 'revalidations': 1})
+
+    async def test_diskCache(self):
+        client = self.client()
+        try:
+            first = await self.fetchSet(client, '/set')
+        finally:
+            await client.close()
+
+        client = self.client()
+        try:
+            second = await client.cachedTracklist(self.stub.url('/set'))
+        finally:
+            await client.close()
+        self.assertEqual(first, second)
+        self.assertEqual(self.stub.server.requests, 1)
+        self.assertEqual(client.cache.hits, 1)
+
+    async def test_status(self):
+        client = self.client()
+        try:
+            with self.assertRaises(Exception):
+                await client.fetchFirstPage(self.stub.url('/missing'))
+        finally:
+            await client.close()
+
+    async def test_timeout(self):
+        client = self.client(timeout=0.1)
+        try:
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.fetchPage(self.stub.url('/slow'))
+        finally:
+            await client.close()
+
+    async def test_loopNotBlocked(self):
+        client = self.client()
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.ensure_future(ticker())
+        try:
+            await client.fetchFirstPage(self.stub.url('/slow'))
+        finally:
+            task.cancel()
+            await client.close()
+        self.assertGreater(ticks, 10)
+
+    async def test_concurrencyLimit(self):
+        client = self.client(concurrency=2)
+        start = time.monotonic()
+        try:
+            await asyncio.gather(
+                *[client.fetchPage(self.stub.url('/slow?page={}'.format(i)))
+                  for i in range(4)])
+        finally:
+            await client.close()
+        self.assertGreater(time.monotonic() - start, 0.9)
+
+    async def test_coalescing(self):
+        client = self.client()
+        try:
+            results = await asyncio.gather(
+                *[client.fetchFirstPage(self.stub.url('/slow/set'))
+                  for i in range(5)])
+        finally:
+            await client.close()
+        self.assertEqual(self.stub.server.requests, 1)
+        self.assertEqual(client.coalesced, 4)
+        self.assertEqual(client.inflight, {})
+        self.assertTrue(all(links == results[0][0] for links, _, _ in results))
+        # Every caller gets its own list
+        results[0][0].append('/user/extra')
+        self.assertEqual(len(results[1][0]), 3)
+
+    async def test_iterPages(self):
+        self.stub.server.pages = 3
+        client = self.client()
+        try:
+            pages = [page async for page in
+                     client.iterPages(self.stub.url('/paged'))]
+        finally:
+            await client.close()
+        self.assertEqual([len(links) for links, _ in pages], [3, 3, 3])
+        self.assertEqual([next_url for _, next_url in pages],
+                         [self.stub.url('/paged?page=2'),
+                          self.stub.url('/paged?page=3'), None])
+        self.assertEqual([link for links, _ in pages for link in links],
+                         ['/user/track-{}'.format(i) for i in range(9)])
+
+    async def test_pageCoalescing(self):
+        self.stub.server.pages = 3
+        client = self.client()
+        try:
+            results = await asyncio.gather(
+                client.fetchPage(self.stub.url('/paged?page=2')),
+                client.fetchPage(self.stub.url('/paged/?page=02')))
+        finally:
+            await client.close()
+        self.assertEqual(self.stub.server.requests, 1)
+        self.assertEqual(client.coalesced, 1)
+        self.assertEqual(results[0], results[1])
+
+
+class TestPlaylistStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'collab.db')
+        self.store = SqlitePlaylistStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_advance(self):
+        self.assertIsNone(self.store.getPlaylist('1'))
+        self.assertIsNone(self.store.advance('1'))
+
+        self.store.setPlaylist('1', ['/a', '/b'])
+        self.store.setPlaylist('2', ['/c'])
+        self.assertEqual(self.store.advance('1'), '/a')
+        self.assertEqual(self.store.advance('1'), '/b')
+        self.assertIsNone(self.store.advance('1'))
+        self.assertEqual(self.store.getPlaylist('1'), (['/a', '/b'], 2))
+        self.assertEqual(self.store.getPlaylist('2'), (['/c'], 0))
+
+    def test_reset(self):
+        self.store.setPlaylist('1', ['/a', '/b', '/c'])
+        self.store.advance('1')
+        self.store.setPlaylist('1', ['/d'])
+        self.assertEqual(self.store.getPlaylist('1'), (['/d'], 0))
+        self.assertEqual(self.store.advance('1'), '/d')
+
+    def test_persistence(self):
+        self.store.setPlaylist('1', ['/a', '/b'])
+        self.store.advance('1')
+        self.store.close()
+        self.store = SqlitePlaylistStore(self.path)
+        self.assertEqual(self.store.advance('1'), '/b')
+
+    def test_processes(self):
+        urls = ['/track-' + str(i) for i in range(200)]
+        self.store.setPlaylist('1', urls)
+        # Each process advances the same cursor until the playlist is empty
+        code = ('import sys; sys.path.insert(0, sys.argv[1]); '
+                'from store import SqlitePlaylistStore; '
+                'store = SqlitePlaylistStore(sys.argv[2]); '
+                'url = store.advance("1")\n'
+                'while url is not None:\n'
+                '    print(url)\n'
+                '    url = store.advance("1")')
+        directory = os.path.dirname(os.path.abspath(__file__))
+        workers = [subprocess.Popen([sys.executable, '-c', code, directory,
+                                     self.path], stdout=subprocess.PIPE,
+                                    universal_newlines=True)
+                   for i in range(4)]
+        given = []
+        for worker in workers:
+            given += worker.communicate()[0].split()
+        self.assertEqual(sorted(given), sorted(urls))
+
+    def test_ingest(self):
+        self.store.setPlaylist('1', ['/old'])
+        self.store.startIngest('1', '/set', '7')
+        self.assertEqual(self.store.getPlaylist('1'), ([], 0))
+        self.assertEqual(self.store.getIngests(), {'1': ('/set', '/set', '7')})
+
+        self.store.appendTracks('1', ['/a', '/b'], '/set?page=2')
+        self.assertEqual(self.store.advance('1'), '/a')
+        self.store.close()
+        self.store = SqlitePlaylistStore(self.path)
+        self.assertEqual(self.store.getIngests(),
+                         {'1': ('/set', '/set?page=2', '7')})
+
+        self.store.appendTracks('1', ['/c'], None)
+        self.assertEqual(self.store.getPlaylist('1'), (['/a', '/b', '/c'], 1))
+        self.assertEqual(self.store.getIngests(), {})
+
+    def test_migrateSchema(self):
+        self.store.close()
+        os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE ingests (channel_id TEXT PRIMARY KEY, '
+                     'url TEXT NOT NULL, next_url TEXT NOT NULL)')
+        conn.execute("INSERT INTO ingests VALUES ('1', '/set', '/set?p=2')")
+        conn.commit()
+        conn.close()
+        self.store = SqlitePlaylistStore(self.path)
+        self.assertEqual(self.store.getIngests(),
+                         {'1': ('/set', '/set?p=2', None)})
+
+    def test_migrateFiles(self):
+        legacy = os.path.join(self.directory.name, 'data42.txt')
+        with open(legacy, 'w') as outfile:
+            json.dump({'urls': ['/a', '/b', '/c'], 'current': 1}, outfile)
+        broken = os.path.join(self.directory.name, 'data43.txt')
+        with open(broken, 'w') as outfile:
+            outfile.write('{')
+
+        self.assertEqual(migrateFiles(self.store, self.directory.name), 1)
+        self.assertEqual(self.store.getPlaylist('42'), (['/a', '/b', '/c'], 1))
+        self.assertFalse(os.path.exists(legacy))
+        self.assertTrue(os.path.exists(legacy + '.migrated'))
+        self.assertTrue(os.path.exists(broken))
+        self.assertEqual(migrateFiles(self.store, self.directory.name), 0)
+
+
+class TestWriteBehindStore(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SqlitePlaylistStore(
+            os.path.join(self.directory.name, 'collab.db'))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    async def test_lazyLoad(self):
+        self.store.setPlaylist('1', ['/a', '/b'], 1)
+        playlists = WriteBehindStore(self.store)
+        self.assertEqual(playlists.playlists, {})
+        self.assertEqual(await playlists.advance('1'), '/b')
+        self.assertIsNone(await playlists.advance('1'))
+        self.assertIsNone(await playlists.advance('2'))
+        self.assertIsNone(await playlists.getPlaylist('2'))
+        playlists.stop()
+
+    async def test_writeBehind(self):
+        playlists = WriteBehindStore(self.store)
+        await playlists.setPlaylist('1', ['/a', '/b', '/c'])
+        await playlists.advance('1')
+        await playlists.advance('1')
+        self.assertEqual(self.store.getPlaylist('1'), (['/a', '/b', '/c'], 0))
+
+        await playlists.flush()
+        self.assertEqual(self.store.getPlaylist('1'), (['/a', '/b', '/c'], 2))
+        self.assertEqual(playlists.dirty, set())
+
+        await playlists.advance('1')
+        playlists.stop()
+        self.assertEqual(self.store.getPlaylist('1'), (['/a', '/b', '/c'], 3))
+
+    async def test_periodicFlush(self):
+        playlists = WriteBehindStore(self.store, interval=0.01)
+        playlists.start(asyncio.get_event_loop())
+        await playlists.setPlaylist('1', ['/a', '/b'])
+        await playlists.advance('1')
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.store.getPlaylist('1'), (['/a', '/b'], 1))
+        playlists.stop()
+
+
+class TestStopClosedLoop(unittest.TestCase):
+    def test_stop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = SqlitePlaylistStore(os.path.join(directory, 'collab.db'))
+            playlists = WriteBehindStore(store, interval=60)
+            loop = asyncio.new_event_loop()
+            try:
+                playlists.start(loop)
+                loop.run_until_complete(
+                    playlists.setPlaylist('1', ['/a', '/b']))
+                loop.run_until_complete(playlists.advance('1'))
+                # The flush task waits in its sleep when the loop closes
+                loop.run_until_complete(asyncio.sleep(0.01))
+            finally:
+                loop.close()
+            playlists.stop()
+            self.assertEqual(store.getPlaylist('1'), (['/a', '/b'], 1))
+            store.close()
+
+
+class TestIngester(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.stub = StubServer().__enter__()
+        self.stub.server.pages = 4
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'collab.db')
+
+    def tearDown(self):
+        self.stub.__exit__()
+        self.directory.cleanup()
+
+    def open(self, ttl=60):
+        store = SqlitePlaylistStore(self.path)
+        cache = PlaylistCache(ttl=ttl, path=self.directory.name)
+        client = SoundCloudClient(cache=cache)
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        return store, client, WriteBehindStore(store)
+
+    async def close(self, store, client, playlists):
+        self.scheduler.stop()
+        playlists.stop()
+        store.close()
+        await client.close()
+
+    async def test_background(self):
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        try:
+            self.assertEqual(await ingester.start('1', self.stub.url('/paged'),
+                                                  'guild'), 3)
+            # The first tracks are served while the others load
+            self.assertTrue(ingester.loading('1'))
+            job = ingester.job('1')
+            self.assertEqual(job.guild, 'guild')
+            self.assertEqual(await playlists.advance('1'), '/user/track-0')
+            self.assertEqual(await job.ended, 'done')
+            self.assertFalse(ingester.loading('1'))
+            urls, current = await playlists.getPlaylist('1')
+            self.assertEqual(len(urls), 12)
+            self.assertEqual(store.getPlaylist('1'), (urls, 0))
+            self.assertEqual(store.getIngests(), {})
+            self.assertEqual(await client.cachedTracklist(
+                self.stub.url('/paged')), urls)
+        finally:
+            await self.close(store, client, playlists)
+
+    async def test_revalidation(self):
+        store, client, playlists = self.open(ttl=0)
+        ingester = Ingester(client, playlists, self.scheduler)
+        url = self.stub.url('/paged')
+        try:
+            await ingester.start('1', url)
+            await ingester.job('1').ended
+            await playlists.advance('1')
+            # The stale set did not change, only its first page is asked
+            requests = self.stub.server.requests
+            self.assertEqual(await ingester.start('1', url), 12)
+            self.assertEqual(self.stub.server.requests - requests, 1)
+            self.assertFalse(ingester.loading('1'))
+            self.assertEqual(store.getPlaylist('1'),
+                             (['/user/track-{}'.format(i) for i in range(12)],
+                              0))
+            self.assertEqual(client.cache.stats(),
+                             {'hits': 0, 'misses': 1, 'revalidations': 1})
+            # A changed set is loaded again
+            self.stub.server.tracks = 2
+            self.assertEqual(await ingester.start('1', url), 2)
+            self.assertEqual(await ingester.job('1').ended, 'done')
+            self.assertEqual(len(store.getPlaylist('1')[0]), 8)
+            self.assertEqual(client.cache.stats()['misses'], 2)
+        finally:
+            await self.close(store, client, playlists)
+
+    async def test_firstPageFails(self):
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        await playlists.setPlaylist('1', ['/old'])
+        self.stub.server.fail_page = 1
+        try:
+            with self.assertRaises(Exception):
+                await ingester.start('1', self.stub.url('/paged'))
+            self.assertEqual(store.getPlaylist('1'), (['/old'], 0))
+            self.assertEqual(store.getIngests(), {})
+        finally:
+            await self.close(store, client, playlists)
+
+    async def test_resume(self):
+        self.stub.server.fail_page = 3
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        try:
+            # A guild of shard 1 out of 2
+            await ingester.start('1', self.stub.url('/paged'), str(1 << 22))
+            self.assertEqual(await ingester.job('1').ended, 'failed')
+            self.assertEqual(len(store.getPlaylist('1')[0]), 6)
+        finally:
+            await self.close(store, client, playlists)
+
+        # Restarted once SoundCloud answers again
+        self.stub.server.fail_page = None
+        requests = self.stub.server.requests
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        try:
+            # Only the shard of the guild takes the ingest up
+            self.assertEqual(await ingester.resumeAll(
+                lambda guild: shardFor(guild, 2) == 0), 0)
+            self.assertFalse(ingester.loading('1'))
+            self.assertEqual(await ingester.resumeAll(
+                lambda guild: shardFor(guild, 2) == 1), 1)
+            self.assertEqual(ingester.job('1').guild, str(1 << 22))
+            self.assertEqual(await ingester.job('1').ended, 'done')
+            urls, current = store.getPlaylist('1')
+        finally:
+            await self.close(store, client, playlists)
+        self.assertEqual(urls, ['/user/track-{}'.format(i)
+                                for i in range(12)])
+        self.assertEqual(self.stub.server.requests - requests, 2)
+
+    async def test_revoked(self):
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        try:
+            await ingester.start('1', self.stub.url('/paged'))
+            job = ingester.job('1')
+            # As by !jobs cancel
+            self.assertIs(await self.scheduler.revoke(job.id), job)
+            self.assertEqual(await job.ended, 'cancelled')
+            self.assertEqual(store.getIngests(), {})
+            loaded = store.getPlaylist('1')[0]
+        finally:
+            await self.close(store, client, playlists)
+
+        # Not resumed on the next start
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        try:
+            self.assertEqual(await ingester.resumeAll(), 0)
+            self.assertFalse(ingester.loading('1'))
+            self.assertEqual(store.getPlaylist('1'), (loaded, 0))
+        finally:
+            await self.close(store, client, playlists)
+
+    async def test_replaced(self):
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        try:
+            await ingester.start('1', self.stub.url('/paged'))
+            first = ingester.job('1')
+            await ingester.start('1', self.stub.url('/paged?page=3'))
+            self.assertEqual(await first.ended, 'cancelled')
+            self.assertEqual(await ingester.job('1').ended, 'done')
+            self.assertEqual(store.getPlaylist('1')[0],
+                             ['/user/track-{}'.format(i) for i in range(6, 12)])
+        finally:
+            await self.close(store, client, playlists)
+
+    async def test_concurrentStarts(self):
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        try:
+            url = self.stub.url('/paged')
+            await asyncio.gather(ingester.start('1', url),
+                                 ingester.start('1', url))
+            self.assertEqual(len(self.scheduler.live()), 1)
+            self.assertEqual(await ingester.job('1').ended, 'done')
+            urls = store.getPlaylist('1')[0]
+            self.assertEqual(urls, ['/user/track-{}'.format(i)
+                                    for i in range(12)])
+            self.assertEqual((await playlists.getPlaylist('1'))[0], urls)
+        finally:
+            await self.close(store, client, playlists)
+
+    async def test_coalescedStarts(self):
+        # Two !collab set of one set at once ask SoundCloud once
+        store, client, playlists = self.open()
+        ingester = Ingester(client, playlists, self.scheduler)
+        try:
+            url = self.stub.url('/slow/set')
+            counts = await asyncio.gather(ingester.start('1', url),
+                                          ingester.start('2', url))
+            self.assertEqual(counts, [3, 3])
+            self.assertEqual(self.stub.server.requests, 1)
+            self.assertEqual(client.coalesced, 1)
+            self.assertEqual(store.getPlaylist('1'), store.getPlaylist('2'))
+        finally:
+            await self.close(store, client, playlists)
+
+
+class SlowStore(PlaylistStore):
+    '''In-memory store taking some time to read a playlist'''
+
+    def __init__(self, playlists, delay):
+        self.playlists = playlists
+        self.delay = delay
+        self.reads = 0
+
+    def getPlaylist(self, channel_id):
+        self.reads += 1
+        time.sleep(self.delay)
+        return self.playlists.get(channel_id)
+
+    def saveCursors(self, cursors):
+        pass
+
+
+class TestConcurrentNext(unittest.IsolatedAsyncioTestCase):
+    async def test_singleChannel(self):
+        urls = ['/track-' + str(i) for i in range(300)]
+        store = SlowStore({'1': (urls, 0)}, 0.05)
+        playlists = WriteBehindStore(store)
+
+        given = await asyncio.gather(*[playlists.advance('1')
+                                       for i in range(500)])
+        playlists.stop()
+
+        given = [url for url in given if url is not None]
+        self.assertEqual(sorted(given), sorted(urls))
+        self.assertEqual(store.reads, 1)
+
+    async def test_channels(self):
+        channels = 10
+        delay = 0.2
+        store = SlowStore({str(c): (['/{}-{}'.format(c, i) for i in range(25)],
+                                    0) for c in range(channels)}, delay)
+        playlists = WriteBehindStore(store)
+
+        start = time.monotonic()
+        given = await asyncio.gather(*[playlists.advance(str(c))
+                                       for i in range(30)
+                                       for c in range(channels)])
+        elapsed = time.monotonic() - start
+        playlists.stop()
+
+        given = [url for url in given if url is not None]
+        self.assertEqual(len(given), channels * 25)
+        self.assertEqual(len(set(given)), channels * 25)
+        # Channels are loaded side by side, not one after the other
+        self.assertLess(elapsed, channels * delay / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()